@@ -0,0 +1,223 @@
+import io
+import os
+import gzip
+import zlib
+import time
+import uuid
+import struct
+import logging
+from contextlib import contextmanager
+
+# Artifacts are written gzip compressed as <path>.gz. Artifacts written before compression are still read from <path>.
+COMPRESSED_SUFFIX = ".gz"
+COMPRESSION_LEVEL = 6
+GZIP_MAGIC = b"\x1f\x8b\x08"  # Start of every gzip member: magic number & the deflate method.
+
+
+def get_artifact_path(path: str) -> str | None:
+    """
+    Returns the file an artifact is stored in, compressed or not, or None if it doesn't exist.
+    """
+    if os.path.isfile(f"{path}{COMPRESSED_SUFFIX}"):
+        return f"{path}{COMPRESSED_SUFFIX}"
+    if os.path.isfile(path):
+        return path
+    return None
+
+
+def artifact_exists(path: str) -> bool:
+    return get_artifact_path(path) is not None
+
+
+def is_compressed(artifact_path: str) -> bool:
+    return artifact_path.endswith(COMPRESSED_SUFFIX)
+
+
+def open_artifact(path: str):
+    """
+    Opens an artifact for reading text. Returns (raw_file, text_file), raw_file.tell() is the position in the stored
+    (compressed) bytes. Raises FileNotFoundError if the artifact doesn't exist.
+    """
+    artifact_path = get_artifact_path(path)
+    if artifact_path is None:
+        raise FileNotFoundError(path)
+
+    raw_file = open(artifact_path, "rb")
+    stream = gzip.GzipFile(fileobj=raw_file, mode="rb") if is_compressed(artifact_path) else raw_file
+    return (raw_file, io.TextIOWrapper(stream, encoding="utf-8"))
+
+
+@contextmanager
+def write_artifact(path: str):
+    """
+    Opens an artifact for writing compressed text. The artifact is written to a temporary file & renamed into place,
+    replacing any uncompressed copy.
+    """
+    temporary_path = f"{path}{COMPRESSED_SUFFIX}.{uuid.uuid4().hex}.tmp"
+    try:
+        with gzip.open(temporary_path, "wt", encoding="utf-8", compresslevel=COMPRESSION_LEVEL) as file:
+            yield file
+        os.replace(temporary_path, f"{path}{COMPRESSED_SUFFIX}")
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def decompress(data: bytes) -> bytes:
+    """
+    Decompresses gzip data made of one or more members. A member cut short (e.g. a log still being written, or one
+    left open by a crash) is decompressed as far as it goes instead of raising, and the members after it are still
+    read: the next member is found by its header.
+    """
+    decompressed = []
+    view = memoryview(data)
+    start = 0
+    while start < len(data):
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        try:
+            member = decompressor.decompress(view[start:])
+        except zlib.error:
+            member = None
+
+        if member is not None and decompressor.eof:
+            decompressed.append(member)
+            start = len(data) - len(decompressor.unused_data)
+            continue
+
+        next_start = data.find(GZIP_MAGIC, start + 1)
+        if next_start < 0:
+            if member is not None:
+                decompressed.append(member)
+            break
+
+        # Only decompress up to the next member, so the cut short one doesn't run into its header.
+        try:
+            decompressed.append(zlib.decompressobj(zlib.MAX_WBITS | 16).decompress(view[start:next_start]))
+        except zlib.error:
+            # Not a member, or a member header found inside compressed data by chance.
+            pass
+        start = next_start
+
+    return b"".join(decompressed)
+
+
+def has_unended_member(data: bytes) -> bool:
+    """
+    Returns whether any gzip member in data is cut short, without the end of its stream & trailer.
+    """
+    while len(data) > 0:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        try:
+            decompressor.decompress(data)
+        except zlib.error:
+            return True
+        if not decompressor.eof:
+            return True
+        data = decompressor.unused_data
+
+    return False
+
+
+def read_artifact_text(path: str) -> str:
+    artifact_path = get_artifact_path(path)
+    if artifact_path is None:
+        raise FileNotFoundError(path)
+
+    with open(artifact_path, "rb") as file:
+        data = file.read()
+
+    if is_compressed(artifact_path):
+        data = decompress(data)
+    return data.decode("utf-8", errors="replace")
+
+
+def read_stored_bytes(path: str) -> bytes | None:
+    """
+    Returns the compressed bytes of an artifact as stored, to send as a gzip encoded response. None if the artifact
+    isn't stored compressed.
+    """
+    artifact_path = get_artifact_path(path)
+    if artifact_path is None or not is_compressed(artifact_path):
+        return None
+
+    with open(artifact_path, "rb") as file:
+        return file.read()
+
+
+class BlockCompressedWriter:
+    """
+    Writes a single gzip stream where each block of data is ended with a full flush. Every block starts on a byte
+    boundary with an empty compression dictionary, so a range of blocks can be decompressed on its own with
+    decompress_blocks, while the whole file is still an ordinary gzip file.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.crc = 0
+        self.uncompressed_size = 0
+        # gzip header: magic, deflate, no flags, mtime, no extra flags, unknown OS.
+        self.file.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time())) + b"\x00\xff")
+
+    def write_block(self, data: bytes) -> tuple[int, int]:
+        """
+        Compresses data as one block. Returns the (offset, length) of the compressed block in the file.
+        """
+        block_offset = self.file.tell()
+        self.crc = zlib.crc32(data, self.crc)
+        self.uncompressed_size += len(data)
+        self.file.write(self.compressor.compress(data) + self.compressor.flush(zlib.Z_FULL_FLUSH))
+        return (block_offset, self.file.tell() - block_offset)
+
+    def close(self, data: bytes = b""):
+        """
+        Compresses the remaining data & ends the gzip stream.
+        """
+        self.crc = zlib.crc32(data, self.crc)
+        self.uncompressed_size += len(data)
+        self.file.write(self.compressor.compress(data) + self.compressor.flush(zlib.Z_FINISH))
+        self.file.write(struct.pack("<II", self.crc & 0xFFFFFFFF, self.uncompressed_size & 0xFFFFFFFF))
+
+
+def decompress_blocks(data: bytes) -> bytes:
+    """
+    Decompresses consecutive blocks written by BlockCompressedWriter.write_block.
+    """
+    return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+
+
+class CompressedFileHandler(logging.FileHandler):
+    """
+    logging.FileHandler that appends to a gzip compressed file. Every time the file is opened a new gzip member is
+    started, read_artifact_text reads all of them. A member only ends when the handler is closed, flush() leaves it
+    open, so close the handler before the file is copied anywhere.
+    """
+
+    def __init__(self, filename: str, encoding: str = "utf-8"):
+        super().__init__(f"{filename}{COMPRESSED_SUFFIX}", mode="a", encoding=encoding)
+
+    def _open(self):
+        self.end_members()
+        return gzip.open(self.baseFilename, "at", encoding=self.encoding, compresslevel=COMPRESSION_LEVEL)
+
+    def end_members(self):
+        """
+        Rewrites the file as a single member if one of its members was never ended, e.g. the process died while it
+        was open. A member appended after one without an end couldn't be told apart from it.
+        """
+        try:
+            with open(self.baseFilename, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return
+
+        if not has_unended_member(data):
+            return
+
+        temporary_path = f"{self.baseFilename}.{uuid.uuid4().hex}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(gzip.compress(decompress(data), COMPRESSION_LEVEL))
+        os.replace(temporary_path, self.baseFilename)
@@ -2,7 +2,8 @@ import json
 from quart import Quart
 import sys
 import os
-import aiohttp
+import hashlib
+import time
 import asyncio
 import openai
 import logging
@@ -12,7 +13,18 @@ from pptx import Presentation
 import pypdf
 
 from .. import file_utils
-
+from .. import text_store
+from .. import artifact_io
+from .. import page_index
+from .. import chunk_cache
+from .. import processed_results
+from .. import document_logging
+from .. import usage_metering
+from ..blob_store import get_blob_store
+from ..search_index import get_search_index
+from ..async_io import run_io, KeyedLock
+
+from .unstructured_pool import UnstructuredPool, get_unstructured_pool
 from .async_task import (
     set_task_status,
     set_task_progress,
@@ -20,24 +32,76 @@ from .async_task import (
 )
 
 import re
-from filelock import FileLock
 
 GPT_MODEL = "gpt-3.5-turbo-1106"
-running_unstructured_processes = 0
+
+# Held while a document is extracted or converted, so concurrent requests for the same work wait for the first one
+# & reuse its result.
+conversion_locks = KeyedLock()
+
+
+def get_pdf_object_digest(pdf_object, digests: dict) -> bytes:
+    """
+    Returns a digest of a pdf object & everything it references. Objects referenced by several pages (e.g. fonts) are
+    only hashed once per document, digests holds them by object reference.
+    """
+    reference = None
+    if isinstance(pdf_object, pypdf.generic.IndirectObject):
+        reference = (pdf_object.idnum, pdf_object.generation)
+        if reference in digests:
+            # None while the object is being hashed, i.e. it references itself.
+            return digests[reference] or b"cycle"
+        digests[reference] = None
+        pdf_object = pdf_object.get_object()
+
+    hasher = hashlib.sha256(type(pdf_object).__name__.encode())
+    if isinstance(pdf_object, dict):
+        for key in sorted(pdf_object):
+            # The parent is the page tree, not part of what a resource draws.
+            if key != "/Parent":
+                hasher.update(str(key).encode())
+                hasher.update(get_pdf_object_digest(pdf_object.raw_get(key), digests))
+        if isinstance(pdf_object, pypdf.generic.StreamObject):
+            hasher.update(pdf_object.get_data())
+    elif isinstance(pdf_object, list):
+        for item in pdf_object:
+            hasher.update(get_pdf_object_digest(item, digests))
+    else:
+        hasher.update(repr(pdf_object).encode())
+
+    digest = hasher.digest()
+    if reference is not None:
+        digests[reference] = digest
+    return digest
 
 
-def get_pdf_pages(file: FileStorage):
+def get_pdf_page_hashes(file: FileStorage) -> list[str]:
+    """
+    Returns a fingerprint of every page in the pdf, computed from the page's content stream & the resources (fonts,
+    images, forms) it draws with. The same content stream can draw different text under other resources.
+    """
     pdf_reader = pypdf.PdfReader(file)
-    return len(pdf_reader.pages)
+    digests = {}
+    page_hashes = []
+    for page in pdf_reader.pages:
+        contents = page.get_contents()
+        hasher = hashlib.sha256(contents.get_data() if contents else b"")
+        hasher.update(get_pdf_object_digest(page.get("/Resources"), digests))
+        page_hashes.append(hasher.hexdigest())
+
+    return page_hashes
 
 
-def get_pptx_pages(file: FileStorage) -> int:
+def get_pptx_page_hashes(file: FileStorage) -> list[str]:
+    """
+    Returns a fingerprint of every slide in the pptx, computed from the slide's XML.
+    """
     try:
         pptx_file = Presentation(file)
-        return len(pptx_file.slides)
+        return [hashlib.sha256(slide.part.blob).hexdigest() for slide in pptx_file.slides]
     except Exception as e:
         print(f"Error: {e}")
-        return 0
+        return []
 
 
 async def async_document2json(
@@ -47,11 +111,13 @@ async def async_document2json(
     extension_type: str,
     task_id: str,
     ip_address: str,
+    email: str | None = None,
 ):
-    global running_unstructured_processes
-
+    """
+    Extracts the document's elements into its JSON & text store. The pages are counted as processed by the logged in
+    user (email), unless the document was extracted already.
+    """
     logger: logging.Logger = get_logger_for_file(server, md5_name)
-    process_limit = server.config["CONCURRENT_TEXT_PROCESS_LIMIT"]
     try:
         # Check if the variables are received correctly
         logger.info("Function: async_document2json")
@@ -60,64 +126,63 @@ async def async_document2json(
         logger.debug(f"Received filename: {filename}")
         logger.debug(f"Received md5_name: {md5_name}")
 
-        document_file_path = f'{server.config["UPLOAD_FOLDER"]}/{md5_name}.{extension_type}'
-        json_file_path = f'{server.config["JSON_FOLDER"]}/{md5_name}.json'
-
-        # Check if the pptx file exists, if not return and set the task status to 'error':
-        if not os.path.isfile(document_file_path):
-            logger.debug(f"Error: file does not exist: {document_file_path}")
-            set_task_status(task_id, "error")
-            set_task_attribute(
-                task_id,
-                "error_msg",
-                "Error: Unable to find uploaded file. Try uploading the file again.",
-            )
-            set_task_attribute(task_id, "error_type", "no_file")
-            return
-
-        # Check if file already exists, if so, set the task status as completed:
-        if os.path.isfile(json_file_path):
-            logger.debug(f"JSON already exists for {filename}, returning...")
+        async with conversion_locks.lock(md5_name):
+            store = get_blob_store(server)
+            document_file_path = await run_io(store.fetch, "upload", f"{md5_name}.{extension_type}")
+
+            # Check if the pptx file exists, if not return and set the task status to 'error':
+            if not os.path.isfile(document_file_path):
+                logger.debug(f"Error: file does not exist: {document_file_path}")
+                set_task_status(task_id, "error")
+                set_task_attribute(
+                    task_id,
+                    "error_msg",
+                    "Error: Unable to find uploaded file. Try uploading the file again.",
+                )
+                set_task_attribute(task_id, "error_type", "no_file")
+                return
+
+            # Check if file already exists, if so, set the task status as completed:
+            if await run_io(store.artifact_exists, "json", f"{md5_name}.json"):
+                logger.debug(f"JSON already exists for {filename}, returning...")
+                set_task_status(task_id, "completed")
+                return
+
+            metadata = await run_io(file_utils.get_all_file_metadata, server, md5_name) or {}
+            page_hashes = metadata.get("page_hashes") or []
+            page_count = len(page_hashes) or max(metadata.get("page_count") or 0, 0)
+            progress = ExtractionProgress(task_id, page_count, get_unstructured_pool(server))
+
+            # Pages we already extracted as part of a previous revision of this document don't need to be extracted
+            # again. Only pdfs can be split, other documents are only reused if every page is unchanged.
+            prior_pages = await run_io(page_index.find_prior_pages, server, md5_name, page_hashes)
+            if extension_type != "pdf" and len(prior_pages) < len(page_hashes):
+                prior_pages = {}
+
+            if len(prior_pages) > 0:
+                logger.info(f"Reusing {len(prior_pages)} of {len(page_hashes)} pages from previous documents")
+                progress.add_pages(len(prior_pages))
+
+            if extension_type == "pdf" and len(prior_pages) > 0:
+                await async_pdf2json(server, md5_name, document_file_path, prior_pages, progress, logger)
+            elif len(prior_pages) > 0:
+                await run_io(
+                    lambda: write_document_json(server, md5_name, get_prior_page_elements(server, prior_pages, {}))
+                )
+            else:
+                # New documents are sent whole in one request, other documents than pdfs can't be split into pages.
+                response_text = await progress.track_request(
+                    get_unstructured_pool(server).post_document(document_file_path, logger, page_count), page_count
+                )
+                # TODO: Implement a keep-alive loop & cancel these post requests if terminated.
+
+                await run_io(write_document_json_text, server, md5_name, response_text)
+
+            await run_io(page_index.record_page_hashes, server, md5_name, page_hashes)
+            await run_io(build_text_store, server, md5_name)
+            if email and metadata.get("page_count"):
+                await run_io(usage_metering.get_usage_meter(server).add_pages, email, metadata["page_count"])
             set_task_status(task_id, "completed")
-            return
-
-        form_data = aiohttp.FormData()
-        form_data.add_field("files", open(document_file_path, "rb"))
-        form_data.add_field("encoding", "utf_8")
-        form_data.add_field("include_page_breaks", "true")  # FIXME: Not needed?
-        form_data.add_field("coordinates", "false")
-        form_data.add_field("strategy", "fast")
-        # form_data.add_field("hi_res_model_name", "detectron2_onnx")
-
-        headers = {"accept": "application/json"}
-
-        # Wait until process_limit goes back down
-        while running_unstructured_processes >= process_limit:
-            await asyncio.sleep(1)
-
-        running_unstructured_processes += 1
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(server.config["UNSTRUCTUED_API_URL"], headers=headers, data=form_data) as response:
-                if response.status == 200:
-                    response_text = await response.text()
-                    # TODO: Implement a keep-alive loop & cancel these post requests if terminated.
-                    # FIXME: Handle any errors thrown by unstructured api.
-
-                    # Create /pdf-json directory if it doesn't exist.
-                    if not os.path.exists(server.config["JSON_FOLDER"]):
-                        os.makedirs(server.config["JSON_FOLDER"])
-
-                    with open(f'{server.config["JSON_FOLDER"]}/{md5_name}.json', "w") as file:
-                        file.write(response_text)
-                        set_task_status(task_id, "completed")
-                        running_unstructured_processes -= 1
-                else:
-                    await asyncio.sleep(1)
-                    logger.error(response.text)
-                    print(response.text, file=sys.stderr)
-                    set_task_status(task_id, "error")
-                    running_unstructured_processes -= 1
 
     except Exception as e:
         # Handle exceptions or errors here
@@ -125,6 +190,205 @@ async def async_document2json(
         logger.error(str(e))
         logger.error(traceback.format_exc())
         set_task_status(task_id, "error")
+    finally:
+        publish_log(server, md5_name, logger)
+
+
+class ExtractionProgress:
+    """
+    Reports the pages extracted so far as the task's progress, along with an ETA from the observed pages/sec.
+    """
+
+    def __init__(self, task_id: str, pages_total: int, unstructured_pool: UnstructuredPool):
+        self.task_id = task_id
+        self.pages_total = pages_total
+        self.pages_done = 0
+        self.pages_reused = 0
+        self.unstructured_pool = unstructured_pool
+        self.start_time = time.time()
+        set_task_attribute(task_id, "pages_total", pages_total)
+        self.set_pages_done(0)
+
+    def get_eta(self, pages_done: float) -> float:
+        pages_remaining = max(self.pages_total - pages_done, 0)
+        pages_extracted = pages_done - self.pages_reused
+        elapsed = time.time() - self.start_time
+
+        # Use the speed we've seen for this document, otherwise what the backends usually manage.
+        if pages_extracted > 0 and elapsed > 0:
+            pages_per_second = pages_extracted / elapsed
+        else:
+            pages_per_second = self.unstructured_pool.get_pages_per_second()
+
+        return round(pages_remaining / pages_per_second, 1)
+
+    def set_pages_done(self, pages_done: float):
+        set_task_attribute(self.task_id, "pages_done", int(pages_done))
+        set_task_attribute(self.task_id, "eta_seconds", self.get_eta(pages_done))
+        if self.pages_total > 0:
+            # Completion is reported by the task status, so stay just below 1.
+            set_task_progress(self.task_id, min(pages_done / self.pages_total, 0.99))
+
+    def add_pages(self, page_count: int, reused: bool = True):
+        self.pages_done += page_count
+        if reused:
+            self.pages_reused += page_count
+        self.set_pages_done(self.pages_done)
+
+    async def track_request(self, request, page_count: int):
+        """
+        Awaits an extraction request of page_count pages, estimating the pages done from the backends' usual speed
+        until it finishes.
+        """
+        pages_done = self.pages_done
+        request_start = time.time()
+
+        async def estimate():
+            while True:
+                await asyncio.sleep(1)
+                elapsed = time.time() - request_start
+                estimated_pages = min(elapsed * self.unstructured_pool.get_pages_per_second(), page_count * 0.95)
+                self.set_pages_done(pages_done + estimated_pages)
+
+        estimate_task = asyncio.create_task(estimate())
+        try:
+            return await request
+        finally:
+            estimate_task.cancel()
+            self.add_pages(page_count, reused=False)
+
+
+async def async_pdf2json(
+    server: Quart,
+    md5_name: str,
+    document_file_path: str,
+    prior_pages: dict[int, tuple[str, int]],
+    progress: ExtractionProgress,
+    logger: logging.Logger,
+):
+    """
+    Builds the unstructured-io JSON of a pdf sharing pages with earlier documents. Elements of pages in prior_pages are
+    copied from the documents they were first extracted from. The other pages are split into smaller pdfs of
+    EXTRACTION_PAGES_PER_REQUEST pages, which are extracted concurrently across the unstructured-io backends. If one of
+    them fails, the others are cancelled.
+    """
+    pages_per_request = server.config["EXTRACTION_PAGES_PER_REQUEST"]
+    pdf_reader = await run_io(pypdf.PdfReader, document_file_path)
+    page_elements: dict[int, list] = {page_number: [] for page_number in range(1, len(pdf_reader.pages) + 1)}
+
+    changed_pages = [page_number for page_number in page_elements if page_number not in prior_pages]
+    page_batches = [
+        changed_pages[index : index + pages_per_request] for index in range(0, len(changed_pages), pages_per_request)
+    ]
+
+    # Only this node needs the partial pdfs, they're never published.
+    partial_file_paths = [
+        get_blob_store(server).get_write_path("upload", f"{md5_name}.part{batch_index}.pdf")
+        for batch_index in range(len(page_batches))
+    ]
+
+    def write_partial_pdfs():
+        # The reader loads objects lazily from one file, so all partial pdfs are written by one thread.
+        for page_numbers, partial_file_path in zip(page_batches, partial_file_paths):
+            pdf_writer = pypdf.PdfWriter()
+            for page_number in page_numbers:
+                pdf_writer.add_page(pdf_reader.pages[page_number - 1])
+            pdf_writer.write(partial_file_path)
+
+    def remove_partial_pdfs():
+        for partial_file_path in partial_file_paths:
+            if os.path.exists(partial_file_path):
+                os.remove(partial_file_path)
+
+    async def extract_pages(page_numbers: list[int], partial_file_path: str):
+        response_text = await get_unstructured_pool(server).post_document(partial_file_path, logger, len(page_numbers))
+
+        # Map the pages of the partial pdf back onto the pages of the whole document.
+        page_number = page_numbers[0]
+        for json_element in json.loads(response_text):
+            metadata = json_element.setdefault("metadata", {})
+            partial_page_number = metadata.get("page_number")
+            # Elements without a page, or with one the partial pdf doesn't have, stay on the previous element's page.
+            if isinstance(partial_page_number, int) and 1 <= partial_page_number <= len(page_numbers):
+                page_number = page_numbers[partial_page_number - 1]
+            elif partial_page_number:
+                logger.warning(f"Unstructured returned page {partial_page_number} of a {len(page_numbers)} page pdf")
+            metadata["page_number"] = page_number
+            page_elements[page_number].append(json_element)
+
+        progress.add_pages(len(page_numbers), reused=False)
+
+    try:
+        await run_io(write_partial_pdfs)
+        batch_tasks = [
+            asyncio.create_task(extract_pages(page_numbers, partial_file_path))
+            for page_numbers, partial_file_path in zip(page_batches, partial_file_paths)
+        ]
+        try:
+            await asyncio.gather(*batch_tasks)
+        except BaseException:
+            # Don't leave the other batches extracting pages nobody will use.
+            for batch_task in batch_tasks:
+                batch_task.cancel()
+            await asyncio.gather(*batch_tasks, return_exceptions=True)
+            raise
+    finally:
+        await run_io(remove_partial_pdfs)
+
+    await run_io(
+        lambda: write_document_json(server, md5_name, get_prior_page_elements(server, prior_pages, page_elements))
+    )
+
+
+def get_prior_page_elements(
+    server: Quart, prior_pages: dict[int, tuple[str, int]], page_elements: dict[int, list]
+) -> dict[int, list]:
+    """
+    Adds the elements of each page in prior_pages to page_elements, copied from the document they were extracted from.
+    """
+    # Group the reused pages by the document they come from, so each prior JSON file is only read once.
+    prior_documents: dict[str, dict[int, list[int]]] = {}
+    for page_number, (prior_md5_name, prior_page_number) in prior_pages.items():
+        prior_documents.setdefault(prior_md5_name, {}).setdefault(prior_page_number, []).append(page_number)
+
+    for prior_md5_name, prior_page_numbers in prior_documents.items():
+        reader = file_utils.JSONArrayReader(get_blob_store(server).fetch_artifact("json", f"{prior_md5_name}.json"))
+        for json_element in reader:
+            metadata = json_element.get("metadata") or {}
+            for page_number in prior_page_numbers.get(metadata.get("page_number"), []):
+                page_elements.setdefault(page_number, []).append(
+                    {**json_element, "metadata": {**metadata, "page_number": page_number}}
+                )
+
+    return page_elements
+
+
+def write_document_json(server: Quart, md5_name: str, page_elements: dict[int, list]):
+    """
+    Writes the elements of each page, in page order, as the document's unstructured-io JSON.
+    """
+    store = get_blob_store(server)
+    with artifact_io.write_artifact(store.get_write_path("json", f"{md5_name}.json")) as file:
+        file.write("[")
+        first_element = True
+        for page_number in sorted(page_elements):
+            for json_element in page_elements[page_number]:
+                if not first_element:
+                    file.write(",")
+                json.dump(json_element, file)
+                first_element = False
+        file.write("]")
+    store.publish_artifact("json", f"{md5_name}.json")
+
+
+def write_document_json_text(server: Quart, md5_name: str, response_text: str):
+    """
+    Writes an unstructured-io response as is as the document's JSON.
+    """
+    store = get_blob_store(server)
+    with artifact_io.write_artifact(store.get_write_path("json", f"{md5_name}.json")) as file:
+        file.write(response_text)
+    store.publish_artifact("json", f"{md5_name}.json")
 
 
 def merge_qa_lines(qa_sets: list[str]):
@@ -189,69 +453,102 @@ def text_has_multiple_choice(text: str) -> bool:
 
 
 def get_logger_for_file(server: Quart, md5_name: str) -> logging.Logger:
-    if not os.path.exists(server.config["LOG_FOLDER"]):
-        os.makedirs(server.config["LOG_FOLDER"])
+    return document_logging.get_document_logger(server, md5_name)
+
 
-    formatter = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
+def publish_log(server: Quart, md5_name: str, logger: logging.Logger):
+    """
+    Shares what was logged for the file so far, for /logs/ on any node.
+    """
+    document_logging.get_document_logging(server).publish(md5_name)
 
-    logger_file = logging.FileHandler(f'{server.config["LOG_FOLDER"]}/{md5_name}.txt')
-    logger_file.setLevel(logging.DEBUG)
-    logger_file.setFormatter(formatter)
 
-    logger = logging.getLogger("pdf-logs")
-    new_logger = False
-    if logger.hasHandlers():
-        logger.handlers.clear()
-    else:
-        new_logger = True
+def iter_document_text(elements):
+    """
+    Yields (page_number, text) for every unstructured-io element that has text. Everything else in the element
+    (metadata, coordinates, ids) is dropped as soon as it's read.
+    """
+    for json_element in elements:
+        text = json_element.get("text")
+
+        if not text or len(text) < 1:
+            continue
 
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(logger_file)
+        page_number = (json_element.get("metadata") or {}).get("page_number")
+        yield (page_number, text)
 
-    if new_logger:
-        logger.info("================================= BEGINNING OF LOGGING SESSION =================================")
 
-    return logger
+def build_text_store(server: Quart, md5_name: str):
+    """
+    Derives the compact text store from the unstructured-io JSON, so later conversions don't need to decode it again.
+    """
+    reader = file_utils.JSONArrayReader(get_blob_store(server).fetch_artifact("json", f"{md5_name}.json"))
+    text_store.write_text_store(server, md5_name, iter_document_text(reader))
 
 
-def json2gpt_input(server: Quart, md5_name: str):
+def open_text_store(server: Quart, md5_name: str) -> text_store.TextStore:
     """
-    Converts the unformatted unstructured-io JSON to a list of strings to input into chat-gpt. These strings are split by
-    pages, and max_input_length if the pages' text is too big.
+    Opens the text store of a document, building it first for documents extracted before text stores existed.
+    """
+    if not text_store.text_store_exists(server, md5_name):
+        build_text_store(server, md5_name)
+
+    return text_store.TextStore(server, md5_name)
+
+
+def json2gpt_input(server: Quart, md5_name: str, document_text=None):
+    """
+    Converts the document's text to strings to input into chat-gpt. These strings are split by pages, and
+    max_input_length if the pages' text is too big. Strings never span pages, so an unchanged page of a revised
+    document produces the same strings & hits the chunk cache.
+
+    document_text is an iterable of (page_number, text), by default the elements of the unstructured-io JSON which is
+    parsed incrementally. This is a generator, each string is yielded as soon as it's complete.
     """
     min_input_length = 500
     max_input_length = 1096
-    text_list = []
     logger: logging.Logger = get_logger_for_file(server, md5_name)
     logger.info("Function: json2gpt_input")
 
-    with open(f'{server.config["JSON_FOLDER"]}/{md5_name}.json', "r") as file:
-        json_data = json.load(file)
-
-        for json_element in json_data:
-            text = json_element.get("text")
-
-            if not text or len(text) < 1:
-                continue
+    if document_text is None:
+        document_text = iter_document_text(
+            file_utils.JSONArrayReader(get_blob_store(server).fetch_artifact("json", f"{md5_name}.json"))
+        )
 
-            # Merge the text if it's length is < min_input_length. (But make sure we don't exceed max_input_length either!)
-            # Merge the text if its length is < min_input_length, but don't exceed max_input_length
-            if len(text) < min_input_length:
-                if text_list and len(text_list[-1]) + len(text) <= max_input_length:
-                    # Merge with the last item in text_list if it doesn't exceed max_input_length
-                    text_list[-1] += f" {text}"
-                else:
-                    # Add as a separate item if merging would exceed max_input_length
-                    text_list.append(text)
+    # The last string we created, kept back since following small texts of the same page may still be merged onto it.
+    pending_text = None
+    pending_page = None
+
+    for page_number, text in document_text:
+        # Elements without a page number stay with the page before them.
+        if page_number and page_number != pending_page:
+            if pending_text is not None:
+                yield pending_text
+            pending_text = None
+            pending_page = page_number
+
+        # Merge the text if its length is < min_input_length, but don't exceed max_input_length
+        if len(text) < min_input_length:
+            if pending_text is not None and len(pending_text) + len(text) <= max_input_length:
+                # Merge with the last string if it doesn't exceed max_input_length
+                pending_text += f" {text}"
             else:
-                # Break the text apart into new strings until each new text segment is < max_input_length
-                if len(text) > max_input_length:
-                    while len(text) > max_input_length:
-                        text_list.append(text[:max_input_length])
-                        text = text[max_input_length:]
-                text_list.append(text)
+                # Add as a separate string if merging would exceed max_input_length
+                if pending_text is not None:
+                    yield pending_text
+                pending_text = text
+        else:
+            if pending_text is not None:
+                yield pending_text
 
-    return text_list
+            # Break the text apart into new strings until each new text segment is < max_input_length
+            while len(text) > max_input_length:
+                yield text[:max_input_length]
+                text = text[max_input_length:]
+            pending_text = text
+
+    if pending_text is not None:
+        yield pending_text
 
 
 # Get tokens from pdf elements and merge them onto a single line.
@@ -273,7 +570,7 @@ async def gpt_generate_test_questions(server, md5_name, data, conversion_options
     logger.info("Function: gpt_generate_test_questions")
 
     # print(f"*********************** Generate Test Questions from text chunk:\n{data}")
-    logger.debug(f"*********************** Generate Test Questions from text chunk:\n{data}")
+    logger.debug("*********************** Generate Test Questions from text chunk:\n%s", data)
 
     prompt_values = {
         "test_multiple_choice": "Multiple Choice (Include letter options in questions or DEATH happens!!!). Multiple Choice Strict Format Example:\nWhich of the following is not a primary color? A) Red B) Yellow C) Green D) Purple -- Answer: D) Purple",
@@ -385,7 +682,7 @@ async def gpt_generate_definitions(server, md5_name, data, conversion_options: d
     logger.info("Function: gpt_generate_definitions")
 
     # print(f"*********************** Generate Definitions from text chunk:\n{data}")
-    logger.debug(f"*********************** Generate Definitions from text chunk:\n{data}")
+    logger.debug("*********************** Generate Definitions from text chunk:\n%s", data)
 
     prompt = f"Please analyze the data and provide 'keyword: definition' pairs relevant for study. Your responses should strictly follow this format without numbering:\nKeyword: Definition\nDo NOT include the words 'Keyword' or 'Definition' in the output. The provided data is as follows:\n{data}"
 
@@ -451,7 +748,7 @@ async def gpt_generate_qa(server, md5_name, data, conversion_options: dict):
     logger.info("Function: gpt_generate_qa")
 
     # print(f"*********************** Generate Q&A from text chunk:\n{data}")
-    logger.debug(f"*********************** Generate Q&A from text chunk:\n{data}")
+    logger.debug("*********************** Generate Q&A from text chunk:\n%s", data)
 
     prompt = f"Generate brief, 'brain-friendly' Q&A flashcards from the provided data.\nYou are required to respond with: 'Q: ... [NEWLINE] A: ...'\nHere is the provided data:\n{data}"
 
@@ -549,57 +846,68 @@ async def async_json2convert_type(
     }
     logger: logging.Logger = get_logger_for_file(server, md5_name)
     logger.info(f"Function: async_json2convert_type ({convert_type})")
+    try:
+        async with conversion_locks.lock(f"{md5_name}/{convert_type}"):
+            # Check if the convert_type for this file was already generated, if so, set the task status as completed
+            if await run_io(processed_results.has_processed_result, server, md5_name, convert_type):
+                logger.debug(f"{convert_type} already exists for {filename}, returning...")
+                # It might have been generated on another node, with its own search index.
+                try:
+                    await run_io(get_search_index(server).index_results, server, {md5_name: [convert_type]})
+                except Exception as e:
+                    logger.error(f"Indexing {convert_type} for search failed: {e}")
+                set_task_status(task_id, "completed")
+                return
+
+            generated_sets = []
+            # Stream the text chunks out of the text store, each chunk is sent to GPT as soon as it's sliced out.
+            with await run_io(open_text_store, server, md5_name) as document_text:
+                for text_chunk in json2gpt_input(server, md5_name, document_text):
+                    # Chunks made of pages we already converted (e.g. unchanged pages of a revised document) are
+                    # reused.
+                    chunk_key = chunk_cache.get_chunk_key(GPT_MODEL, convert_type, conversion_options, text_chunk)
+                    set = await run_io(chunk_cache.get_cached_chunk, server, chunk_key)
+                    if set is None:
+                        set = await gpt_generate_functions[convert_type](
+                            server, md5_name, text_chunk, conversion_options
+                        )
+                        await run_io(chunk_cache.cache_chunk, server, chunk_key, set or [])
+                    if set is None:
+                        continue
+                    generated_sets = generated_sets + set
+                    set_task_progress(task_id, document_text.progress)
+
+            await run_io(
+                processed_results.write_processed_result,
+                server,
+                md5_name,
+                convert_type,
+                {"data": generated_sets},
+            )
 
-    # Create directory if it doesn't exist.
-    os.makedirs(server.config["PROCESSED_FOLDER"], exist_ok=True)
-    processed_file = f'{server.config["PROCESSED_FOLDER"]}/{md5_name}.json'
-
-    with FileLock(f"{processed_file}.lock"):
-        # Check if file already exists and q&a for it was generated, if so, set the task status as completed
-        if os.path.isfile(processed_file):
-            with open(processed_file, "r") as file:
-                if convert_type in json.load(file):
-                    logger.debug(f"{convert_type} already exists for {filename}, returning...")
-                    set_task_status(task_id, "completed")
-                    return
-
-    text_list = json2gpt_input(server, md5_name)
-
-    logger.debug("JSON text (converted from JSON): ")
-    logger.debug(text_list)
-
-    generated_sets = []
-    for index, text_chunk in enumerate(text_list):
-        set = await gpt_generate_functions[convert_type](server, md5_name, text_chunk, conversion_options)
-        if set is None:
-            continue
-        generated_sets = generated_sets + set
-        set_task_progress(task_id, float(index + 1) / float(len(text_list)))
-
-    append_json_value_to_file(
-        processed_file,
-        convert_type,
-        {"data": generated_sets},
-    )
-
-    # Update the file's metadata & specify our generated data_length
-    metadata_file_path = os.path.join(server.config["METADATA_FOLDER"], f"{md5_name}.json")
-    file_utils.append_file_json_value(metadata_file_path, "data_lengths", {convert_type: len(generated_sets)})
-
-    set_task_status(task_id, "completed")
-    logger.debug(f"{convert_type} Generation Successful.")
-
-
-def append_json_value_to_file(filename: str, key: str, value: object):
-    processed_json = {}
-
-    with FileLock(f"{filename}.lock"):
-        if os.path.isfile(filename):
-            with open(filename, "r") as file:
-                processed_json = json.load(file)
+            # Update the file's metadata & specify our generated data_length
+            await file_utils.get_async_database(server).set_file_data_length(
+                md5_name, convert_type, len(generated_sets)
+            )
 
-        processed_json[key] = value
+            try:
+                await run_io(get_search_index(server).index_result, md5_name, convert_type, generated_sets)
+            except Exception as e:
+                # The result is saved either way, it's only missing from search.
+                logger.error(f"Indexing {convert_type} for search failed: {e}")
 
-        # Save Q&A set to filesystem
-        with open(filename, "w") as file:
-            json.dump(processed_json, file)
+            set_task_status(task_id, "completed")
+        logger.debug(f"{convert_type} Generation Successful.")
+    except FileNotFoundError as e:
+        # The document's files are gone, e.g. deleted by retention.
+        logger.error(str(e))
+        set_task_status(task_id, "error")
+        set_task_attribute(task_id, "error_msg", "Error: Unable to find uploaded file. Try uploading the file again.")
+        set_task_attribute(task_id, "error_type", "no_file")
+    except Exception as e:
+        print("Error:", str(e), file=sys.stderr)
+        logger.error(str(e))
+        logger.error(traceback.format_exc())
+        set_task_status(task_id, "error")
+    finally:
+        publish_log(server, md5_name, logger)
@@ -1,4 +1,4 @@
-import os, sys, inspect
+import sys, inspect
 from quart import Quart
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
@@ -6,7 +6,8 @@ from reportlab.rl_config import defaultPageSize
 from reportlab.lib.units import inch
 from reportlab.pdfgen.canvas import Canvas
 from .async_task import set_task_status
-import json
+from .. import processed_results
+from ..blob_store import get_blob_store
 
 PAGE_HEIGHT = defaultPageSize[1]
 PAGE_WIDTH = defaultPageSize[0]
@@ -112,7 +113,7 @@ def export_flashcard_as_pdf(server: Quart, file_id: str, md5_name: str, flashcar
     """
     Generates a pdf file of all Q&A sets from the provided files.
     """
-    canvas = Canvas(f"./data/exports/{file_id}.pdf")
+    canvas = Canvas(get_blob_store(server).get_write_path("export", f"{file_id}.pdf"))
     styleSheet = getSampleStyleSheet()
     style = styleSheet["BodyText"]
 
@@ -155,6 +156,7 @@ def export_flashcard_as_pdf(server: Quart, file_id: str, md5_name: str, flashcar
         i += 1
 
     canvas.save()
+    get_blob_store(server).publish("export", f"{file_id}.pdf")
     return True
 
 
@@ -172,10 +174,6 @@ def export_flashcard(server: Quart, task_id, file_id, md5_name, export_type, fla
 
     # FIXME: Check if export_type doesn't exist, and return false if so
 
-    # Create the export folder if needed
-    if not os.path.exists(server.config["EXPORT_FOLDER"]):
-        os.makedirs(server.config["EXPORT_FOLDER"])
-
     function_dict = {"anki": export_flashcard_as_anki, "pdf": export_flashcard_as_pdf}
 
     if function_dict[export_type](server, file_id, md5_name, flashcard_sets):
@@ -188,12 +186,8 @@ def get_flashcard_sets(server: Quart, md5_name: str, flashcard_sets: list[int])
     """
     Loads the Q&A sets from a file and returns it as a variable.
     """
-    qa_sets = []
-    with open(f'{server.config["PROCESSED_FOLDER"]}/{md5_name}.json', "r") as file:
-        flashcard_sets_json = json.load(file)["flashcards"]["data"]
-        qa_sets = [
-            flashcard_set_json
-            for index, flashcard_set_json in enumerate(flashcard_sets_json)
-            if index in flashcard_sets
-        ]
+    flashcard_sets_json = processed_results.get_processed_result(server, md5_name, "flashcards")["data"]
+    qa_sets = [
+        flashcard_set_json for index, flashcard_set_json in enumerate(flashcard_sets_json) if index in flashcard_sets
+    ]
     return qa_sets
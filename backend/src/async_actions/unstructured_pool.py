@@ -0,0 +1,216 @@
+import sys
+import time
+import asyncio
+import logging
+import aiohttp
+from urllib.parse import urlsplit, urlunsplit
+from quart import Quart
+
+MAX_ATTEMPTS = 3  # How many backends we try a document on before giving up.
+EJECT_SECONDS = 30  # Minimum time an ejected backend is left alone before health checks can bring it back.
+HEALTH_CHECK_INTERVAL = 10
+MEMORY_REJECTION_MESSAGE = "Rejecting because free memory"
+SPEED_SMOOTHING = 0.3  # Weight of the newest request in each backend's pages/sec average.
+DEFAULT_PAGES_PER_SECOND = 1.0  # Assumed speed until we've seen a backend extract anything.
+
+
+class UnstructuredAPIError(Exception):
+    pass
+
+
+class UnstructuredBackend:
+    def __init__(self, url: str):
+        self.url = url
+        # unstructured-api serves its health check from the root of the host.
+        split_url = urlsplit(url)
+        self.health_url = urlunsplit((split_url.scheme, split_url.netloc, "/healthcheck", "", ""))
+        self.outstanding = 0
+        self.healthy = True
+        self.ejected_until = 0.0
+        self.pages_per_second = None  # Moving average of observed extraction speed.
+
+    def record_speed(self, page_count: int, elapsed_seconds: float):
+        pages_per_second = page_count / max(elapsed_seconds, 0.001)
+        if self.pages_per_second is None:
+            self.pages_per_second = pages_per_second
+        else:
+            self.pages_per_second += SPEED_SMOOTHING * (pages_per_second - self.pages_per_second)
+
+    def is_available(self, now: float) -> bool:
+        return self.healthy and now >= self.ejected_until
+
+
+class UnstructuredPool:
+    """
+    Routes documents across multiple unstructured-api backends by least outstanding requests.
+
+    Backends that reject a request (503, out of memory) or can't be reached are ejected, and only brought back by the
+    health checker once they respond to /healthcheck again.
+    """
+
+    def __init__(self, urls: list[str], max_outstanding: int):
+        self.backends = [UnstructuredBackend(url) for url in urls]
+        self.max_outstanding = max_outstanding
+        self.health_checker: asyncio.Task | None = None
+
+    def get_backend(self, exclude: list[UnstructuredBackend]) -> UnstructuredBackend | None:
+        """
+        Returns the available backend with the least outstanding requests, or None if every backend is busy.
+        Backends in exclude are only used if there is no other choice.
+        """
+        now = time.time()
+        candidates = [
+            backend
+            for backend in self.backends
+            if backend.is_available(now) and backend.outstanding < self.max_outstanding
+        ]
+        preferred = [backend for backend in candidates if backend not in exclude]
+
+        if len(preferred) > 0:
+            candidates = preferred
+        if len(candidates) <= 0:
+            return None
+
+        return min(candidates, key=lambda backend: backend.outstanding)
+
+    async def acquire(self, exclude: list[UnstructuredBackend]) -> UnstructuredBackend:
+        self.ensure_health_checker()
+
+        # Wait until one of the backends has room for another document.
+        backend = self.get_backend(exclude)
+        while backend is None:
+            await asyncio.sleep(1)
+            # Ejected backends only come back through the health checker.
+            self.ensure_health_checker()
+            backend = self.get_backend(exclude)
+
+        backend.outstanding += 1
+        return backend
+
+    def release(self, backend: UnstructuredBackend):
+        backend.outstanding -= 1
+
+    def eject(self, backend: UnstructuredBackend, reason: str):
+        print(f"Ejecting unstructured backend {backend.url}: {reason}", file=sys.stderr)
+        backend.healthy = False
+        backend.ejected_until = time.time() + EJECT_SECONDS
+
+    def get_pages_per_second(self) -> float:
+        """
+        Returns the average extraction speed of a single request, across backends we have measured.
+        """
+        speeds = [backend.pages_per_second for backend in self.backends if backend.pages_per_second is not None]
+        if len(speeds) <= 0:
+            return DEFAULT_PAGES_PER_SECOND
+        return sum(speeds) / len(speeds)
+
+    def ensure_health_checker(self):
+        """
+        Starts the health checker, or restarts it if it stopped.
+        """
+        if self.health_checker is not None and not self.health_checker.done():
+            return
+
+        if self.health_checker is not None and not self.health_checker.cancelled():
+            print(f"Unstructured health checker stopped: {self.health_checker.exception()}", file=sys.stderr)
+
+        # The loop only keeps weak references to tasks, keep ours so it isn't garbage collected.
+        self.health_checker = asyncio.create_task(self.run_health_checker())
+
+    async def run_health_checker(self):
+        while True:
+            try:
+                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+                    for backend in self.backends:
+                        await self.check_backend(session, backend)
+            except Exception as e:
+                print(f"Unstructured health check failed: {e}", file=sys.stderr)
+
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+    async def check_backend(self, session: aiohttp.ClientSession, backend: UnstructuredBackend):
+        # Leave freshly ejected backends alone, they are usually still freeing memory.
+        if time.time() < backend.ejected_until:
+            return
+
+        try:
+            async with session.get(backend.health_url) as response:
+                healthy = response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            healthy = False
+        except Exception as e:
+            print(f"Health check of unstructured backend {backend.url} failed: {e}", file=sys.stderr)
+            healthy = False
+
+        if healthy and not backend.healthy:
+            print(f"Unstructured backend {backend.url} is healthy again.", file=sys.stderr)
+        elif not healthy and backend.healthy:
+            self.eject(backend, "failed health check")
+
+        backend.healthy = healthy
+
+    async def post_document(self, document_file_path: str, logger: logging.Logger, page_count: int = 0) -> str:
+        """
+        Sends the document to the least loaded backend & returns the response text. Rejected or unreachable requests
+        are retried on another backend, up to MAX_ATTEMPTS.
+
+        page_count is used to measure the backend's pages/sec.
+        """
+        tried_backends = []
+        last_error = None
+
+        for _ in range(MAX_ATTEMPTS):
+            backend = await self.acquire(tried_backends)
+            tried_backends.append(backend)
+            request_start = time.time()
+            try:
+                with open(document_file_path, "rb") as document_file:
+                    form_data = aiohttp.FormData()
+                    form_data.add_field("files", document_file)
+                    form_data.add_field("encoding", "utf_8")
+                    form_data.add_field("include_page_breaks", "true")  # FIXME: Not needed?
+                    form_data.add_field("coordinates", "false")
+                    form_data.add_field("strategy", "fast")
+                    # form_data.add_field("hi_res_model_name", "detectron2_onnx")
+
+                    headers = {"accept": "application/json"}
+
+                    async with aiohttp.ClientSession() as session:
+                        async with session.post(backend.url, headers=headers, data=form_data) as response:
+                            response_text = await response.text()
+
+                if response.status == 200:
+                    if page_count > 0:
+                        backend.record_speed(page_count, time.time() - request_start)
+                    return response_text
+
+                logger.error(f"Unstructured backend {backend.url} returned {response.status}: {response_text}")
+                last_error = UnstructuredAPIError(f"Unstructured API returned {response.status}")
+
+                if response.status != 503 and MEMORY_REJECTION_MESSAGE not in response_text:
+                    # The backend is fine, the document itself was rejected. Another backend won't do better.
+                    raise last_error
+
+                self.eject(backend, f"rejected request with {response.status}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"Unstructured backend {backend.url} failed: {e}")
+                last_error = UnstructuredAPIError(str(e))
+                self.eject(backend, str(e))
+            finally:
+                self.release(backend)
+
+        raise last_error
+
+
+unstructured_pool: UnstructuredPool | None = None
+
+
+def get_unstructured_pool(server: Quart) -> UnstructuredPool:
+    global unstructured_pool
+
+    if unstructured_pool is None:
+        unstructured_pool = UnstructuredPool(
+            server.config["UNSTRUCTUED_API_URLS"], server.config["CONCURRENT_TEXT_PROCESS_LIMIT"]
+        )
+
+    return unstructured_pool
@@ -0,0 +1,112 @@
+import sys
+import time
+import asyncio
+import functools
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from quart import Quart
+
+IO_THREADS = 8  # Threads running blocking file, blob store & DB calls for async code.
+STALL_CHECK_INTERVAL = 0.1  # Seconds between event loop stall checks.
+STALL_LOG_THRESHOLD = 0.25  # Stalls longer than this are logged.
+
+io_executor = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="io")
+
+
+async def run_io(function, *args, **kwargs):
+    """
+    Runs a blocking call in the I/O threads, so the event loop keeps serving other requests meanwhile.
+
+    Quart runs sync routes in its own threads already, this is for async routes & background tasks.
+    """
+    # Run in a copy of the caller's context, so context variables (e.g. the document being logged for) carry over.
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        io_executor, functools.partial(context.run, function, *args, **kwargs)
+    )
+
+
+class KeyedLock:
+    """
+    asyncio locks by key, e.g. one per (file, conversion type). Waiting for a lock suspends the task instead of
+    blocking the event loop. Locks are dropped once nobody holds or waits for them.
+    """
+
+    def __init__(self):
+        self.locks: dict[str, tuple[asyncio.Lock, int]] = {}
+
+    @asynccontextmanager
+    async def lock(self, key: str):
+        lock, users = self.locks.get(key, (asyncio.Lock(), 0))
+        self.locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self.locks[key]
+            if users <= 1:
+                del self.locks[key]
+            else:
+                self.locks[key] = (lock, users - 1)
+
+
+class LoopStallMonitor:
+    """
+    Measures how long the event loop is blocked. Every STALL_CHECK_INTERVAL seconds it checks how late it was woken
+    up, any delay is time the loop spent stuck in blocking code instead of serving requests.
+    """
+
+    def __init__(self):
+        self.checks = 0
+        self.stalls = 0
+        self.total_stall_seconds = 0.0
+        self.max_stall_seconds = 0.0
+        self.started = None
+        self.lock = threading.Lock()
+
+    def record(self, stall_seconds: float):
+        with self.lock:
+            self.checks += 1
+            if stall_seconds <= 0:
+                return
+
+            self.stalls += 1
+            self.total_stall_seconds += stall_seconds
+            self.max_stall_seconds = max(self.max_stall_seconds, stall_seconds)
+
+        if stall_seconds >= STALL_LOG_THRESHOLD:
+            print(f"Event loop stalled for {stall_seconds:.3f}s", file=sys.stderr)
+
+    async def run(self):
+        self.started = time.monotonic()
+        while True:
+            expected = time.monotonic() + STALL_CHECK_INTERVAL
+            await asyncio.sleep(STALL_CHECK_INTERVAL)
+            # Wake ups are a little late even on an idle loop, only count real delays.
+            stall_seconds = time.monotonic() - expected
+            self.record(stall_seconds if stall_seconds > 0.005 else 0.0)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            uptime = time.monotonic() - self.started if self.started is not None else 0.0
+            return {
+                "checks": self.checks,
+                "stalls": self.stalls,
+                "total_stall_seconds": self.total_stall_seconds,
+                "max_stall_seconds": self.max_stall_seconds,
+                "stall_ratio": self.total_stall_seconds / uptime if uptime > 0 else 0.0,
+            }
+
+
+loop_stall_monitor: LoopStallMonitor | None = None
+
+
+def get_loop_stall_monitor(server: Quart) -> LoopStallMonitor:
+    global loop_stall_monitor
+
+    if loop_stall_monitor is None:
+        loop_stall_monitor = LoopStallMonitor()
+
+    return loop_stall_monitor
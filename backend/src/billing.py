@@ -0,0 +1,147 @@
+import sys
+import time
+import asyncio
+import threading
+import stripe
+from quart import Quart
+from . import file_utils
+from .async_io import run_io
+
+# Stripe events that change a customer's next charge date or upcoming invoice.
+BILLING_EVENT_TYPES = (
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+    "invoice.created",
+    "invoice.updated",
+    "invoice.finalized",
+    "invoice.paid",
+    "invoice.payment_failed",
+    "invoice.upcoming",
+)
+
+
+class BillingSummaries:
+    """
+    Each customer's next charge date & upcoming invoice amount, kept in the billing_summaries table so pages render
+    without calling stripe. A summary is read from stripe the first time it's needed, then refreshed when stripe sends
+    a webhook event for the customer, when usage is reported, and by the reconciler once it's older than the TTL. The
+    reconciler leaves the summaries of customers who haven't viewed theirs in BILLING_ACTIVE_SECONDS to the events.
+    """
+
+    def __init__(self, server: Quart):
+        self.server = server
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failed_refreshes = 0
+        self.webhook_events = 0
+        self.last_reconcile = None
+        self.lock = threading.Lock()
+
+    def refresh(self, stripe_user_id: str) -> dict:
+        """
+        Reads the customer's billing from stripe & saves it.
+        """
+        with self.lock:
+            self.refreshes += 1
+
+        with file_utils.get_database(self.server) as database:
+            subscription_id = database.get_user_subscription_id(stripe_user_id)
+
+        current_period_end = None
+        amount_due = None
+        if subscription_id:
+            subscription = stripe.Subscription.retrieve(subscription_id)
+            if subscription.status != "canceled":
+                current_period_end = subscription.current_period_end
+                amount_due = stripe.Invoice.upcoming(subscription=subscription_id).amount_due
+
+        with file_utils.get_database(self.server) as database:
+            database.set_billing_summary(stripe_user_id, subscription_id, current_period_end, amount_due)
+
+        return {"subscription_id": subscription_id, "current_period_end": current_period_end, "amount_due": amount_due}
+
+    async def get(self, stripe_user_id: str, refresh: bool = False) -> dict:
+        """
+        Returns the customer's billing summary, from stripe if refresh is set or it was never read before.
+        """
+        if not refresh:
+            summary = await file_utils.get_async_database(self.server).get_billing_summary(stripe_user_id)
+            with self.lock:
+                if summary is not None:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if summary is not None:
+                await file_utils.get_async_database(self.server).touch_billing_summary(stripe_user_id)
+                return summary
+
+        return await run_io(self.refresh, stripe_user_id)
+
+    async def handle_event(self, event: dict):
+        if event["type"] not in BILLING_EVENT_TYPES:
+            return
+
+        stripe_user_id = event["data"]["object"].get("customer")
+        if not stripe_user_id:
+            return
+
+        with self.lock:
+            self.webhook_events += 1
+        await run_io(self.refresh, stripe_user_id)
+
+    def reconcile(self):
+        """
+        Refreshes the summaries marked stale, then those older than BILLING_SUMMARY_TTL that were viewed recently.
+        """
+        with file_utils.get_database(self.server) as database:
+            stripe_user_ids = database.get_stale_billing_summaries(
+                self.server.config["BILLING_SUMMARY_TTL"],
+                self.server.config["BILLING_ACTIVE_SECONDS"],
+                self.server.config["BILLING_RECONCILE_BATCH_SIZE"],
+            )
+
+        for stripe_user_id in stripe_user_ids:
+            try:
+                self.refresh(stripe_user_id)
+            except Exception as e:
+                with self.lock:
+                    self.failed_refreshes += 1
+                print(f"Refreshing the billing summary of {stripe_user_id} failed: {e}", file=sys.stderr)
+
+        with self.lock:
+            self.last_reconcile = time.time()
+
+    async def run(self):
+        while True:
+            try:
+                await run_io(self.reconcile)
+            except Exception as e:
+                print(f"Billing reconciliation failed: {e}", file=sys.stderr)
+            await asyncio.sleep(self.server.config["BILLING_RECONCILE_INTERVAL"])
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            reads = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / reads if reads > 0 else 0.0,
+                "refreshes": self.refreshes,
+                "failed_refreshes": self.failed_refreshes,
+                "webhook_events": self.webhook_events,
+                "last_reconcile": self.last_reconcile,
+            }
+
+
+billing_summaries: BillingSummaries | None = None
+
+
+def get_billing_summaries(server: Quart) -> BillingSummaries:
+    global billing_summaries
+
+    if billing_summaries is None:
+        billing_summaries = BillingSummaries(server)
+
+    return billing_summaries
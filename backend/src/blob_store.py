@@ -0,0 +1,347 @@
+import os
+import sys
+import uuid
+import shutil
+import threading
+from quart import Quart
+from .artifact_io import COMPRESSED_SUFFIX
+
+# Kinds of blobs & the data folder each is kept in locally.
+BLOB_KINDS = {
+    "upload": "UPLOAD_FOLDER",
+    "json": "JSON_FOLDER",
+    "text": "TEXT_FOLDER",
+    "processed": "PROCESSED_FOLDER",
+    "log": "LOG_FOLDER",
+    "export": "EXPORT_FOLDER",
+    "page-index": "PAGE_INDEX_FOLDER",
+    "chunk-cache": "CHUNK_CACHE_FOLDER",
+}
+SHARD_LENGTH = 2  # Blobs are spread over directories named after the first characters of their hash.
+# Kinds of blobs rewritten after they are published. Stores where the local folders are only a copy revalidate these.
+MUTABLE_KINDS = ("processed", "log")
+# Mutable blobs that nodes append to, instead of replacing them whole.
+APPENDED_KINDS = ("log",)
+
+
+def get_blob_hash(name: str) -> str:
+    """
+    Blob names start with the hash of the content they belong to: <md5>.pdf, <md5>.json.gz, <md5>/flashcards.json.gz
+    """
+    return name.split("/")[0].split(".")[0]
+
+
+def get_blob_shard(name: str) -> str:
+    return get_blob_hash(name)[:SHARD_LENGTH]
+
+
+class LocalBlobStore:
+    """
+    Blobs on local disk, in the data folder of their kind & sharded by hash (file-upload/ab/ab12....pdf).
+    Blobs saved before sharding are moved into their shard once, by move_legacy_blobs() at startup.
+
+    get_path() is where code reads a blob with regular file APIs, get_write_path() where it writes one. fetch() makes
+    sure the blob is there first & publish() shares it after it was written. Both are no-ops here, they matter for
+    stores where the local folders are only a copy.
+    """
+
+    def __init__(self, folders: dict[str, str]):
+        self.folders = folders
+
+    def get_path(self, kind: str, name: str) -> str:
+        return f"{self.folders[kind]}/{get_blob_shard(name)}/{name}"
+
+    def get_write_path(self, kind: str, name: str) -> str:
+        """
+        Same as get_path, creating the blob's directory.
+        """
+        path = self.get_path(kind, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def move_legacy_blobs(self):
+        """
+        Moves blobs saved before sharding from the top of their data folder into their shard.
+        """
+        for kind, folder in self.folders.items():
+            try:
+                entries = list(os.scandir(folder))
+            except FileNotFoundError:
+                continue
+
+            moved = 0
+            for entry in entries:
+                if (entry.is_dir() and len(entry.name) == SHARD_LENGTH) or entry.name.endswith(".tmp"):
+                    continue
+
+                path = self.get_write_path(kind, entry.name)
+                if not os.path.exists(path):
+                    os.replace(entry.path, path)
+                    moved += 1
+
+            if moved > 0:
+                print(f"Moved {moved} {kind} blobs into their shards", file=sys.stderr)
+
+    def fetch(self, kind: str, name: str) -> str:
+        return self.get_path(kind, name)
+
+    def publish(self, kind: str, name: str):
+        pass
+
+    def exists(self, kind: str, name: str) -> bool:
+        return os.path.exists(self.get_path(kind, name))
+
+    def has_prefix(self, kind: str, prefix: str) -> bool:
+        """
+        Returns whether any blob's name starts with prefix/, e.g. any processed result of a file.
+        """
+        # Directories emptied by retention may be left behind, only directories with blobs in them count.
+        path = self.get_path(kind, prefix)
+        return os.path.isdir(path) and len(os.listdir(path)) > 0
+
+    def read(self, kind: str, name: str) -> bytes | None:
+        try:
+            with open(self.fetch(kind, name), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, kind: str, name: str, data: bytes):
+        path = self.get_write_path(kind, name)
+        temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+        self.publish(kind, name)
+
+    def delete(self, kind: str, name: str):
+        self.evict(self.get_path(kind, name))
+
+    def evict(self, path: str):
+        """
+        Removes the local file (or directory) of a blob.
+        """
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def iter_local(self, kind: str):
+        """
+        Yields (name, path) of every top level blob (file, or directory of blobs) stored locally for the kind.
+        """
+        try:
+            entries = list(os.scandir(self.folders[kind]))
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            if entry.is_dir() and len(entry.name) == SHARD_LENGTH:
+                for shard_entry in os.scandir(entry.path):
+                    yield (shard_entry.name, shard_entry.path)
+            else:
+                yield (entry.name, entry.path)
+
+    # Artifacts written with artifact_io are stored as <name>.gz, or as <name> if written before compression.
+    # These return & take the path artifact_io expects, without the suffix.
+
+    def artifact_exists(self, kind: str, name: str) -> bool:
+        return self.exists(kind, f"{name}{COMPRESSED_SUFFIX}") or self.exists(kind, name)
+
+    def fetch_artifact(self, kind: str, name: str) -> str:
+        if not os.path.exists(self.fetch(kind, f"{name}{COMPRESSED_SUFFIX}")):
+            self.fetch(kind, name)
+        return self.get_path(kind, name)
+
+    def publish_artifact(self, kind: str, name: str):
+        self.publish(kind, f"{name}{COMPRESSED_SUFFIX}")
+
+
+class S3BlobStore(LocalBlobStore):
+    """
+    Blobs in an S3 compatible bucket (AWS, MinIO), shared by every backend node. The local data folders hold copies
+    of the blobs this node used.
+
+    Blobs are named after the upload they belong to, not their own content. Uploads, extracted documents, text stores
+    & page indexes only depend on the upload, a copy of one is never downloaded again. Exports are named by a new id
+    every time, so they are never rewritten either.
+
+    Processed results & logs (MUTABLE_KINDS) are rewritten after they are published. Their copies are revalidated on
+    every fetch by the ETag they were downloaded or published with, only a changed blob is downloaded again. Processed
+    results are replaced whole, the last node to publish wins. Logs are appended to: they are published only if the
+    bucket still has the version this node's copy started from, otherwise what this node appended is added to the
+    newer version & published again, so no node's entries are lost.
+    """
+
+    def __init__(self, folders: dict[str, str], bucket: str, endpoint_url: str | None):
+        super().__init__(folders)
+        # Only needed when blobs are stored in S3.
+        import boto3
+        import botocore.exceptions
+
+        self.client_error = botocore.exceptions.ClientError
+        # Credentials come from the usual AWS_ACCESS_KEY_ID & AWS_SECRET_ACCESS_KEY environment variables.
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.bucket = bucket
+        # {path: (ETag, size)} of the bucket's version each local copy of a mutable blob was downloaded or published
+        # as.
+        self.versions: dict[str, tuple[str, int]] = {}
+        self.versions_lock = threading.Lock()
+
+        try:
+            self.client.head_bucket(Bucket=bucket)
+        except self.client_error:
+            print(f"Creating blob store bucket {bucket}", file=sys.stderr)
+            self.client.create_bucket(Bucket=bucket)
+
+    def get_key(self, kind: str, name: str) -> str:
+        return f"{kind}/{get_blob_shard(name)}/{name}"
+
+    def get_error_code(self, error) -> str:
+        return str(error.response.get("Error", {}).get("Code"))
+
+    def is_not_found(self, error) -> bool:
+        return self.get_error_code(error) in ("404", "NoSuchKey", "NotFound")
+
+    def get_version(self, path: str) -> tuple[str, int] | None:
+        with self.versions_lock:
+            return self.versions.get(path)
+
+    def set_version(self, path: str, etag: str, size: int):
+        with self.versions_lock:
+            self.versions[path] = (etag, size)
+
+    def fetch(self, kind: str, name: str) -> str:
+        path = self.get_path(kind, name)
+        if kind in MUTABLE_KINDS:
+            self.fetch_mutable(kind, name, path)
+            return path
+
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            self.client.download_file(self.bucket, self.get_key(kind, name), temporary_path)
+            os.replace(temporary_path, path)
+        except self.client_error as e:
+            if not self.is_not_found(e):
+                raise
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+        return path
+
+    def fetch_mutable(self, kind: str, name: str, path: str):
+        """
+        Downloads the blob unless the local copy is the bucket's current version. Copies of blobs the bucket doesn't
+        have are kept.
+        """
+        version = self.get_version(path) if os.path.exists(path) else None
+        condition = {"IfNoneMatch": version[0]} if version is not None else {}
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.get_key(kind, name), **condition)
+        except self.client_error as e:
+            if self.is_not_found(e) or self.get_error_code(e) in ("304", "NotModified"):
+                return
+            raise
+
+        self.write_version(path, response["Body"].read(), response["ETag"])
+
+    def write_version(self, path: str, data: bytes, etag: str, base_size: int | None = None):
+        """
+        Replaces the local copy with a version of the blob. base_size is how much of data is the bucket's version, if
+        data has more appended to it.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temporary_path, "wb") as file:
+                file.write(data)
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        self.set_version(path, etag, len(data) if base_size is None else base_size)
+
+    def publish(self, kind: str, name: str):
+        path = self.get_path(kind, name)
+        key = self.get_key(kind, name)
+        if kind not in MUTABLE_KINDS:
+            self.client.upload_file(path, self.bucket, key)
+            return
+
+        while True:
+            with open(path, "rb") as file:
+                data = file.read()
+
+            version = self.get_version(path)
+            condition = {}
+            if kind in APPENDED_KINDS:
+                # Only replace the version our copy started from.
+                condition = {"IfMatch": version[0]} if version is not None else {"IfNoneMatch": "*"}
+
+            try:
+                response = self.client.put_object(Bucket=self.bucket, Key=key, Body=data, **condition)
+            except self.client_error as e:
+                if self.get_error_code(e) not in ("412", "PreconditionFailed", "ConditionalRequestConflict"):
+                    raise
+                # Another node published meanwhile, add what we appended to its version & try again.
+                appended_data = data[version[1] if version is not None else 0 :]
+                response = self.client.get_object(Bucket=self.bucket, Key=key)
+                latest_data = response["Body"].read()
+                self.write_version(path, latest_data + appended_data, response["ETag"], len(latest_data))
+                continue
+
+            self.set_version(path, response["ETag"], len(data))
+            return
+
+    def evict(self, path: str):
+        super().evict(path)
+        with self.versions_lock:
+            for version_path in [key for key in self.versions if key == path or key.startswith(f"{path}/")]:
+                del self.versions[version_path]
+
+    def exists(self, kind: str, name: str) -> bool:
+        if os.path.exists(self.get_path(kind, name)):
+            return True
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.get_key(kind, name))
+            return True
+        except self.client_error as e:
+            if not self.is_not_found(e):
+                raise
+            return False
+
+    def has_prefix(self, kind: str, prefix: str) -> bool:
+        if super().has_prefix(kind, prefix):
+            return True
+
+        response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=f"{self.get_key(kind, prefix)}/", MaxKeys=1)
+        return response.get("KeyCount", 0) > 0
+
+    def delete(self, kind: str, name: str):
+        super().delete(kind, name)
+        self.client.delete_object(Bucket=self.bucket, Key=self.get_key(kind, name))
+
+
+blob_store: LocalBlobStore | None = None
+
+
+def get_blob_store(server: Quart) -> LocalBlobStore:
+    global blob_store
+
+    if blob_store is None:
+        folders = {kind: server.config[config_key] for kind, config_key in BLOB_KINDS.items()}
+        if server.config["BLOB_STORE"] == "s3":
+            blob_store = S3BlobStore(folders, server.config["S3_BUCKET"], server.config["S3_ENDPOINT_URL"])
+        else:
+            blob_store = LocalBlobStore(folders)
+
+    return blob_store
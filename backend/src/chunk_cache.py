@@ -0,0 +1,26 @@
+import json
+import hashlib
+from quart import Quart
+from .blob_store import get_blob_store
+
+
+def get_chunk_key(model: str, convert_type: str, conversion_options: dict, text_chunk: str) -> str:
+    """
+    Returns the cache key of a text chunk, identical text converted the same way produces identical GPT output.
+    """
+    chunk_hash = hashlib.sha256()
+    chunk_hash.update(json.dumps([model, convert_type, conversion_options], sort_keys=True).encode("utf-8"))
+    chunk_hash.update(text_chunk.encode("utf-8"))
+    return chunk_hash.hexdigest()
+
+
+def get_cached_chunk(server: Quart, chunk_key: str) -> list | None:
+    chunk_data = get_blob_store(server).read("chunk-cache", f"{chunk_key}.json")
+    if chunk_data is None:
+        return None
+
+    return json.loads(chunk_data)
+
+
+def cache_chunk(server: Quart, chunk_key: str, generated_set: list):
+    get_blob_store(server).write("chunk-cache", f"{chunk_key}.json", json.dumps(generated_set).encode("utf-8"))
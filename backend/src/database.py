@@ -1,10 +1,13 @@
 import mysql.connector
 from mysql.connector.connection import MySQLConnection, MySQLCursor
 import sys
-import os
-import hashlib
+import json
 import stripe
 import time
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 class DBUser:
@@ -12,30 +15,183 @@ class DBUser:
         self.id = db_tuple[0]
         self.email = db_tuple[1]
         self.password = db_tuple[2]
-        self.salt = bytes(db_tuple[3])
+        self.salt = bytes(db_tuple[3]) if db_tuple[3] is not None else None
         self.card_connected = db_tuple[4]
         self.pages_processed = int(db_tuple[6])
 
 
-class DBManager:
-    def __init__(self, database="user", host="db", user="root", pass_file=None):
-        password_file = open(pass_file, "r")
-        self.connection: MySQLConnection = mysql.connector.connect(
-            user=user,
-            password=password_file.read(),
-            host=host,  # name of the mysql service as set in the docker compose file
-            database=database,
+class DBPoolTimeout(Exception):
+    pass
+
+
+class DBConnectionPool:
+    """
+    Fixed size pool of MySQL connections, shared by every DBManager. Connections are opened as needed up to size,
+    after that checkout() waits for one to be returned. Connections idle for longer than health_check_interval are
+    pinged before being handed out & replaced if the ping fails.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        timeout: float,
+        health_check_interval: float,
+        pass_file: str,
+        database="user",
+        host="db",
+        user="root",
+    ):
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.database = database
+        self.host = host
+        self.user = user
+        with open(pass_file, "r") as password_file:
+            self.password = password_file.read()
+
+        self.idle_connections: list[tuple[MySQLConnection, float]] = []  # (connection, time it was returned)
+        self.open_connections = 0
+        self.condition = threading.Condition()
+
+        self.checkouts = 0
+        self.waits = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.replaced_connections = 0
+
+    def connect(self) -> MySQLConnection:
+        return mysql.connector.connect(
+            user=self.user,
+            password=self.password,
+            host=self.host,  # name of the mysql service as set in the docker compose file
+            database=self.database,
             auth_plugin="mysql_native_password",
         )
-        password_file.close()
+
+    def checkout(self) -> MySQLConnection:
+        wait_start = time.monotonic()
+        connection = None
+        with self.condition:
+            while len(self.idle_connections) <= 0 and self.open_connections >= self.size:
+                remaining = self.timeout - (time.monotonic() - wait_start)
+                if remaining <= 0 or not self.condition.wait(remaining):
+                    if len(self.idle_connections) <= 0 and self.open_connections >= self.size:
+                        self.timeouts += 1
+                        raise DBPoolTimeout(f"No database connection available after {self.timeout}s")
+
+            if len(self.idle_connections) > 0:
+                connection, returned_at = self.idle_connections.pop()
+            else:
+                # Reserve the slot, the connection is opened outside the lock.
+                self.open_connections += 1
+
+            wait_seconds = time.monotonic() - wait_start
+            self.checkouts += 1
+            if wait_seconds > 0.001:
+                self.waits += 1
+                self.total_wait_seconds += wait_seconds
+                self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+        try:
+            if connection is None:
+                return self.connect()
+
+            if time.monotonic() - returned_at >= self.health_check_interval and not self.is_healthy(connection):
+                self.replaced_connections += 1
+                self.close_connection(connection)
+                return self.connect()
+
+            return connection
+        except Exception:
+            self.discard()
+            raise
+
+    def is_healthy(self, connection: MySQLConnection) -> bool:
+        try:
+            connection.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def checkin(self, connection: MySQLConnection):
+        try:
+            # Don't hand out a connection in the middle of someone else's transaction.
+            connection.rollback()
+        except Exception:
+            self.close_connection(connection)
+            self.discard()
+            return
+
+        with self.condition:
+            self.idle_connections.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    def discard(self):
+        """
+        Frees the slot of a connection that was closed instead of returned.
+        """
+        with self.condition:
+            self.open_connections -= 1
+            self.condition.notify()
+
+    def close_connection(self, connection: MySQLConnection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def get_stats(self) -> dict:
+        with self.condition:
+            return {
+                "size": self.size,
+                "open_connections": self.open_connections,
+                "idle_connections": len(self.idle_connections),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "total_wait_seconds": self.total_wait_seconds,
+                "max_wait_seconds": self.max_wait_seconds,
+                "timeouts": self.timeouts,
+                "replaced_connections": self.replaced_connections,
+            }
+
+
+class DBManager:
+    """
+    Checks out a connection from the pool for as long as it's used. Use it as a context manager or call close() to
+    return the connection, otherwise it's returned when the DBManager is garbage collected.
+    """
+
+    def __init__(self, pool: DBConnectionPool):
+        self.pool = pool
+        self.connection: MySQLConnection | None = None
+        self.connection = pool.checkout()
         self.cursor: MySQLCursor = self.connection.cursor(buffered=True)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def __del__(self):
-        ...
-        # self.close_connections()
+        self.close()
+
+    def close(self):
+        if self.connection is None:
+            return
 
-    def run_query(self, query: str):
-        self.cursor.execute(query)
+        try:
+            self.cursor.close()
+        except Exception:
+            pass
+        self.pool.checkin(self.connection)
+        self.connection = None
+
+    def run_query(self, query: str, params: tuple = ()):
+        # Values always go in params, never into the query string.
+        self.cursor.execute(query, params)
         self.connection.commit()
         return self.cursor.fetchone()
 
@@ -69,7 +225,46 @@ class DBManager:
 
         return bool(result)
 
-    def pay_for_file(self, email, md5_name, conversion_type, data_length):
+    def get_paid_files(self, email) -> set[tuple[str, str]]:
+        """
+        Returns (md5_name, conversion_type) of every file the user paid for.
+        """
+        paid_files_query = """
+            SELECT pf.md5_name, pf.conversion_type
+            FROM paid_files pf
+            INNER JOIN paid_files_jt uft ON pf.file_id = uft.file_id
+            INNER JOIN users u ON uft.user_id = u.id
+            WHERE u.email = %s
+        """
+        self.cursor.execute(paid_files_query, (email,))
+        return {(row[0], row[1]) for row in self.cursor.fetchall()}
+
+    def get_paid_md5_names(self) -> set[str]:
+        self.cursor.execute("SELECT DISTINCT md5_name FROM paid_files")
+        return {row[0] for row in self.cursor.fetchall()}
+
+    def get_library_md5_names(self) -> set[str]:
+        """
+        Returns the md5_name of every document in a user's library with conversions.
+        """
+        self.cursor.execute(
+            "SELECT DISTINCT md5_name FROM user_documents WHERE JSON_LENGTH(COALESCE(conversion_types, '[]')) > 0"
+        )
+        return {row[0] for row in self.cursor.fetchall()}
+
+    def pay_for_file(self, email, md5_name, conversion_type, data_length, free_item_limit):
+        """
+        Records the file as paid & queues its usage in the usage_outbox, in one transaction. The first free_item_limit
+        items were free, only the rest are billed. The usage is reported to stripe later by the UsageReporter.
+        """
+        stripe_user_id = self.get_stripe_user_id(email)
+        subscription_query = "SELECT subscription_item_id FROM stripe_users WHERE user_id = %s"
+        self.cursor.execute(subscription_query, (stripe_user_id,))
+        subscription_item = self.cursor.fetchone()
+        if not subscription_item or not subscription_item[0]:
+            raise ValueError(f"{email} has no stripe subscription to bill the file to")
+        subscription_item_id: str = subscription_item[0]
+
         # Add this file into our paid_files table
         db_user_id = self.get_db_user_id(email)
         add_file_query = "INSERT INTO paid_files (md5_name, conversion_type, data_length) VALUES (%s, %s, %s)"
@@ -83,29 +278,13 @@ class DBManager:
         # Add file_id & user_id to our file_join_table
         add_file_join_query = "INSERT INTO paid_files_jt (user_id, file_id) VALUES (%s, %s)"
         self.cursor.execute(add_file_join_query, (db_user_id, file_id))
-        self.connection.commit()
-
-        stripe_user_id = self.get_stripe_user_id(email)
-
-        subscription_query = f"""
-        SELECT subscription_item_id
-        FROM stripe_users
-        WHERE user_id = '{stripe_user_id}'
-        """
 
-        self.cursor.execute(subscription_query)
-        subscription_item_id: str = self.cursor.fetchone()[0]
+        paid_quantity = data_length - free_item_limit
+        if paid_quantity > 0:
+            add_usage_query = "INSERT INTO usage_outbox (subscription_item_id, quantity) VALUES (%s, %s)"
+            self.cursor.execute(add_usage_query, (subscription_item_id, paid_quantity))
 
-        paid_quantity = data_length - 10
-        if paid_quantity <= 0:
-            return
-
-        stripe.SubscriptionItem.create_usage_record(
-            subscription_item_id,
-            quantity=paid_quantity,
-            timestamp=int(time.time()),
-            action="increment",
-        )
+        self.connection.commit()
 
     def get_db_user_id(self, email):
         query = "SELECT id FROM users WHERE email = %s"
@@ -129,7 +308,10 @@ class DBManager:
         self.cursor.execute(query, values)
         self.connection.commit()
 
-    def add_user(self, email: str, password: str):
+    def add_user(self, email: str, password_hash: str):
+        """
+        Adds a user with a password hashed by passwords.hash_password (see PasswordHasher).
+        """
         try:
             # Check for existing users:
             existing_user_query = "SELECT COUNT(*) FROM users WHERE email= %s"
@@ -140,13 +322,9 @@ class DBManager:
             if count > 0:
                 return (1, "User already exists")
 
-            # Generate a salt
-            salt = os.urandom(16)
-            # Hash the password with the salt
-            hashed_password_bytes = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 100000)
-
-            query = "INSERT INTO users (email, password, salt, card_connected) VALUES (%s, %s, %s, false)"
-            data = (email, hashed_password_bytes.hex(), salt)
+            # The salt is part of the password hash, the salt column only holds the salt of legacy hashes.
+            query = "INSERT INTO users (email, password, salt, card_connected) VALUES (%s, %s, NULL, false)"
+            data = (email, password_hash)
             self.cursor.execute(query, data)
             self.connection.commit()
 
@@ -155,35 +333,28 @@ class DBManager:
             return (1, str(e))
         return (0, "Success")
 
-    def get_user(self, email: str, password: str | None = None):
+    def get_user(self, email: str):
+        """
+        Returns the user, passwords are checked by the caller (see PasswordHasher.verify).
+        """
         try:
-            query = f"SELECT * FROM users WHERE email='{email}'"
-            self.cursor.execute(query)
+            query = "SELECT * FROM users WHERE email = %s"
+            self.cursor.execute(query, (email,))
             user_db_tuple = self.cursor.fetchone()
 
             if user_db_tuple:
-                db_user_obj = DBUser(user_db_tuple)
-
-                # If we are not providing a password
-                if not password:
-                    return (db_user_obj, "Success")
-
-                # Hash the entered password with the stored salt
-                hash_password_entered_hex = hashlib.pbkdf2_hmac(
-                    "sha256", password.encode("utf-8"), db_user_obj.salt, 100000
-                ).hex()
-
-                if db_user_obj.password == hash_password_entered_hex:
-                    # Return the user data from SQL
-                    return (db_user_obj, "Success")
-                else:
-                    return (None, "Invalid email or password")  # Password is incorrect
+                return (DBUser(user_db_tuple), "Success")
             else:
                 return (None, "Invalid email or password")  # User doesn't exist
         except Exception as e:
             print("Error:", e, file=sys.stderr)
             return (None, str(e))
 
+    def set_user_password(self, email: str, password_hash: str):
+        query = "UPDATE users SET password = %s, salt = NULL WHERE email = %s"
+        self.cursor.execute(query, (password_hash, email))
+        self.connection.commit()
+
     def set_card_connected(self, email, value):
         try:
             query = "UPDATE users SET card_connected = %s WHERE email = %s"
@@ -197,8 +368,8 @@ class DBManager:
 
     def get_stripe_user_id(self, email):
         # TODO: Use try
-        query = f"SELECT stripe_user_id from users WHERE email='{email}'"
-        self.cursor.execute(query)
+        query = "SELECT stripe_user_id from users WHERE email = %s"
+        self.cursor.execute(query, (email,))
         stripe_user_id = self.cursor.fetchone()
         print(stripe_user_id)
 
@@ -225,19 +396,271 @@ class DBManager:
 
         self.cursor.execute(stripe_query, values)
 
-        users_query = f"""
-            UPDATE users SET stripe_user_id = '{user_id}' WHERE email = '{email}'
+        users_query = "UPDATE users SET stripe_user_id = %s WHERE email = %s"
+        self.cursor.execute(users_query, (user_id, email))
+
+        self.connection.commit()
+
+    def add_file_metadata(self, metadata: dict):
         """
+        Saves the metadata of an uploaded file. If the file was uploaded before, the existing metadata is kept.
+        """
+        query = """
+            INSERT IGNORE INTO file_metadata
+                (md5_name, file_name, page_count, extension_type, page_hashes, data_lengths)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """
+        values = (
+            metadata["md5_name"],
+            metadata.get("file_name"),
+            metadata.get("page_count"),
+            metadata.get("extension_type"),
+            json.dumps(metadata.get("page_hashes", [])),
+            json.dumps(metadata.get("data_lengths", {})),
+        )
+        self.cursor.execute(query, values)
+        self.connection.commit()
+
+    def get_file_metadata(self, md5_name: str) -> dict | None:
+        query = """
+            SELECT md5_name, file_name, page_count, extension_type, page_hashes, data_lengths
+            FROM file_metadata
+            WHERE md5_name = %s
+        """
+        self.cursor.execute(query, (md5_name,))
+        metadata_tuple = self.cursor.fetchone()
+
+        if not metadata_tuple:
+            return None
+
+        return {
+            "md5_name": metadata_tuple[0],
+            "file_name": metadata_tuple[1],
+            "page_count": metadata_tuple[2],
+            "extension_type": metadata_tuple[3],
+            "page_hashes": json.loads(metadata_tuple[4] or "[]"),
+            "data_lengths": json.loads(metadata_tuple[5] or "{}"),
+        }
+
+    def set_file_data_length(self, md5_name: str, conversion_type: str, data_length: int):
+        """
+        Sets the data_length of one conversion type. This is a single UPDATE, so concurrent conversions of the same
+        file can't overwrite each other's data_lengths.
+        """
+        query = """
+            UPDATE file_metadata
+            SET data_lengths = JSON_SET(COALESCE(data_lengths, '{}'), CONCAT('$."', %s, '"'), %s)
+            WHERE md5_name = %s
+        """
+        self.cursor.execute(query, (conversion_type, data_length, md5_name))
+        self.connection.commit()
+
+    def clear_file_results(self, md5_name: str):
+        """
+        Forgets the processed results of a file, after retention deleted them: its data_lengths, and the conversions
+        listed in the libraries it is in. Both in one transaction.
+        """
+        self.cursor.execute("UPDATE file_metadata SET data_lengths = '{}' WHERE md5_name = %s", (md5_name,))
+        self.cursor.execute("UPDATE user_documents SET conversion_types = '[]' WHERE md5_name = %s", (md5_name,))
+        self.connection.commit()
+
+    def add_user_document(self, email: str, md5_name: str, file_name: str):
+        """
+        Adds the document to the user's library, or updates its name if it's there already.
+        """
+        query = """
+            INSERT INTO user_documents (user_id, md5_name, file_name, conversion_types)
+            SELECT id, %s, %s, '[]' FROM users WHERE email = %s
+            ON DUPLICATE KEY UPDATE file_name = VALUES(file_name)
+        """
+        self.cursor.execute(query, (md5_name, file_name, email))
+        self.connection.commit()
+
+    def add_user_document_conversion(self, email: str, md5_name: str, conversion_type: str):
+        query = """
+            UPDATE user_documents ud
+            INNER JOIN users u ON u.id = ud.user_id
+            SET ud.conversion_types = JSON_ARRAY_APPEND(COALESCE(ud.conversion_types, '[]'), '$', %s)
+            WHERE u.email = %s AND ud.md5_name = %s
+                AND NOT JSON_CONTAINS(COALESCE(ud.conversion_types, '[]'), JSON_QUOTE(%s))
+        """
+        self.cursor.execute(query, (conversion_type, email, md5_name, conversion_type))
+        self.connection.commit()
+
+    def get_user_document_results(self, email: str) -> dict[str, list[str]]:
+        """
+        Returns the conversion types each document in the user's library has a finished result for, by md5_name.
+        """
+        query = """
+            SELECT ud.md5_name, fm.data_lengths
+            FROM user_documents ud
+            INNER JOIN users u ON u.id = ud.user_id
+            LEFT JOIN file_metadata fm ON fm.md5_name = ud.md5_name
+            WHERE u.email = %s
+        """
+        self.cursor.execute(query, (email,))
+        # A conversion is done once its data_length was saved.
+        return {row[0]: list(json.loads(row[1] or "{}")) for row in self.cursor.fetchall()}
+
+    def get_user_documents(self, email: str, before_id: int | None, limit: int) -> list[dict]:
+        """
+        Returns a page of the user's library, newest first, starting after the document with id before_id. Uses the
+        (user_id, id) index, so every page costs the same however large the library is.
+        """
+        query = """
+            SELECT ud.id, ud.md5_name, ud.file_name, ud.conversion_types, UNIX_TIMESTAMP(ud.created_at),
+                fm.page_count, fm.extension_type, fm.data_lengths
+            FROM user_documents ud
+            LEFT JOIN file_metadata fm ON fm.md5_name = ud.md5_name
+            WHERE ud.user_id = (SELECT id FROM users WHERE email = %s) AND ud.id < %s
+            ORDER BY ud.id DESC
+            LIMIT %s
+        """
+        self.cursor.execute(query, (email, before_id if before_id is not None else 2**63 - 1, limit))
+
+        documents = []
+        for row in self.cursor.fetchall():
+            data_lengths = json.loads(row[7] or "{}")
+            documents.append(
+                {
+                    "id": row[0],
+                    "md5_name": row[1],
+                    "file_name": row[2],
+                    # A conversion is done once its data_length was saved.
+                    "conversions": {
+                        conversion_type: "completed" if conversion_type in data_lengths else "processing"
+                        for conversion_type in json.loads(row[3] or "[]")
+                    },
+                    "created_at": int(row[4]),
+                    "page_count": row[5],
+                    "extension_type": row[6],
+                    "data_lengths": data_lengths,
+                }
+            )
+
+        return documents
+
+    def add_pages_processed(self, pages_by_email: list[tuple[str, int]]):
+        """
+        Adds pages to users.pages_processed of each user in a single UPDATE.
+        """
+        if len(pages_by_email) <= 0:
+            return
 
-        self.cursor.execute(users_query)
+        cases = " ".join(["WHEN %s THEN %s"] * len(pages_by_email))
+        placeholders = ", ".join(["%s"] * len(pages_by_email))
+        query = f"""
+            UPDATE users
+            SET pages_processed = COALESCE(pages_processed, 0) + CASE email {cases} ELSE 0 END
+            WHERE email IN ({placeholders})
+        """
+        values = [value for email_pages in pages_by_email for value in email_pages]
+        self.cursor.execute(query, (*values, *[email for email, _ in pages_by_email]))
+        self.connection.commit()
+
+    def get_billing_summary(self, stripe_user_id: str) -> dict | None:
+        query = """
+            SELECT subscription_id, current_period_end, amount_due, stale, UNIX_TIMESTAMP(refreshed_at)
+            FROM billing_summaries
+            WHERE stripe_user_id = %s
+        """
+        self.cursor.execute(query, (stripe_user_id,))
+        summary_tuple = self.cursor.fetchone()
 
+        if not summary_tuple:
+            return None
+
+        return {
+            "subscription_id": summary_tuple[0],
+            "current_period_end": summary_tuple[1],
+            "amount_due": summary_tuple[2],
+            "stale": bool(summary_tuple[3]),
+            "refreshed_at": int(summary_tuple[4]),
+        }
+
+    def set_billing_summary(
+        self, stripe_user_id: str, subscription_id: str | None, current_period_end: int | None, amount_due: int | None
+    ):
+        query = """
+            INSERT INTO billing_summaries (stripe_user_id, subscription_id, current_period_end, amount_due)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                subscription_id = VALUES(subscription_id),
+                current_period_end = VALUES(current_period_end),
+                amount_due = VALUES(amount_due),
+                stale = 0,
+                refreshed_at = CURRENT_TIMESTAMP
+        """
+        self.cursor.execute(query, (stripe_user_id, subscription_id, current_period_end, amount_due))
+        self.connection.commit()
+
+    def touch_billing_summary(self, stripe_user_id: str):
+        """
+        Records that the customer viewed their billing summary, at most once a minute.
+        """
+        query = """
+            UPDATE billing_summaries
+            SET viewed_at = CURRENT_TIMESTAMP
+            WHERE stripe_user_id = %s AND viewed_at < NOW() - INTERVAL 1 MINUTE
+        """
+        self.cursor.execute(query, (stripe_user_id,))
         self.connection.commit()
 
+    def mark_billing_summaries_stale(self, subscription_item_id: str):
+        """
+        Marks the billing summary of the subscription item's customer stale, e.g. after usage was reported.
+        """
+        query = """
+            UPDATE billing_summaries bs
+            INNER JOIN stripe_users su ON su.user_id = bs.stripe_user_id
+            SET bs.stale = 1
+            WHERE su.subscription_item_id = %s
+        """
+        self.cursor.execute(query, (subscription_item_id,))
+        self.connection.commit()
+
+    def get_stale_billing_summaries(self, max_age_seconds: int, active_seconds: int, limit: int) -> list[str]:
+        """
+        Returns the stripe_user_id of billing summaries marked stale, or older than max_age_seconds & viewed in the
+        last active_seconds. Stale ones come first, then oldest first.
+        """
+        query = """
+            SELECT stripe_user_id
+            FROM billing_summaries
+            WHERE stale = 1
+                OR (refreshed_at < NOW() - INTERVAL %s SECOND AND viewed_at >= NOW() - INTERVAL %s SECOND)
+            ORDER BY stale DESC, refreshed_at
+            LIMIT %s
+        """
+        self.cursor.execute(query, (max_age_seconds, active_seconds, limit))
+        return [row[0] for row in self.cursor.fetchall()]
+
     def close_connections(self):
-        if self.cursor:
-            self.cursor.close()
-        if self.connection:
-            self.connection.close()
+        self.close()
+
+
+class AsyncDatabase:
+    """
+    The DBManager operations for async code, e.g. await database.get_user(email). Each call checks out a
+    connection & runs in the database threads, so queries never block the event loop. There is one thread per pooled
+    connection, so calls don't wait on the pool unless sync code holds connections too.
+    """
+
+    def __init__(self, pool: DBConnectionPool):
+        self.pool = pool
+        self.executor = ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix="db")
+
+    async def run(self, operation: str, *args, **kwargs):
+        def run_operation():
+            with DBManager(self.pool) as database:
+                return getattr(database, operation)(*args, **kwargs)
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, run_operation)
+
+    def __getattr__(self, operation: str):
+        if operation.startswith("_") or not callable(getattr(DBManager, operation, None)):
+            raise AttributeError(operation)
+        return functools.partial(self.run, operation)
 
 
 """
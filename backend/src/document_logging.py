@@ -0,0 +1,139 @@
+import queue
+import logging
+import contextvars
+import logging.handlers
+from collections import OrderedDict
+from quart import Quart
+from .artifact_io import CompressedFileHandler
+from .blob_store import get_blob_store
+
+LOGGER_NAME = "pdf-logs"
+
+# The document the current task works on. Each asyncio task (and run_io call) has its own copy, so concurrent
+# documents never log into each other's files.
+current_md5_name: contextvars.ContextVar[str | None] = contextvars.ContextVar("current_md5_name", default=None)
+
+
+class DocumentContextFilter(logging.Filter):
+    """
+    Tags each record with the document of the task that logged it. Runs before the record is queued, while we're
+    still in the task's context. Records logged outside of any document are dropped.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "md5_name", None) is None:
+            record.md5_name = current_md5_name.get()
+        return record.md5_name is not None
+
+
+class DocumentRoutingHandler(logging.Handler):
+    """
+    Writes each record into the log file of its document. Runs in the queue listener's thread, so disk writes never
+    block the event loop. At most max_open_files log files are kept open, the least recently used one is closed
+    (and published to the blob store) to make room for another. Log files are always closed before they are
+    published, the next record opens them again.
+    """
+
+    def __init__(self, server: Quart, max_open_files: int):
+        super().__init__()
+        self.server = server
+        self.max_open_files = max_open_files
+        self.file_handlers: OrderedDict[str, logging.Handler] = OrderedDict()
+        self.file_formatter = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
+
+    def get_file_handler(self, md5_name: str) -> logging.Handler:
+        file_handler = self.file_handlers.get(md5_name)
+        if file_handler is not None:
+            self.file_handlers.move_to_end(md5_name)
+            return file_handler
+
+        # Fetch the logs other nodes wrote for the file, so publishing ours doesn't drop them.
+        store = get_blob_store(self.server)
+        store.fetch_artifact("log", f"{md5_name}.txt")
+        file_handler = CompressedFileHandler(store.get_write_path("log", f"{md5_name}.txt"))
+        file_handler.setFormatter(self.file_formatter)
+        self.file_handlers[md5_name] = file_handler
+
+        while len(self.file_handlers) > self.max_open_files:
+            self.close_file_handler(*self.file_handlers.popitem(last=False))
+
+        return file_handler
+
+    def close_file_handler(self, md5_name: str, file_handler: logging.Handler):
+        file_handler.close()
+        get_blob_store(self.server).publish_artifact("log", f"{md5_name}.txt")
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            if getattr(record, "publish_log", False):
+                # Files that aren't open anymore were published when they were closed.
+                file_handler = self.file_handlers.pop(record.md5_name, None)
+                if file_handler is not None:
+                    # Closing ends the file's gzip member, a copy of a member that was only flushed can't be read
+                    # once more is appended to it.
+                    self.close_file_handler(record.md5_name, file_handler)
+                return
+
+            self.get_file_handler(record.md5_name).handle(record)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        while len(self.file_handlers) > 0:
+            self.close_file_handler(*self.file_handlers.popitem(last=False))
+        super().close()
+
+
+class DocumentLogging:
+    """
+    The "pdf-logs" logger only puts records on a queue. A listener thread takes them off & writes them into the log
+    file of the document each one belongs to.
+    """
+
+    def __init__(self, server: Quart):
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = logging.handlers.QueueHandler(self.queue)
+        self.queue_handler.addFilter(DocumentContextFilter())
+        self.routing_handler = DocumentRoutingHandler(server, server.config["LOG_MAX_OPEN_FILES"])
+        self.listener = logging.handlers.QueueListener(self.queue, self.routing_handler)
+
+        self.logger = logging.getLogger(LOGGER_NAME)
+        self.logger.setLevel(server.config["LOG_LEVEL"])
+        self.logger.propagate = False
+        self.logger.handlers = [self.queue_handler]
+
+        self.listener.start()
+
+    def publish(self, md5_name: str):
+        """
+        Queues publishing the document's log, after the records logged before it are written.
+        """
+        record = self.logger.makeRecord(LOGGER_NAME, logging.INFO, __file__, 0, "", (), None)
+        record.md5_name = md5_name
+        record.publish_log = True
+        self.queue_handler.handle(record)
+
+    def stop(self):
+        # Writes out everything still queued before closing the log files.
+        self.listener.stop()
+        self.routing_handler.close()
+
+
+document_logging: DocumentLogging | None = None
+
+
+def get_document_logging(server: Quart) -> DocumentLogging:
+    global document_logging
+
+    if document_logging is None:
+        document_logging = DocumentLogging(server)
+
+    return document_logging
+
+
+def get_document_logger(server: Quart, md5_name: str) -> logging.Logger:
+    """
+    Returns the logger for the document & routes everything the current task logs into the document's log file.
+    """
+    current_md5_name.set(md5_name)
+    return get_document_logging(server).logger
@@ -0,0 +1,165 @@
+import sys
+import time
+import threading
+import redis
+from quart import Quart
+from . import file_utils
+
+# Every entitlement set holds this member, so users who haven't paid for anything are cached too.
+EMPTY_ENTITLEMENT = ""
+INVALIDATE_ATTEMPTS = 4  # Tries to drop a user's set after a payment...
+INVALIDATE_RETRY_DELAY = 0.1  # ...seconds apart, doubled after every try.
+
+
+def get_entitlement(md5_name: str, conversion_type: str) -> str:
+    return f"{md5_name}/{conversion_type}"
+
+
+class EntitlementCache:
+    """
+    The files each user paid for, as a Redis set of "md5_name/conversion_type" next to the sessions. Checks only ask
+    Redis, a user's set is loaded from the database on the first check after it expired or was invalidated.
+
+    Call invalidate() after pay_for_file / assign_user_file. It bumps the user's version, and a set read from the
+    database while the version changed is never stored, so a load racing a payment can't hide it. If Redis is
+    unavailable, checks fall back to the database.
+    """
+
+    def __init__(self, server: Quart, client: redis.Redis, ttl: int):
+        self.server = server
+        self.client = client
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def get_key(self, email: str) -> str:
+        return f"entitlements:{email}"
+
+    def get_version_key(self, email: str) -> str:
+        return f"entitlements-version:{email}"
+
+    def has_paid_file(self, email: str, md5_name: str, conversion_type: str) -> bool:
+        entitlement = get_entitlement(md5_name, conversion_type)
+        return bool(
+            self.check(
+                email,
+                lambda pipeline, key: pipeline.sismember(key, entitlement),
+                lambda entitlements: entitlement in entitlements,
+                lambda database: database.user_has_paid_file(email, md5_name, conversion_type),
+            )
+        )
+
+    def get_paid_results(self, email: str) -> set[str]:
+        """
+        Returns "md5_name/conversion_type" of every file the user paid for.
+        """
+        entitlements = self.check(
+            email,
+            lambda pipeline, key: pipeline.smembers(key),
+            lambda entitlements: entitlements,
+            lambda database: {get_entitlement(*paid_file) for paid_file in database.get_paid_files(email)},
+        )
+        return set(entitlements) - {EMPTY_ENTITLEMENT}
+
+    def check(self, email: str, read_cached, read_loaded, read_database):
+        """
+        Answers a check from the user's cached set: read_cached(pipeline, key) queues the Redis command answering it.
+        If the set isn't cached it's loaded & read_loaded(entitlements) answers instead, if Redis is unavailable
+        read_database(database).
+        """
+        try:
+            with self.client.pipeline(transaction=False) as pipeline:
+                pipeline.exists(self.get_key(email))
+                read_cached(pipeline, self.get_key(email))
+                cached, result = pipeline.execute()
+
+            with self.lock:
+                if cached:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+
+            if cached:
+                return result
+            return read_loaded(self.load(email))
+        except redis.RedisError as e:
+            with self.lock:
+                self.errors += 1
+            print(f"Entitlement cache unavailable, checking the database: {e}", file=sys.stderr)
+            with file_utils.get_database(self.server) as database:
+                return read_database(database)
+
+    def load(self, email: str) -> set[str]:
+        """
+        Reads the files the user paid for from the database & caches them, unless a payment came in meanwhile.
+        """
+        with self.client.pipeline() as pipeline:
+            pipeline.watch(self.get_version_key(email))
+            with file_utils.get_database(self.server) as database:
+                entitlements = {get_entitlement(*paid_file) for paid_file in database.get_paid_files(email)}
+
+            try:
+                pipeline.multi()
+                pipeline.delete(self.get_key(email))
+                pipeline.sadd(self.get_key(email), EMPTY_ENTITLEMENT, *entitlements)
+                pipeline.expire(self.get_key(email), self.ttl)
+                pipeline.execute()
+            except redis.WatchError:
+                # The next check loads the set again.
+                pass
+
+        return entitlements
+
+    def invalidate(self, email: str) -> bool:
+        """
+        Drops the user's cached set, retrying INVALIDATE_ATTEMPTS times. Returns False if Redis stayed unavailable,
+        the stale set is then used until it expires after ttl seconds.
+        """
+        retry_delay = INVALIDATE_RETRY_DELAY
+        for attempt in range(1, INVALIDATE_ATTEMPTS + 1):
+            try:
+                with self.client.pipeline() as pipeline:
+                    pipeline.incr(self.get_version_key(email))
+                    pipeline.expire(self.get_version_key(email), self.ttl)
+                    pipeline.delete(self.get_key(email))
+                    pipeline.execute()
+                return True
+            except redis.RedisError as e:
+                with self.lock:
+                    self.errors += 1
+                print(f"Couldn't invalidate the entitlements of {email} (attempt {attempt}): {e}", file=sys.stderr)
+
+            if attempt < INVALIDATE_ATTEMPTS:
+                time.sleep(retry_delay)
+                retry_delay *= 2
+
+        return False
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            checks = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / checks if checks > 0 else 0.0,
+                "errors": self.errors,
+                "ttl": self.ttl,
+            }
+
+
+entitlement_cache: EntitlementCache | None = None
+
+
+def get_entitlement_cache(server: Quart) -> EntitlementCache:
+    global entitlement_cache
+
+    if entitlement_cache is None:
+        entitlement_cache = EntitlementCache(
+            server,
+            redis.Redis.from_url(server.config["REDIS_URL"], decode_responses=True),
+            server.config["ENTITLEMENT_CACHE_TTL"],
+        )
+
+    return entitlement_cache
@@ -2,78 +2,88 @@ import os
 import json
 from quart import Quart
 import sys
+from .database import DBManager, DBConnectionPool, AsyncDatabase
+from . import artifact_io
+
+db_pool: DBConnectionPool | None = None
+
+
+def get_db_pool(server: Quart) -> DBConnectionPool:
+    global db_pool
+
+    if db_pool is None:
+        db_pool = DBConnectionPool(
+            server.config["DB_POOL_SIZE"],
+            server.config["DB_POOL_TIMEOUT"],
+            server.config["DB_HEALTH_CHECK_INTERVAL"],
+            server.config["DB_PASSWORD_FILE"],
+        )
+
+    return db_pool
+
+
+def get_database(server: Quart) -> DBManager:
+    """
+    Returns a DBManager with a connection checked out from the pool.
+    """
+    return DBManager(get_db_pool(server))
+
+
+async_database: AsyncDatabase | None = None
+
+
+def get_async_database(server: Quart) -> AsyncDatabase:
+    """
+    Returns the database for async code, queries run in the database threads with connections from the pool.
+    """
+    global async_database
+
+    if async_database is None:
+        async_database = AsyncDatabase(get_db_pool(server))
+
+    return async_database
+
+
+def get_all_file_metadata(server: Quart, md5_name) -> dict | None:
+    with get_database(server) as database:
+        return database.get_file_metadata(md5_name)
 
 
-def remove_json_value(file_path, key):
-    try:
-        with open(file_path, "r+") as file:
-            data = json.load(file)
-            if key in data:
-                del data[key]
-                file.seek(0)
-                json.dump(data, file)
-                file.truncate()
-            else:
-                print(f"Key '{key}' not found in JSON.", file=sys.stderr)
-    except FileNotFoundError:
-        print(f"File '{file_path}' not found.", file=sys.stderr)
-    except json.JSONDecodeError:
-        print(f"Error decoding JSON in file '{file_path}'.", file=sys.stderr)
-    except Exception as e:
-        print(f"An error occurred: {e}", file=sys.stderr)
-
-
-# Example usage:
-# remove_json_value('data.json', 'name')
-
-
-def append_file_json_value(file_path, key, value):
-    with open(file_path, "r+") as file:
-        data = json.load(file)
-
-        print("***** append_file_json_value", file=sys.stderr)
-        print((key in data), file=sys.stderr)
-        if key in data:
-            print((isinstance(data[key], dict)), file=sys.stderr)
-
-        if key in data and isinstance(data[key], dict):
-            data[key].update(value)  # Append the dictionary values here
-        else:
-            data[key] = value
-        file.seek(0)
-        json.dump(data, file)
-        file.truncate()
-
-
-def set_file_json_value(file_path, key, value):
-    try:
-        with open(file_path, "r+") as file:
-            data = json.load(file)
-            data[key] = value
-            file.seek(0)
-            json.dump(data, file)
-            file.truncate()
-    except FileNotFoundError:
-        print(f"File '{file_path}' not found.", file=sys.stderr)
-    except json.JSONDecodeError:
-        print(f"Error decoding JSON in file '{file_path}'.", file=sys.stderr)
-    except Exception as e:
-        print(f"An error occurred: {e}", file=sys.stderr)
-
-
-# FIXME: Maybe just make this get_file_json_value and remove the metadata shit?
 def get_file_metadata(server: Quart, md5_name, key):
-    metadata_folder = server.config["METADATA_FOLDER"]
-    metadata_file_path = os.path.join(metadata_folder, f"{md5_name}.json")
+    metadata = get_all_file_metadata(server, md5_name)
 
-    if os.path.exists(metadata_file_path):
-        with open(metadata_file_path, "r") as metadata_file:
-            metadata = json.load(metadata_file)
-            return metadata.get(key, None)
+    if metadata:
+        return metadata.get(key, None)
     else:
         return None
 
 
+def import_metadata_folder(server: Quart):
+    """
+    Imports the metadata JSON files written before metadata was stored in the database, then renames the folder so
+    the import only runs once.
+    """
+    metadata_folder = server.config["METADATA_FOLDER"]
+    if not os.path.isdir(metadata_folder):
+        return
+
+    imported_files = 0
+    with get_database(server) as database:
+        for metadata_file_name in os.listdir(metadata_folder):
+            if not metadata_file_name.endswith(".json"):
+                continue
+
+            metadata = get_file_json(os.path.join(metadata_folder, metadata_file_name))
+            if not metadata or "md5_name" not in metadata:
+                continue
+
+            database.add_file_metadata(metadata)
+            imported_files += 1
+
+    os.rename(metadata_folder, f"{metadata_folder}-imported")
+    print(f"Imported metadata of {imported_files} files into the database.", file=sys.stderr)
+
+
 def get_file_json(file_path):
     if os.path.exists(file_path):
         with open(file_path, "r") as metadata_file:
@@ -82,11 +92,85 @@ def get_file_json(file_path):
         return None
 
 
-def dir_last_updated(folder):
-    return str(
-        max(os.path.getmtime(os.path.join(root_path, f)) for root_path, _, files in os.walk(folder) for f in files)
-    )
-
-
 def get_file_extension(filename: str):
     return filename.rsplit(".", 1)[-1].lower()
+
+
+class JSONArrayReader:
+    """
+    Incrementally reads the elements of a top-level JSON array from a file, one element at a time. Only a small
+    read buffer and the current element are held in memory, so large unstructured-io responses can be processed
+    without loading the whole document. The file may be stored compressed (see artifact_io). `progress` is the
+    fraction (0-1) of the stored file consumed so far.
+    """
+
+    def __init__(self, file_path, chunk_size=64 * 1024):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        artifact_path = artifact_io.get_artifact_path(file_path)
+        if artifact_path is None:
+            raise FileNotFoundError(file_path)
+        self.file_size = os.path.getsize(artifact_path)
+        self.bytes_read = 0
+
+    @property
+    def progress(self) -> float:
+        if self.file_size <= 0:
+            return 1.0
+        return min(self.bytes_read / self.file_size, 1.0)
+
+    def __iter__(self):
+        decoder = json.JSONDecoder()
+        raw_file, file = artifact_io.open_artifact(self.file_path)
+        with raw_file, file:
+            buffer = ""
+            position = 0
+            started = False
+            eof = False
+
+            while True:
+                # Skip whitespace & separators between elements.
+                while position < len(buffer) and buffer[position] in " \t\r\n,":
+                    position += 1
+
+                if position >= len(buffer):
+                    if eof:
+                        return
+                    buffer = file.read(self.chunk_size)
+                    self.bytes_read = raw_file.tell()
+                    position = 0
+                    eof = len(buffer) < 1
+                    continue
+
+                if not started:
+                    if buffer[position] != "[":
+                        raise json.JSONDecodeError("Expected a JSON array", buffer, position)
+                    started = True
+                    position += 1
+                    continue
+
+                if buffer[position] == "]":
+                    return
+
+                try:
+                    element, end = decoder.raw_decode(buffer, position)
+                    # A scalar touching the end of the buffer may continue in the next read.
+                    split = end >= len(buffer) and not eof
+                except json.JSONDecodeError:
+                    split = True
+
+                if split:
+                    # The element is split across reads, pull in more data and try again.
+                    more = file.read(self.chunk_size)
+                    if not more:
+                        if eof:
+                            raise json.JSONDecodeError("Unterminated JSON array", buffer, position)
+                        eof = True
+                        continue
+                    self.bytes_read = raw_file.tell()
+                    buffer = buffer[position:] + more
+                    position = 0
+                    continue
+
+                position = end
+                yield element
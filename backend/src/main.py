@@ -3,9 +3,26 @@ import os
 import openai
 import hashlib
 import uuid
+import time
+import asyncio
 import json
 import stripe
 from . import file_utils
+from . import result_cache
+from . import processed_results
+from . import static_assets
+from . import artifact_io
+from . import retention
+from . import async_io
+from . import document_logging
+from . import entitlements
+from . import migrations
+from . import usage_reporting
+from . import billing
+from . import passwords
+from . import usage_metering
+from . import search_index
+from .blob_store import get_blob_store
 from .async_actions import exporter
 from .async_actions import document_processing
 from .async_actions.async_task import (
@@ -18,6 +35,7 @@ from .async_actions.async_task import (
 from quart import (
     Quart,
     Request,
+    Response,
     render_template,
     flash,
     request,
@@ -26,53 +44,162 @@ from quart import (
     session,
     jsonify,
     send_file,
+    send_from_directory,
     abort,
 )
 from quart_session import Session
 from werkzeug.utils import secure_filename
 from werkzeug.datastructures import FileStorage
-from .database import DBManager
 
 import traceback
 from datetime import datetime
 
 UNSTRUCTUED_API_URL = "http://unstructured-api:8000/general/v0/general"
+# Comma separated list of unstructured-api endpoints, documents are load balanced across them.
+UNSTRUCTUED_API_URLS = os.environ.get("UNSTRUCTURED_API_URLS", UNSTRUCTUED_API_URL).split(",")
 API_KEYS_FOLDER = "./data/api-keys"
 UPLOAD_FOLDER = "./data/file-upload"
 JSON_FOLDER = "./data/file-json"
+TEXT_FOLDER = "./data/file-text"
+PAGE_INDEX_FOLDER = "./data/page-index"
+CHUNK_CACHE_FOLDER = "./data/chunk-cache"
 PROCESSED_FOLDER = "./data/file-processed"
 LOG_FOLDER = "./data/file-log"
-METADATA_FOLDER = "./data/file-metadata"
+METADATA_FOLDER = "./data/file-metadata"  # Only read once, to import metadata saved before it moved to the DB.
 EXPORT_FOLDER = "./data/exports"
 ALLOWED_EXTENSIONS = {"pdf", "pptx"}
-CONCURRENT_TEXT_PROCESS_LIMIT = 2  # How many files unstructured API can handle at a time.
+CONCURRENT_TEXT_PROCESS_LIMIT = 2  # How many files each unstructured API backend can handle at a time.
+EXTRACTION_PAGES_PER_REQUEST = 20  # PDFs are split into requests of this many pages, extracted concurrently.
+DB_PASSWORD_FILE = "/run/secrets/db-password"
+DB_POOL_SIZE = 10  # MySQL connections shared by all requests & background tasks.
+DB_POOL_TIMEOUT = 10  # Seconds to wait for a free connection before failing.
+DB_HEALTH_CHECK_INTERVAL = 30  # Connections idle for longer than this are pinged before they are reused.
 SUPPORT_EMAIL = "???@???.com"
 SINGLE_ITEM_COST = 0.02
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Memory used to cache processed results served to the results page.
+FREE_ITEM_LIMIT = 10  # Items of each result logged in users see without paying for it.
+SEARCH_INDEX_PATH = "./data/search-index/items.sqlite3"  # Full-text index of the generated items.
+SEARCH_MAX_HITS = 100  # Most hits /search returns.
+DOCUMENTS_PAGE_SIZE = 100  # Documents per /documents page, unless the client asks for fewer...
+DOCUMENTS_MAX_PAGE_SIZE = 1000  # ...or more, up to this.
+WATCH_STATIC_FILES = os.environ.get("QUART_ENV") == "development"  # Pick up edited static files without a restart.
+# Comma separated emails of the accounts allowed to see /metrics, which expose per-user counts & error messages.
+ADMIN_EMAILS = [email for email in os.environ.get("ADMIN_EMAILS", "").split(",") if email]
+# Addresses of the reverse proxies (nginx) in front of the backend, comma-separated. Requests from them are counted by
+# the client IP the proxy forwards in X-Real-IP or X-Forwarded-For instead.
+TRUSTED_PROXIES = [address for address in os.environ.get("TRUSTED_PROXIES", "").split(",") if address]
+# Where artifacts are stored: "local", or "s3" to share them between backend nodes through an S3 compatible bucket.
+# With s3 the data folders only hold copies of the blobs each node used. S3 credentials are read from the usual
+# AWS_ACCESS_KEY_ID & AWS_SECRET_ACCESS_KEY environment variables.
+BLOB_STORE = os.environ.get("BLOB_STORE", "local")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")  # None for AWS, e.g. http://minio:9000 for MinIO.
+S3_BUCKET = os.environ.get("S3_BUCKET", "pdf2questions")
+# Level of the per-document logs. At DEBUG full GPT prompts & responses are logged.
+LOG_LEVEL = os.environ.get("DOCUMENT_LOG_LEVEL", "INFO")
+LOG_MAX_OPEN_FILES = 32  # Per-document log files kept open at once.
+REDIS_URL = "redis://redis:6379"  # Sessions & the entitlement cache.
+# Seconds the files a user paid for stay cached in Redis. Payments invalidate them, this bounds how long a set that
+# couldn't be invalidated (Redis was down) stays stale.
+ENTITLEMENT_CACHE_TTL = 60 * 60
+USAGE_REPORT_INTERVAL = 10  # Seconds between reports of the queued usage to stripe.
+USAGE_REPORT_BATCH_SIZE = 500  # Usage events grouped into batches per report.
+USAGE_RETRY_DELAY = 10  # Seconds before a failed batch is retried, doubled on every failure...
+USAGE_RETRY_MAX_DELAY = 60 * 60  # ...up to this.
+USAGE_MAX_ATTEMPTS = 30  # Attempts before a failing batch is given up on & left in usage_outbox with failed_at set.
+BILLING_SUMMARY_TTL = 15 * 60  # Seconds before the reconciler refreshes a billing summary stripe sent no event for.
+BILLING_RECONCILE_INTERVAL = 60  # Seconds between runs of the billing summary reconciler.
+BILLING_RECONCILE_BATCH_SIZE = 50  # Billing summaries refreshed per run.
+# Only customers who viewed their billing summary in this many seconds get it refreshed after the TTL.
+BILLING_ACTIVE_SECONDS = 24 * 60 * 60
+# Daily quotas by account type, {counter: limit}. Counters without a limit are only counted. "documents" is counted
+# per upload, "conversions" per /convertfile request. Guests are counted by IP, users by account.
+DAILY_QUOTAS = {
+    "guest": {"documents": 1},
+    "free": {"documents": 5},
+    "paid": {},
+}
+USAGE_FLUSH_INTERVAL = 60  # Seconds between adding the pages counted in Redis to users.pages_processed.
+# PBKDF2 iterations of new password hashes. Raising it upgrades each user's hash at their next login.
+PASSWORD_HASH_ITERATIONS = 100000
+PASSWORD_HASH_THREADS = os.cpu_count() or 1  # Password hashing is CPU bound, one thread per core.
+# Point stripe at a local stand-in, e.g. http://stripe-mock:12111 (docker compose --profile stripe-mock up).
+STRIPE_API_BASE = os.environ.get("STRIPE_API_BASE")
+RETENTION_INTERVAL = 60 * 60  # Seconds between retention sweeps of the data folders.
+# (max bytes, max age in seconds) of each kind of blob's data folder, None for no limit. Artifacts past their age are
+# deleted, then the least recently used ones until the folder fits. Artifacts of paid & library files are kept.
+RETENTION_POLICIES = {
+    "upload": (20 * 1024**3, 30 * 24 * 60 * 60),
+    "json": (10 * 1024**3, 90 * 24 * 60 * 60),
+    "text": (5 * 1024**3, 90 * 24 * 60 * 60),
+    "processed": (10 * 1024**3, None),
+    "log": (1024**3, 30 * 24 * 60 * 60),
+    "export": (2 * 1024**3, 24 * 60 * 60),
+    "chunk-cache": (5 * 1024**3, 30 * 24 * 60 * 60),
+    "page-index": (1024**3, 90 * 24 * 60 * 60),
+}
 
 
 # Configure quart
 server = Quart(__name__)
-server.config["UNSTRUCTUED_API_URL"] = UNSTRUCTUED_API_URL
+server.config["UNSTRUCTUED_API_URLS"] = UNSTRUCTUED_API_URLS
 server.config["API_KEYS_FOLDER"] = API_KEYS_FOLDER
 server.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 server.config["JSON_FOLDER"] = JSON_FOLDER
+server.config["TEXT_FOLDER"] = TEXT_FOLDER
+server.config["PAGE_INDEX_FOLDER"] = PAGE_INDEX_FOLDER
+server.config["CHUNK_CACHE_FOLDER"] = CHUNK_CACHE_FOLDER
 server.config["PROCESSED_FOLDER"] = PROCESSED_FOLDER
 server.config["LOG_FOLDER"] = LOG_FOLDER
 server.config["EXPORT_FOLDER"] = EXPORT_FOLDER
 server.config["METADATA_FOLDER"] = METADATA_FOLDER
+server.config["DB_PASSWORD_FILE"] = DB_PASSWORD_FILE
+server.config["DB_POOL_SIZE"] = DB_POOL_SIZE
+server.config["DB_POOL_TIMEOUT"] = DB_POOL_TIMEOUT
+server.config["DB_HEALTH_CHECK_INTERVAL"] = DB_HEALTH_CHECK_INTERVAL
 server.config["MAX_CONTENT_LENGTH"] = 15 * 1024 * 1024  # 15mb
 server.config["CONCURRENT_TEXT_PROCESS_LIMIT"] = CONCURRENT_TEXT_PROCESS_LIMIT
+server.config["EXTRACTION_PAGES_PER_REQUEST"] = EXTRACTION_PAGES_PER_REQUEST
 server.config["SUPPORT_EMAIL"] = SUPPORT_EMAIL
 server.config["SINGLE_ITEM_COST"] = SINGLE_ITEM_COST
+server.config["RESULT_CACHE_MAX_BYTES"] = RESULT_CACHE_MAX_BYTES
+server.config["ADMIN_EMAILS"] = ADMIN_EMAILS
+server.config["TRUSTED_PROXIES"] = TRUSTED_PROXIES
+server.config["SEARCH_INDEX_PATH"] = SEARCH_INDEX_PATH
+server.config["SEARCH_MAX_HITS"] = SEARCH_MAX_HITS
+server.config["DOCUMENTS_PAGE_SIZE"] = DOCUMENTS_PAGE_SIZE
+server.config["DOCUMENTS_MAX_PAGE_SIZE"] = DOCUMENTS_MAX_PAGE_SIZE
+server.config["WATCH_STATIC_FILES"] = WATCH_STATIC_FILES
+server.config["BLOB_STORE"] = BLOB_STORE
+server.config["S3_ENDPOINT_URL"] = S3_ENDPOINT_URL
+server.config["S3_BUCKET"] = S3_BUCKET
+server.config["LOG_LEVEL"] = LOG_LEVEL
+server.config["LOG_MAX_OPEN_FILES"] = LOG_MAX_OPEN_FILES
+server.config["REDIS_URL"] = REDIS_URL
+server.config["ENTITLEMENT_CACHE_TTL"] = ENTITLEMENT_CACHE_TTL
+server.config["USAGE_REPORT_INTERVAL"] = USAGE_REPORT_INTERVAL
+server.config["USAGE_REPORT_BATCH_SIZE"] = USAGE_REPORT_BATCH_SIZE
+server.config["USAGE_RETRY_DELAY"] = USAGE_RETRY_DELAY
+server.config["USAGE_RETRY_MAX_DELAY"] = USAGE_RETRY_MAX_DELAY
+server.config["USAGE_MAX_ATTEMPTS"] = USAGE_MAX_ATTEMPTS
+server.config["BILLING_SUMMARY_TTL"] = BILLING_SUMMARY_TTL
+server.config["BILLING_RECONCILE_INTERVAL"] = BILLING_RECONCILE_INTERVAL
+server.config["BILLING_RECONCILE_BATCH_SIZE"] = BILLING_RECONCILE_BATCH_SIZE
+server.config["BILLING_ACTIVE_SECONDS"] = BILLING_ACTIVE_SECONDS
+server.config["PASSWORD_HASH_ITERATIONS"] = PASSWORD_HASH_ITERATIONS
+server.config["PASSWORD_HASH_THREADS"] = PASSWORD_HASH_THREADS
+server.config["DAILY_QUOTAS"] = DAILY_QUOTAS
+server.config["USAGE_FLUSH_INTERVAL"] = USAGE_FLUSH_INTERVAL
+server.config["RETENTION_INTERVAL"] = RETENTION_INTERVAL
+server.config["RETENTION_POLICIES"] = RETENTION_POLICIES
 server.secret_key = "opnqpwefqewpfqweu32134j32p4n1234d"
 
 # Setup redis
 server.config["SESSION_TYPE"] = "redis"
-server.config["SESSION_URI"] = "redis://redis:6379"
+server.config["SESSION_URI"] = REDIS_URL
 Session(server)
 
 # Setup stripe
-# /run/secrets/stripe
+# /run/secrets/stripe, key=value lines: private, public, product_id & optionally webhook_secret (whsec_...)
 stripe_keys = {}
 with open("/run/secrets/stripe", "r") as file:
     for line in file:
@@ -81,6 +208,8 @@ with open("/run/secrets/stripe", "r") as file:
 
 # Set up Stripe with the API keys
 stripe.api_key = stripe_keys["private"]
+if STRIPE_API_BASE:
+    stripe.api_base = STRIPE_API_BASE
 
 
 # Set up OpenAI API key...
@@ -108,11 +237,68 @@ if not open_ai_api_key:
 # Configure OpenAI GPT
 openai.api_key = open_ai_api_key
 
+# Fingerprint static files once, templates link to them with asset_url('css/main.css').
+asset_manifest = static_assets.AssetManifest(server.static_folder)
+server.jinja_env.globals.update(asset_url=asset_manifest.asset_url)
+
 # server.jinja_env.globals.update(zip=zip)
 # Prevent flask form emptying session variables
 # server.config.update(SESSION_COOKIE_SAMESITE="None", SESSION_COOKIE_SECURE=True)
 
 
+@server.before_serving
+async def migrate_database():
+    await async_io.run_io(migrations.run_migrations, file_utils.get_db_pool(server))
+    await async_io.run_io(migrations.enforce_unique_emails, file_utils.get_db_pool(server))
+    await async_io.run_io(file_utils.import_metadata_folder, server)
+
+
+@server.before_serving
+async def move_legacy_blobs():
+    await async_io.run_io(get_blob_store(server).move_legacy_blobs)
+
+
+@server.before_serving
+async def watch_static_files():
+    if server.config["WATCH_STATIC_FILES"]:
+        server.add_background_task(asset_manifest.watch)
+
+
+@server.before_serving
+async def start_document_logging():
+    document_logging.get_document_logging(server)
+
+
+@server.after_serving
+async def stop_document_logging():
+    document_logging.get_document_logging(server).stop()
+
+
+@server.before_serving
+async def start_loop_stall_monitor():
+    server.add_background_task(async_io.get_loop_stall_monitor(server).run)
+
+
+@server.before_serving
+async def start_usage_reporting():
+    server.add_background_task(usage_reporting.get_usage_reporter(server).run)
+
+
+@server.before_serving
+async def start_billing_reconciler():
+    server.add_background_task(billing.get_billing_summaries(server).run)
+
+
+@server.before_serving
+async def start_usage_metering():
+    server.add_background_task(usage_metering.get_usage_meter(server).run)
+
+
+@server.before_serving
+async def start_retention():
+    server.add_background_task(retention.get_retention_manager(server).run)
+
+
 def get_user_data_limit(md5_name, conversion_type):
     """
     Returns the number of values the user is allowed to view depending on the account, card_connected, and if they paid to view the remaining data.
@@ -121,13 +307,11 @@ def get_user_data_limit(md5_name, conversion_type):
         return 5
 
     if not session.get("card_connected"):
-        return 10
+        return FREE_ITEM_LIMIT
 
-    # TODO: Check DB to see if user has paid to view results of md5 file & it's conversion_type.
-    database = DBManager(pass_file="/run/secrets/db-password")
-    paid = database.user_has_paid_file(session.get("email"), md5_name, conversion_type)
+    paid = entitlements.get_entitlement_cache(server).has_paid_file(session.get("email"), md5_name, conversion_type)
     if not paid:
-        return 10
+        return FREE_ITEM_LIMIT
 
     return -1
 
@@ -147,36 +331,54 @@ def get_acount_type() -> str:
     return "guest"
 
 
-# Returns the invoice amount and due date.
-def get_customer_invoice():
-    if not session.get("card_connected"):
-        return (None, None)
+# Returns whether the logged in user may see the /metrics routes.
+def is_admin() -> bool:
+    return bool(session.get("logged_in")) and session.get("email") in server.config["ADMIN_EMAILS"]
+
+
+# Returns the IP of the client, as forwarded by the proxy if the request came through a trusted one.
+def get_client_ip() -> str:
+    if request.remote_addr not in server.config["TRUSTED_PROXIES"]:
+        return request.remote_addr
 
-    database = DBManager(pass_file="/run/secrets/db-password")
-    customer_id = database.get_stripe_user_id(session.get("email"))
+    if request.headers.get("X-Real-IP"):
+        return request.headers["X-Real-IP"]
 
-    # response = database.run_query(f"SELECT subscription_item_id FROM stripe_users WHERE user_id = '{customer_id}'")
-    # subscription_item_id = response[0]
+    # The proxy appends the address it got the request from, the ones before it are up to the client.
+    forwarded_for = [address.strip() for address in request.headers.get("X-Forwarded-For", "").split(",")]
+    return forwarded_for[-1] or request.remote_addr
 
-    response = database.run_query(f"SELECT subscription_id FROM stripe_users WHERE user_id = '{customer_id}'")
-    subscription_id = response[0]
 
-    if not subscription_id:
+# Returns who usage is counted for: the account if logged in, otherwise the IP.
+def get_usage_identity() -> str:
+    if session.get("logged_in"):
+        return f"user:{session.get('email')}"
+
+    return f"ip:{get_client_ip()}"
+
+
+# Returns the due date and invoice amount, from the billing summary saved in our DB unless refresh is set.
+async def get_customer_invoice(refresh: bool = False):
+    if not session.get("card_connected"):
+        return (None, None)
+
+    database = file_utils.get_async_database(server)
+    customer_id = await database.get_stripe_user_id(session.get("email"))
+    if not customer_id:
         return (None, None)
 
-    subscription = stripe.Subscription.retrieve(subscription_id)
+    summary = await billing.get_billing_summaries(server).get(customer_id, refresh)
 
-    # Retrieve upcoming invoice
-    upcoming_invoice = stripe.Invoice.upcoming(subscription=subscription_id)
+    if not summary["subscription_id"] or summary["current_period_end"] is None:
+        return (None, None)
 
     # Calculate the next charge date based on the current period end date
-    current_period_end = subscription.current_period_end
-    next_charge_date = datetime.fromtimestamp(current_period_end)
+    next_charge_date = datetime.fromtimestamp(summary["current_period_end"])
 
     # Format the next charge date
     next_charge_date_str = next_charge_date.strftime("%m/%d/%Y")
 
-    return (next_charge_date_str, upcoming_invoice.amount_due)
+    return (next_charge_date_str, summary["amount_due"])
 
 
 async def upload_file(request: Request):
@@ -198,14 +400,23 @@ async def upload_file(request: Request):
     if not file or not allowed_file(file.filename):
         return jsonify({"success": False, "error_type": "file_denied"})
 
+    # Count the document against the account's daily quota before doing any work on it.
+    usage_meter = usage_metering.get_usage_meter(server)
+    if not await async_io.run_io(usage_meter.count, "documents", get_acount_type(), get_usage_identity()):
+        return jsonify({"success": False, "error_type": "quota_exceeded"})
+
     file_extension = file_utils.get_file_extension(file.filename)
 
     number_of_pages = -1
+    page_hashes = []
+    # Parsing the document blocks, do it in the I/O threads.
     match file_extension:
         case "pdf":
-            number_of_pages = document_processing.get_pdf_pages(file)
+            page_hashes = await async_io.run_io(document_processing.get_pdf_page_hashes, file)
+            number_of_pages = len(page_hashes)
         case "pptx":
-            number_of_pages = document_processing.get_pptx_pages(file)
+            page_hashes = await async_io.run_io(document_processing.get_pptx_page_hashes, file)
+            number_of_pages = len(page_hashes)
         case _:
             None
 
@@ -225,43 +436,40 @@ async def upload_file(request: Request):
         "User uploaded document: {}".format(file.filename),
         file=sys.stderr,
     )
-    # Create /file-upload directory if it doesn't exist.
-    if not os.path.exists(server.config["UPLOAD_FOLDER"]):
-        os.makedirs(server.config["UPLOAD_FOLDER"])
-
-    # Create /file-metadata directory if it doesn't exist.
-    if not os.path.exists(server.config["METADATA_FOLDER"]):
-        os.makedirs(server.config["METADATA_FOLDER"])
-
+    file.stream.seek(0)
     file_contents = file.stream.read()
     # Compute the MD5 hash of the contents
-    md5_name = hashlib.md5(file_contents).hexdigest()
+    md5_name = await async_io.run_io(lambda: hashlib.md5(file_contents).hexdigest())
     filename = secure_filename(file.filename).replace(f".{file_extension}", "")
 
     file.filename = f"{md5_name}.{file_extension}"
 
-    # Save the file's metadata to the filesystem
+    # Save the file's metadata to the database
     # TODO: Save IP of user who uploaded.
-    metadata_file_path = os.path.join(server.config["METADATA_FOLDER"], f"{md5_name}.json")
-    if not os.path.exists(metadata_file_path):
-        metadata = {
-            "file_name": filename,
-            "md5_name": md5_name,
-            "page_count": number_of_pages,
-            "extension_type": file_extension,
-        }
-
-        with open(metadata_file_path, "w") as metadata_file:
-            json.dump(metadata, metadata_file)
+    metadata = {
+        "file_name": filename,
+        "md5_name": md5_name,
+        "page_count": number_of_pages,
+        "extension_type": file_extension,
+        "page_hashes": page_hashes,
+    }
+    await file_utils.get_async_database(server).add_file_metadata(metadata)
+    if session.get("logged_in"):
+        # Keep the document in the user's library, so it's there on any device.
+        await file_utils.get_async_database(server).add_user_document(session.get("email"), md5_name, filename)
 
-    # Update the metadata variable to get all metadata values from the file ()
-    metadata = file_utils.get_file_json(metadata_file_path)
+    # Get all metadata values from the database, the file might have been uploaded & converted before.
+    metadata = await file_utils.get_async_database(server).get_file_metadata(md5_name)
+    # The page hashes are only used server-side.
+    del metadata["page_hashes"]
 
     # Release the pointer that reads the file so we can save it properly
     file.stream.seek(0)
 
     # FIXME: Check if file already exists, if so dont bother saving it again.
-    await file.save(os.path.join(server.config["UPLOAD_FOLDER"], file.filename))
+    upload_path = await async_io.run_io(get_blob_store(server).get_write_path, "upload", file.filename)
+    await file.save(upload_path)
+    await async_io.run_io(get_blob_store(server).publish, "upload", file.filename)
 
     return (
         jsonify({"success": True, "metadata": metadata}),
@@ -275,7 +483,7 @@ async def home():
     if request.method == "POST":
         return await upload_file(request)
 
-    return await render_template("index.html", last_updated=file_utils.dir_last_updated("./src/static"))
+    return await render_template("index.html")
 
 
 # @server.errorhandler(404)
@@ -296,23 +504,22 @@ async def register():
         if password != confirm_password:
             return await render_template(
                 "register.html",
-                last_updated=file_utils.dir_last_updated("./src/static"),
                 error_msg="Passwords do not match",
             )
 
-        database = DBManager(pass_file="/run/secrets/db-password")
-        response, error_msg = database.add_user(email, password)
+        password_hash = await passwords.get_password_hasher(server).hash(password)
+        database = file_utils.get_async_database(server)
+        response, error_msg = await database.add_user(email, password_hash)
 
         if response != 0:
             return await render_template(
                 "register.html",
-                last_updated=file_utils.dir_last_updated("./src/static"),
                 error_msg=error_msg,
             )
 
         return redirect(url_for("login"))
 
-    return await render_template("register.html", last_updated=file_utils.dir_last_updated("./src/static"))
+    return await render_template("register.html")
 
 
 @server.route("/login", methods=["GET", "POST"])
@@ -328,10 +535,17 @@ async def login():
             return redirect("/")
 
         # Check if the email and password match a user in the database
-        database = DBManager(pass_file="/run/secrets/db-password")
-        db_user_obj, error_msg = database.get_user(email, password)
+        database = file_utils.get_async_database(server)
+        db_user_obj, error_msg = await database.get_user(email)
         # print(db_user_obj, file=sys.stderr)
 
+        password_hasher = passwords.get_password_hasher(server)
+        if db_user_obj and not await password_hasher.verify(password, db_user_obj.password, db_user_obj.salt):
+            db_user_obj, error_msg = (None, "Invalid email or password")  # Password is incorrect
+
+        if db_user_obj and password_hasher.needs_rehash(db_user_obj.password):
+            await database.set_user_password(email, await password_hasher.hash(password))
+
         if db_user_obj:
             print(db_user_obj, file=sys.stderr)
             session["logged_in"] = True
@@ -343,10 +557,9 @@ async def login():
             # User doesn't exist or password is incorrect
             return await render_template(
                 "login.html",
-                last_updated=file_utils.dir_last_updated("./src/static"),
                 error_msg=error_msg,
             )
-    return await render_template("login.html", last_updated=file_utils.dir_last_updated("./src/static"))
+    return await render_template("login.html")
 
 
 @server.route("/logout", methods=["POST"])
@@ -365,12 +578,10 @@ async def profile():
     if not session.get("logged_in"):
         return redirect(url_for("login"))
 
-    # FIXME: get_customer_invoice() is slow, use cache w/ session.() and talk to our DB.
-    charge_date, amount = get_customer_invoice()
+    charge_date, amount = await get_customer_invoice()
 
     return await render_template(
         "profile.html",
-        last_updated=file_utils.dir_last_updated("./src/static"),
         charge_date=charge_date,
         amount=amount,
     )
@@ -388,15 +599,15 @@ async def handle_checkout_session():
     # Retrieve the setup intent
     setup_intent = stripe.SetupIntent.retrieve(checkout_session.setup_intent)
 
-    database = DBManager(pass_file="/run/secrets/db-password")
+    database = file_utils.get_async_database(server)
 
     customer = None
 
     # Create/fetch stripe customer
-    stripe_user_id = database.get_stripe_user_id(session.get("email"))
+    stripe_user_id = await database.get_stripe_user_id(session.get("email"))
     if not stripe_user_id:
         customer = stripe.Customer.create(email=session.get("email"), description="From PDF2Flashcards backend")
-        database.add_stripe_customer(customer)
+        await database.add_stripe_customer(customer)
         stripe_user_id = customer.id
     else:
         customer = stripe.Customer.retrieve(stripe_user_id)
@@ -446,10 +657,10 @@ async def handle_checkout_session():
         subscription_item_id = subscription["items"]["data"][0]["id"]
 
         # Assign the subscription_id and subscription_item_id to our stripe_users table
-        database.assign_user_subscriptions(stripe_user_id, subscription.id, subscription_item_id)
+        await database.assign_user_subscriptions(stripe_user_id, subscription.id, subscription_item_id)
 
     # Update users table & set card_connected to True
-    database.set_card_connected(session.get("email"), True)
+    await database.set_card_connected(session.get("email"), True)
     session["card_connected"] = True
 
     # Go back to user profile
@@ -474,20 +685,19 @@ async def create_checkout_session():
 async def add_payment():
     return await render_template(
         "add-payment.html",
-        last_updated=file_utils.dir_last_updated("./src/static"),
         stripe_pk=stripe_keys["public"],
     )
 
 
 @server.route("/remove-payment", methods=["POST"])
 async def remove_payment():
-    database = DBManager(pass_file="/run/secrets/db-password")
-    customer_id = database.get_stripe_user_id(session.get("email"))
+    database = file_utils.get_async_database(server)
+    customer_id = await database.get_stripe_user_id(session.get("email"))
     payment_method_json = stripe.Customer.list_payment_methods(customer_id, limit=1)
     payment_id = payment_method_json["data"][0]["id"]
 
-    # Charge the stripe customer if they have a balance > 0.5
-    _, amount = get_customer_invoice()
+    # Charge the stripe customer if they have a balance > 0.5, with the amount as stripe has it right now.
+    _, amount = await get_customer_invoice(refresh=True)
     # print(f"Amount: {amount}")
     if amount >= 50:
         intent = stripe.PaymentIntent.create(
@@ -502,11 +712,11 @@ async def remove_payment():
         print(payment_result, file=sys.stderr)
 
     # Cancel the subscription & detach the card from the customer.
-    stripe.Subscription.cancel(database.get_user_subscription_id(customer_id))
+    stripe.Subscription.cancel(await database.get_user_subscription_id(customer_id))
     stripe.PaymentMethod.detach(payment_id)
 
     # Set our card connected to false.
-    database.run_query(f"UPDATE users SET card_connected = 0 WHERE email='{session.get('email')}'")
+    await database.set_card_connected(session.get("email"), False)
     session["card_connected"] = False
 
     return jsonify({"success": True, "return_url": return_url})
@@ -515,8 +725,8 @@ async def remove_payment():
 @server.route("/manage-payment", methods=["GET"])
 async def manage_payment():
     # Get user card from stripe
-    database = DBManager(pass_file="/run/secrets/db-password")
-    customer_id = database.get_stripe_user_id(session.get("email"))
+    database = file_utils.get_async_database(server)
+    customer_id = await database.get_stripe_user_id(session.get("email"))
 
     if not customer_id:
         return redirect(url_for("profile"))
@@ -527,11 +737,10 @@ async def manage_payment():
         return redirect(url_for("profile"))
 
     customer_card = payment_method_json["data"][0]["card"]
-    _, amount_due = get_customer_invoice()
+    _, amount_due = await get_customer_invoice()
 
     return await render_template(
         "manage-payment.html",
-        last_updated=file_utils.dir_last_updated("./src/static"),
         stripe_pk=stripe_keys["public"],
         customer_card=customer_card,
         amount_due=amount_due,
@@ -542,42 +751,145 @@ async def manage_payment():
 async def help():
     return await render_template(
         "help.html",
-        last_updated=file_utils.dir_last_updated("./src/static"),
         support_email=server.config["SUPPORT_EMAIL"],
     )
 
 
 @server.route("/flashcard_test", methods=["GET"])
 async def flashcard_test():
-    return await render_template("flashcard_test.html", last_updated=file_utils.dir_last_updated("./src/static"))
+    return await render_template("flashcard_test.html")
 
 
 @server.route("/flashcard", methods=["GET"])
 async def flashcard():
-    return await render_template("flashcard.html", last_updated=file_utils.dir_last_updated("./src/static"))
+    return await render_template("flashcard.html")
 
 
 @server.route("/prompt", methods=["GET"])
 async def prompt():
-    return await render_template("prompt.html", last_updated=file_utils.dir_last_updated("./src/static"))
+    return await render_template("prompt.html")
+
+
+# Get a fingerprinted static file, these never change so browsers can cache them forever.
+@server.route("/assets/<path:filename>", methods=["GET"])
+async def get_static_asset(filename):
+    real_path = asset_manifest.resolve(filename)
+    if real_path is None:
+        # Relative URLs inside stylesheets (e.g. ../img/...) aren't fingerprinted, serve those as regular static files.
+        return await send_from_directory(server.static_folder, filename)
+
+    response = await send_from_directory(server.static_folder, real_path)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
 
 
 # Get the Q&A set of the associated file.
 @server.route("/pdf-qa/<md5_name>", methods=["GET"])
 def get_pdf_qa(md5_name):
-    with open(f'{server.config["PROCESSED_FOLDER"]}/{md5_name}.json', "r") as file:
-        return json.load(file)["qa_set"]
+    qa_set = processed_results.get_processed_result(server, md5_name, "qa_set")
+    if qa_set is None:
+        abort(404, f"No Q&A set for {md5_name}")
+    return qa_set
+
+
+# Get the hit rate & size of the processed results cache.
+@server.route("/metrics/result-cache", methods=["GET"])
+def get_result_cache_metrics():
+    if not is_admin():
+        abort(403)
+    return jsonify(result_cache.get_result_cache(server).get_stats())
+
+
+# Get the usage & wait times of the database connection pool.
+@server.route("/metrics/db-pool", methods=["GET"])
+def get_db_pool_metrics():
+    if not is_admin():
+        abort(403)
+    return jsonify(file_utils.get_db_pool(server).get_stats())
+
+
+# Get how long the event loop was blocked, by code that should have been run in the I/O threads.
+@server.route("/metrics/event-loop", methods=["GET"])
+def get_event_loop_metrics():
+    if not is_admin():
+        abort(403)
+    return jsonify(async_io.get_loop_stall_monitor(server).get_stats())
+
+
+# Get how often entitlement checks were answered by Redis without a database query.
+@server.route("/metrics/entitlements", methods=["GET"])
+def get_entitlement_metrics():
+    if not is_admin():
+        abort(403)
+    return jsonify(entitlements.get_entitlement_cache(server).get_stats())
+
+
+# Stripe sends billing events here, they refresh the customer's billing summary.
+@server.route("/stripe-webhook", methods=["POST"])
+async def stripe_webhook():
+    webhook_secret = stripe_keys.get("webhook_secret")
+    if not webhook_secret:
+        return jsonify({"error": "Stripe webhooks aren't configured"}), 503
+
+    payload = await request.get_data()
+    try:
+        event = stripe.Webhook.construct_event(payload, request.headers.get("Stripe-Signature"), webhook_secret)
+    except (ValueError, stripe.error.SignatureVerificationError):
+        return jsonify({"error": "Invalid stripe event"}), 400
+
+    await billing.get_billing_summaries(server).handle_event(event)
+    return jsonify({"received": True})
+
+
+# Get how many passwords were hashed & verified, and with what cost.
+@server.route("/metrics/passwords", methods=["GET"])
+def get_password_metrics():
+    if not is_admin():
+        abort(403)
+    return jsonify(passwords.get_password_hasher(server).get_stats())
+
+
+# Get how often billing summaries were served from our DB instead of stripe.
+@server.route("/metrics/billing", methods=["GET"])
+def get_billing_metrics():
+    if not is_admin():
+        abort(403)
+    return jsonify(billing.get_billing_summaries(server).get_stats())
+
+
+# Get how many requests the daily quotas let through & denied.
+@server.route("/metrics/usage", methods=["GET"])
+def get_usage_metrics():
+    if not is_admin():
+        abort(403)
+    return jsonify(usage_metering.get_usage_meter(server).get_stats())
+
+
+# Get how much usage was reported to stripe & how much is still queued.
+@server.route("/metrics/usage-reporting", methods=["GET"])
+def get_usage_reporting_metrics():
+    if not is_admin():
+        abort(403)
+    return jsonify(usage_reporting.get_usage_reporter(server).get_stats())
+
+
+# Get how much each data folder holds & how much the retention sweeps reclaimed.
+@server.route("/metrics/retention", methods=["GET"])
+def get_retention_metrics():
+    if not is_admin():
+        abort(403)
+    return jsonify(retention.get_retention_manager(server).get_stats())
 
 
 # Get the logs of the associated file.
 @server.route("/logs/<md5_name>", methods=["GET"])
 async def get_logs(md5_name):
-    with open(f'{server.config["LOG_FOLDER"]}/{md5_name}.txt', "r") as file:
-        return await render_template(
-            "log_info.html",
-            log_data=file.read(),
-            last_updated=file_utils.dir_last_updated("./src/static"),
-        )
+    log_path = await async_io.run_io(get_blob_store(server).fetch_artifact, "log", f"{md5_name}.txt")
+    log_data = await async_io.run_io(artifact_io.read_artifact_text, log_path)
+    return await render_template(
+        "log_info.html",
+        log_data=log_data,
+    )
 
 
 @server.route("/export-flashcard", methods=["GET"])
@@ -588,7 +900,6 @@ async def export_flashcard():
         "export-flashcard.html",
         filename=filename,
         md5_name=md5_name,
-        last_updated=file_utils.dir_last_updated("./src/static"),
     )
 
 
@@ -600,7 +911,6 @@ async def export_keyword():
         "export-keyword.html",
         filename=filename,
         md5_name=md5_name,
-        last_updated=file_utils.dir_last_updated("./src/static"),
     )
 
 
@@ -612,15 +922,14 @@ async def export_test():
         "export-test.html",
         filename=filename,
         md5_name=md5_name,
-        last_updated=file_utils.dir_last_updated("./src/static"),
     )
 
 
 # Get the export file of the associated <file> name.
 @server.route("/export/<file>", methods=["GET"])
 async def get_exported_document(file):
-    export_folder = server.config["EXPORT_FOLDER"]
-    file_path = f"{export_folder}/{file}"
+    file_path = await async_io.run_io(get_blob_store(server).fetch, "export", secure_filename(file))
+    await async_io.run_io(retention.touch, file_path)
     try:
         return await send_file(file_path, as_attachment=False)
     except FileNotFoundError:
@@ -681,30 +990,40 @@ def get_convert_file():
     print(f"Convertfile GET - Get {conversion_type} of {filename}", file=sys.stderr)
 
     if filename and md5_name and conversion_type:
-        file_path = f'{server.config["PROCESSED_FOLDER"]}/{md5_name}.json'
+        file_path = processed_results.get_result_path(server, md5_name, conversion_type)
+        retention.record_access(server, md5_name)
         try:
-            with open(file_path, "r") as file:
-                data = json.load(file)
-
-                if conversion_type in data:
-                    data = data[conversion_type]["data"]
-                    data_length = len(data)
-
-                    # Limit the number of data (flashcards, sets, test questions) if needed
-                    # if user_data_limit != -1:
-                    #    data = data[:user_data_limit]
-
-                    return jsonify({"data": data, "data_length": data_length})
-                else:
-                    return (
-                        jsonify(
-                            {
-                                "error": f"Conversion type '{conversion_type}' not found",
-                                "error_type": "no_conversion",
-                            }
-                        ),
-                        400,
+            # Optional paging, the client can request limit items starting at offset.
+            offset = max(request.args.get("offset", 0, type=int), 0)
+            limit = request.args.get("limit", None, type=int)
+
+            if limit is None and user_data_limit == -1 and offset == 0 and "gzip" in request.accept_encodings:
+                # The whole result is stored as a gzip compressed response, send it as is.
+                stored_result = processed_results.read_stored_result(server, md5_name, conversion_type)
+                if stored_result is not None:
+                    return Response(
+                        stored_result,
+                        mimetype="application/json",
+                        headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
                     )
+
+            # Limit the number of data (flashcards, sets, test questions) if needed
+            response = processed_results.read_result_response(
+                server, md5_name, conversion_type, offset, limit, user_data_limit
+            )
+
+            if response is not None:
+                return jsonify(response)
+            else:
+                return (
+                    jsonify(
+                        {
+                            "error": f"Conversion type '{conversion_type}' not found",
+                            "error_type": "no_conversion",
+                        }
+                    ),
+                    400,
+                )
         except FileNotFoundError:
             return jsonify({"error": f"File '{file_path}' not found", "error_type": "no_file"}), 404
         except Exception as e:
@@ -729,10 +1048,21 @@ async def post_unlock_file():
     # TODO: Have the client send a preview of how much the user sees they are paying. If our backend cost doesn't match. Stop here.
 
     # FIXME: Do a keycheck here.
-    data_length = file_utils.get_file_metadata(server, md5_name, "data_lengths")[convert_type]
-
-    database = DBManager(pass_file="/run/secrets/db-password")
-    database.pay_for_file(session.get("email"), md5_name, convert_type, data_length)
+    database = file_utils.get_async_database(server)
+    data_length = (await database.get_file_metadata(md5_name))["data_lengths"][convert_type]
+
+    # The usage is reported to stripe in the background, see usage_reporting.
+    await database.pay_for_file(session.get("email"), md5_name, convert_type, data_length, FREE_ITEM_LIMIT)
+    if not await async_io.run_io(entitlements.get_entitlement_cache(server).invalidate, session.get("email")):
+        return (
+            jsonify(
+                {
+                    "error": "Your payment was saved, but the unlocked results may take up to an hour to show.",
+                    "error_type": "entitlements_unavailable",
+                }
+            ),
+            503,
+        )
 
     # FIXME: Should we return anything?
     return {}
@@ -749,6 +1079,10 @@ async def post_convert_file():
         print("*** CONVERSION OPTIONS: ***", file=sys.stderr)
         print(conversion_options, file=sys.stderr)
 
+        usage_meter = usage_metering.get_usage_meter(server)
+        if not await async_io.run_io(usage_meter.count, "conversions", get_acount_type(), get_usage_identity()):
+            return jsonify({"error": "Daily conversion limit reached", "error_type": "quota_exceeded"}), 429
+
         # Generate a unique task ID, set it as processing
         task_id = str(uuid.uuid4())
         set_task_status(task_id, "processing")
@@ -757,7 +1091,15 @@ async def post_convert_file():
 
         print(f"*** Converting {filename} to {convert_type} ***", file=sys.stderr)
 
-        extension_type: str = file_utils.get_file_metadata(server, md5_name, "extension_type")
+        await async_io.run_io(retention.record_access, server, md5_name)
+        metadata = await file_utils.get_async_database(server).get_file_metadata(md5_name)
+        extension_type: str = metadata["extension_type"] if metadata else None
+        if convert_type != "text" and session.get("logged_in") and metadata:
+            # The document might have been uploaded before the user logged in.
+            database = file_utils.get_async_database(server)
+            await database.add_user_document(session.get("email"), md5_name, metadata["file_name"])
+            await database.add_user_document_conversion(session.get("email"), md5_name, convert_type)
+
         if convert_type == "text":
             server.add_background_task(
                 document_processing.async_document2json,
@@ -767,6 +1109,8 @@ async def post_convert_file():
                 extension_type,
                 task_id,
                 request.remote_addr,
+                # Processing the document's text is what processes its pages.
+                session.get("email") if session.get("logged_in") else None,
             )
         elif convert_type in ["flashcards", "keywords", "test"]:
             server.add_background_task(
@@ -791,11 +1135,55 @@ async def post_convert_file():
         return {"error:": error_message}
 
 
+# Get a page of the user's document library, newest first. Pass the returned next_cursor as cursor for the next page.
+@server.route("/documents", methods=["GET"])
+async def get_documents():
+    if not session.get("logged_in"):
+        return jsonify({"error": "Not logged in", "error_type": "not_logged_in"}), 401
+
+    limit = request.args.get("limit", server.config["DOCUMENTS_PAGE_SIZE"], type=int)
+    limit = min(max(limit, 1), server.config["DOCUMENTS_MAX_PAGE_SIZE"])
+    cursor = request.args.get("cursor", None, type=int)
+
+    documents = await file_utils.get_async_database(server).get_user_documents(session.get("email"), cursor, limit)
+
+    return jsonify(
+        {
+            "documents": documents,
+            "next_cursor": documents[-1]["id"] if len(documents) >= limit else None,
+        }
+    )
+
+
+# Search the generated items of the user's documents, best match first. Items the user would have to pay to see are
+# left out.
+@server.route("/search", methods=["GET"])
+async def search():
+    if not session.get("logged_in"):
+        return jsonify({"error": "Not logged in", "error_type": "not_logged_in"}), 401
+
+    query = request.args.get("q", "")
+    limit = min(max(request.args.get("limit", 20, type=int), 1), server.config["SEARCH_MAX_HITS"])
+    start = time.perf_counter()
+
+    document_results, paid_results = await asyncio.gather(
+        file_utils.get_async_database(server).get_user_document_results(session.get("email")),
+        async_io.run_io(entitlements.get_entitlement_cache(server).get_paid_results, session.get("email")),
+    )
+    index = search_index.get_search_index(server)
+    # The index is per node, results another node generated are indexed here on their first search.
+    await async_io.run_io(index.index_results, server, document_results)
+    hits = await async_io.run_io(
+        index.search, query, list(document_results), FREE_ITEM_LIMIT, list(paid_results), limit
+    )
+
+    return jsonify({"hits": hits, "took_ms": (time.perf_counter() - start) * 1000})
+
+
 @server.route("/results", methods=["GET"])
 async def results():
     return await render_template(
         "results.html",
-        last_updated=file_utils.dir_last_updated("./src/static"),
         single_item_cost=server.config["SINGLE_ITEM_COST"],
     )
 
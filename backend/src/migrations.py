@@ -0,0 +1,273 @@
+import sys
+from .database import DBConnectionPool, DBManager
+
+# (version, description, statements). Applied in order, each version once, recorded in schema_migrations. Add new
+# migrations to the end & never edit one that was released. MySQL commits DDL statements one by one, so a migration
+# that failed halfway is run again from the start: keep every statement safe to repeat (IF NOT EXISTS).
+# Index statements use MariaDB's IF NOT EXISTS, databases created from dump.sql already have some of these tables.
+MIGRATIONS = [
+    (
+        1,
+        "Create users & stripe_users",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id INT NOT NULL AUTO_INCREMENT,
+                email VARCHAR(255) DEFAULT NULL,
+                password VARCHAR(255) NOT NULL,
+                salt BINARY(16) DEFAULT NULL,
+                card_connected TINYINT(1) NOT NULL,
+                stripe_user_id VARCHAR(255) DEFAULT NULL,
+                pages_processed INT DEFAULT 0,
+                PRIMARY KEY (id),
+                KEY stripe_user_id (stripe_user_id)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS stripe_users (
+                id INT NOT NULL AUTO_INCREMENT,
+                user_id VARCHAR(255) DEFAULT NULL,
+                email VARCHAR(255) DEFAULT NULL,
+                created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                name VARCHAR(255) DEFAULT NULL,
+                delinquent TINYINT(1) DEFAULT NULL,
+                currency VARCHAR(3) DEFAULT NULL,
+                default_source VARCHAR(255) DEFAULT NULL,
+                livemode TINYINT(1) DEFAULT NULL,
+                subscription_item_id VARCHAR(255) DEFAULT NULL,
+                subscription_id VARCHAR(255) DEFAULT NULL,
+                PRIMARY KEY (id),
+                KEY user_id (user_id)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            """,
+        ],
+    ),
+    (
+        2,
+        "Create paid_files & paid_files_jt",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS paid_files (
+                file_id INT NOT NULL AUTO_INCREMENT,
+                md5_name CHAR(32) NOT NULL,
+                conversion_type VARCHAR(32) NOT NULL,
+                data_length INT NOT NULL DEFAULT 0,
+                paid TINYINT(1) NOT NULL DEFAULT 1,
+                PRIMARY KEY (file_id)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS paid_files_jt (
+                user_id INT NOT NULL,
+                file_id INT NOT NULL
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            """,
+        ],
+    ),
+    (
+        3,
+        "Create file_metadata",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS file_metadata (
+                md5_name CHAR(32) NOT NULL,
+                file_name VARCHAR(255) DEFAULT NULL,
+                page_count INT DEFAULT NULL,
+                extension_type VARCHAR(16) DEFAULT NULL,
+                page_hashes LONGTEXT DEFAULT NULL,
+                data_lengths LONGTEXT DEFAULT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                PRIMARY KEY (md5_name),
+                KEY extension_type (extension_type),
+                KEY created_at (created_at),
+                KEY updated_at (updated_at)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            """,
+        ],
+    ),
+    (
+        4,
+        "Index the columns users & paid files are looked up by",
+        [
+            # get_user, get_db_user_id, get_stripe_user_id & add_user look users up by email. Not unique, databases may
+            # have duplicate emails from before, enforce_unique_emails makes it unique once they're merged.
+            "ALTER TABLE users ADD INDEX IF NOT EXISTS email (email)",
+            # user_has_paid_file & retention look paid files up by file.
+            "ALTER TABLE paid_files ADD INDEX IF NOT EXISTS md5_name_conversion_type (md5_name, conversion_type)",
+            # The join table is walked both ways: a user's files, and the users of a file.
+            "ALTER TABLE paid_files_jt ADD INDEX IF NOT EXISTS user_id_file_id (user_id, file_id)",
+            "ALTER TABLE paid_files_jt ADD INDEX IF NOT EXISTS file_id_user_id (file_id, user_id)",
+        ],
+    ),
+    (
+        5,
+        "Create usage_outbox",
+        [
+            # Usage waiting to be reported to stripe. Rows are grouped into batches when first reported, each batch is
+            # one usage record & its batch_id the idempotency key, so retries never count usage twice.
+            """
+            CREATE TABLE IF NOT EXISTS usage_outbox (
+                id BIGINT NOT NULL AUTO_INCREMENT,
+                subscription_item_id VARCHAR(255) NOT NULL,
+                quantity INT NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                batch_id CHAR(32) DEFAULT NULL,
+                attempts INT NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                last_error TEXT DEFAULT NULL,
+                reported_at TIMESTAMP NULL DEFAULT NULL,
+                PRIMARY KEY (id),
+                KEY reported_at_batch_id (reported_at, batch_id),
+                KEY batch_id (batch_id)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            """,
+        ],
+    ),
+    (
+        6,
+        "Create billing_summaries",
+        [
+            # Each customer's next charge date & upcoming invoice amount, as last read from stripe.
+            """
+            CREATE TABLE IF NOT EXISTS billing_summaries (
+                stripe_user_id VARCHAR(255) NOT NULL,
+                subscription_id VARCHAR(255) DEFAULT NULL,
+                current_period_end BIGINT DEFAULT NULL,
+                amount_due INT DEFAULT NULL,
+                stale TINYINT(1) NOT NULL DEFAULT 0,
+                refreshed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (stripe_user_id),
+                KEY stale_refreshed_at (stale, refreshed_at)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            """,
+        ],
+    ),
+    (
+        7,
+        "Create user_documents",
+        [
+            # Each user's document library. Listed newest first a page at a time, by (user_id, id) keyset.
+            """
+            CREATE TABLE IF NOT EXISTS user_documents (
+                id BIGINT NOT NULL AUTO_INCREMENT,
+                user_id INT NOT NULL,
+                md5_name CHAR(32) NOT NULL,
+                file_name VARCHAR(255) DEFAULT NULL,
+                conversion_types LONGTEXT DEFAULT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id),
+                UNIQUE KEY user_id_md5_name (user_id, md5_name),
+                KEY user_id_id (user_id, id)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            """,
+        ],
+    ),
+    (
+        8,
+        "Fix usage batch timestamps & dead-letter failing batches",
+        [
+            # The timestamp a batch is reported with, set at its first attempt & reused by its retries.
+            "ALTER TABLE usage_outbox ADD COLUMN IF NOT EXISTS report_timestamp BIGINT DEFAULT NULL",
+            # Set when a batch gave up, it isn't retried until an operator clears it.
+            "ALTER TABLE usage_outbox ADD COLUMN IF NOT EXISTS failed_at TIMESTAMP NULL DEFAULT NULL",
+        ],
+    ),
+    (
+        9,
+        "Track when billing summaries were last viewed",
+        [
+            # The reconciler only refreshes the summaries of customers who viewed theirs recently.
+            "ALTER TABLE billing_summaries "
+            "ADD COLUMN IF NOT EXISTS viewed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP",
+        ],
+    ),
+]
+MIGRATIONS_LOCK_TIMEOUT = 60  # Seconds to wait for another backend node that is migrating the database.
+
+
+def enforce_unique_emails(pool: DBConnectionPool) -> bool:
+    """
+    Adds a unique index on users.email unless there is one, so concurrent sign ups can't create the same user twice.
+    Emails used by several users are reported instead, the index is added at the first start after they're merged.
+    Returns whether emails are unique.
+    """
+    with DBManager(pool) as database:
+        cursor = database.cursor
+        cursor.execute(
+            """
+            SELECT COUNT(*)
+            FROM information_schema.statistics s
+            WHERE s.table_schema = DATABASE() AND s.table_name = 'users' AND s.non_unique = 0
+                AND s.column_name = 'email'
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM information_schema.statistics other
+                    WHERE other.table_schema = s.table_schema AND other.table_name = s.table_name
+                        AND other.index_name = s.index_name AND other.column_name != 'email'
+                )
+            """
+        )
+        if cursor.fetchone()[0] > 0:
+            return True
+
+        cursor.execute("SELECT email, COUNT(*) FROM users GROUP BY email HAVING COUNT(*) > 1")
+        duplicates = cursor.fetchall()
+        if len(duplicates) > 0:
+            emails = ", ".join(f"{email} ({count} users)" for email, count in duplicates)
+            print(f"users.email isn't unique until these users are merged: {emails}", file=sys.stderr)
+            return False
+
+        try:
+            cursor.execute("ALTER TABLE users ADD UNIQUE INDEX IF NOT EXISTS email_unique (email)")
+        except Exception as e:
+            # A duplicate signed up since the check, reported at the next start.
+            print(f"Couldn't make users.email unique: {e}", file=sys.stderr)
+            return False
+        # The unique index serves the lookups too.
+        cursor.execute("ALTER TABLE users DROP INDEX IF EXISTS email")
+        return True
+
+
+def run_migrations(pool: DBConnectionPool, target_version: int | None = None) -> int:
+    """
+    Applies the migrations the database doesn't have yet, up to target_version (default all). Backend nodes starting
+    at the same time take turns through a named lock. Returns the version of the database.
+    """
+    with DBManager(pool) as database:
+        cursor = database.cursor
+        cursor.execute("SELECT GET_LOCK('schema_migrations', %s)", (MIGRATIONS_LOCK_TIMEOUT,))
+        if cursor.fetchone()[0] != 1:
+            raise TimeoutError(f"Another node held the migrations lock for over {MIGRATIONS_LOCK_TIMEOUT}s")
+
+        try:
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT NOT NULL,
+                    description VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (version)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+                """
+            )
+            cursor.execute("SELECT version FROM schema_migrations")
+            applied_versions = {row[0] for row in cursor.fetchall()}
+
+            for version, description, statements in MIGRATIONS:
+                if version in applied_versions or (target_version is not None and version > target_version):
+                    continue
+
+                print(f"Applying database migration {version}: {description}", file=sys.stderr)
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (version, description)
+                )
+                database.connection.commit()
+                applied_versions.add(version)
+
+            return max(applied_versions, default=0)
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK('schema_migrations')")
+            cursor.fetchone()
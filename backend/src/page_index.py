@@ -0,0 +1,42 @@
+import json
+from quart import Quart
+from .blob_store import get_blob_store
+
+
+def record_page_hashes(server: Quart, md5_name: str, page_hashes: list[str]):
+    """
+    Records which document & page each page hash was extracted from, so later revisions of the document can reuse it.
+    The first document extracted with a page keeps it.
+    """
+    store = get_blob_store(server)
+
+    for index, page_hash in enumerate(page_hashes):
+        if store.exists("page-index", f"{page_hash}.json"):
+            continue
+
+        prior_page = {"md5_name": md5_name, "page_number": index + 1}
+        store.write("page-index", f"{page_hash}.json", json.dumps(prior_page).encode("utf-8"))
+
+
+def find_prior_pages(server: Quart, md5_name: str, page_hashes: list[str]) -> dict[int, tuple[str, int]]:
+    """
+    Returns {page_number: (prior_md5_name, prior_page_number)} for each page of the document that was already
+    extracted as part of another document.
+    """
+    store = get_blob_store(server)
+    prior_pages = {}
+
+    for index, page_hash in enumerate(page_hashes):
+        prior_page_data = store.read("page-index", f"{page_hash}.json")
+        if prior_page_data is None:
+            continue
+
+        prior_page = json.loads(prior_page_data)
+
+        # Only reuse pages from other documents that still have their extracted JSON.
+        if prior_page["md5_name"] == md5_name or not store.artifact_exists("json", f'{prior_page["md5_name"]}.json'):
+            continue
+
+        prior_pages[index + 1] = (prior_page["md5_name"], prior_page["page_number"])
+
+    return prior_pages
@@ -0,0 +1,111 @@
+import os
+import hmac
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from quart import Quart
+
+ALGORITHM = "pbkdf2_sha256"
+SALT_BYTES = 16
+# Passwords saved before hashes carried their parameters: the hex digest in users.password, the salt in users.salt.
+LEGACY_ITERATIONS = 100000
+
+
+def hash_password(password: str, iterations: int) -> str:
+    """
+    Returns "pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>", everything needed to verify the password later.
+    """
+    salt = os.urandom(SALT_BYTES)
+    password_hash = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return f"{ALGORITHM}${iterations}${salt.hex()}${password_hash.hex()}"
+
+
+def parse_password_hash(stored_hash: str, legacy_salt: bytes | None) -> tuple[str, int, bytes, str]:
+    """
+    Returns (algorithm, iterations, salt, hash hex) of a saved password.
+    """
+    if "$" not in stored_hash:
+        return (ALGORITHM, LEGACY_ITERATIONS, legacy_salt or b"", stored_hash)
+
+    algorithm, iterations, salt, password_hash = stored_hash.split("$")
+    return (algorithm, int(iterations), bytes.fromhex(salt), password_hash)
+
+
+def verify_password(password: str, stored_hash: str, legacy_salt: bytes | None = None) -> bool:
+    algorithm, iterations, salt, password_hash = parse_password_hash(stored_hash, legacy_salt)
+    if algorithm != ALGORITHM:
+        return False
+
+    entered_hash = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations).hex()
+    return hmac.compare_digest(entered_hash, password_hash)
+
+
+def needs_rehash(stored_hash: str, iterations: int) -> bool:
+    """
+    Returns whether the password was saved with older parameters than the current ones.
+    """
+    if "$" not in stored_hash:
+        return True
+
+    algorithm, stored_iterations, _, _ = parse_password_hash(stored_hash, None)
+    return algorithm != ALGORITHM or stored_iterations < iterations
+
+
+class PasswordHasher:
+    """
+    Hashes & verifies passwords in threads of their own, one per core. Each hash takes around 100ms of CPU, run on the
+    event loop a burst of logins would stall every other request. hashlib releases the GIL while hashing, so the
+    threads use all cores.
+
+    New hashes use server.config["PASSWORD_HASH_ITERATIONS"]. Raising it only affects new hashes, users' hashes are
+    upgraded the next time they log in (see needs_rehash).
+    """
+
+    def __init__(self, iterations: int, threads: int):
+        self.iterations = iterations
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="password")
+        self.hashes = 0
+        self.verifications = 0
+        self.lock = threading.Lock()
+
+    async def hash(self, password: str) -> str:
+        with self.lock:
+            self.hashes += 1
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, hash_password, password, self.iterations
+        )
+
+    async def verify(self, password: str, stored_hash: str, legacy_salt: bytes | None = None) -> bool:
+        with self.lock:
+            self.verifications += 1
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, verify_password, password, stored_hash, legacy_salt
+        )
+
+    def needs_rehash(self, stored_hash: str) -> bool:
+        return needs_rehash(stored_hash, self.iterations)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "hashes": self.hashes,
+                "verifications": self.verifications,
+                "iterations": self.iterations,
+                "threads": self.threads,
+            }
+
+
+password_hasher: PasswordHasher | None = None
+
+
+def get_password_hasher(server: Quart) -> PasswordHasher:
+    global password_hasher
+
+    if password_hasher is None:
+        password_hasher = PasswordHasher(
+            server.config["PASSWORD_HASH_ITERATIONS"], server.config["PASSWORD_HASH_THREADS"]
+        )
+
+    return password_hasher
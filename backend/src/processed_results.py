@@ -0,0 +1,268 @@
+import os
+import json
+import uuid
+import struct
+from quart import Quart
+from . import artifact_io
+from .blob_store import get_blob_store
+from .result_cache import get_result_cache
+
+# Each result is stored gzip compressed, decompressed it's the full /convertfile/ response for the conversion type:
+# {"data": [...], "data_length": ..., "offset": 0, "next_offset": null}. The items of "data" are compressed in blocks
+# of ITEMS_PER_BLOCK, and the index holds where every block & item is, so a page of items can be decompressed without
+# the rest of the file. The index header holds the size of the result file it was written for, so a mismatched pair
+# is never used.
+ITEMS_PER_BLOCK = 64
+INDEX_MAGIC = b"P2QR"
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct("<4sIQII")
+INDEX_BLOCK = struct.Struct("<QQQ")  # (compressed offset, compressed length, uncompressed offset)
+INDEX_ITEM = struct.Struct("<IQI")  # (block, uncompressed offset, uncompressed length)
+
+
+def get_result_name(md5_name: str, conversion_type: str) -> str:
+    return f"{md5_name}/{conversion_type}.json"
+
+
+def get_result_index_name(md5_name: str, conversion_type: str) -> str:
+    return f"{md5_name}/{conversion_type}.idx"
+
+
+def get_result_path(server: Quart, md5_name: str, conversion_type: str) -> str:
+    return get_blob_store(server).get_path("processed", get_result_name(md5_name, conversion_type))
+
+
+def read_processed_result(server: Quart, md5_name: str, conversion_type: str):
+    """
+    Reads the processed result of a conversion type, or None if the file has no result for it. Raises
+    FileNotFoundError if nothing was processed for the file yet.
+    """
+    return read_sized_processed_result(server, md5_name, conversion_type)[0]
+
+
+def read_sized_processed_result(server: Quart, md5_name: str, conversion_type: str) -> tuple[dict | None, int]:
+    """
+    Same as read_processed_result, also returns the size of the JSON read (decompressed) to size cache entries by.
+    """
+    store = get_blob_store(server)
+    result_path = store.fetch_artifact("processed", get_result_name(md5_name, conversion_type))
+    if artifact_io.artifact_exists(result_path):
+        raw_file, file = artifact_io.open_artifact(result_path)
+        with raw_file, file:
+            result_data = file.buffer.read()
+        return (json.loads(result_data), len(result_data))
+
+    # Files processed before results were split by conversion type have every conversion type in one JSON file.
+    combined_result_path = store.fetch("processed", f"{md5_name}.json")
+    if os.path.isfile(combined_result_path):
+        with open(combined_result_path, "rb") as file:
+            result_data = file.read()
+        # Sized by the whole file, these are few & only get fewer.
+        return (json.loads(result_data).get(conversion_type), len(result_data))
+
+    if store.has_prefix("processed", md5_name):
+        return (None, 0)
+
+    raise FileNotFoundError(result_path)
+
+
+def has_processed_result(server: Quart, md5_name: str, conversion_type: str) -> bool:
+    """
+    Checks for the result's file without reading it. Only a legacy combined file has to be read, to see whether it
+    has the conversion type.
+    """
+    store = get_blob_store(server)
+    if store.artifact_exists("processed", get_result_name(md5_name, conversion_type)):
+        return True
+
+    if not store.exists("processed", f"{md5_name}.json"):
+        return False
+
+    try:
+        return read_processed_result(server, md5_name, conversion_type) is not None
+    except FileNotFoundError:
+        return False
+
+
+def write_processed_result(server: Quart, md5_name: str, conversion_type: str, value: dict):
+    """
+    Saves the processed result of a conversion type along with the index of its items. Both are written to temporary
+    files & renamed into place, so readers see either the previous or the new result, and other conversion types are
+    never touched.
+    """
+    store = get_blob_store(server)
+    result_name = get_result_name(md5_name, conversion_type)
+    index_name = get_result_index_name(md5_name, conversion_type)
+    result_path = store.get_write_path("processed", f"{result_name}{artifact_io.COMPRESSED_SUFFIX}")
+    index_path = store.get_write_path("processed", index_name)
+
+    data = value["data"]
+    blocks = []
+    items = []
+    uncompressed_offset = 0
+    temporary_id = uuid.uuid4().hex
+
+    with open(f"{result_path}.{temporary_id}.tmp", "wb") as file:
+        writer = artifact_io.BlockCompressedWriter(file)
+
+        prefix = b'{"data": ['
+        blocks.append((*writer.write_block(prefix), uncompressed_offset))
+        uncompressed_offset += len(prefix)
+
+        for block_start in range(0, len(data), ITEMS_PER_BLOCK):
+            block_data = bytearray()
+            for index in range(block_start, min(block_start + ITEMS_PER_BLOCK, len(data))):
+                if index > 0:
+                    block_data += b","
+                encoded_item = json.dumps(data[index]).encode("utf-8")
+                items.append((len(blocks), uncompressed_offset + len(block_data), len(encoded_item)))
+                block_data += encoded_item
+
+            blocks.append((*writer.write_block(bytes(block_data)), uncompressed_offset))
+            uncompressed_offset += len(block_data)
+
+        # The rest of the /convertfile/ response, so the file can be sent as is.
+        writer.close(f'], "data_length": {len(data)}, "offset": 0, "next_offset": null}}'.encode("utf-8"))
+        result_size = file.tell()
+
+    with open(f"{index_path}.{temporary_id}.tmp", "wb") as file:
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, result_size, len(blocks), len(items)))
+        for block in blocks:
+            file.write(INDEX_BLOCK.pack(*block))
+        for item in items:
+            file.write(INDEX_ITEM.pack(*item))
+
+    os.replace(f"{result_path}.{temporary_id}.tmp", result_path)
+    os.replace(f"{index_path}.{temporary_id}.tmp", index_path)
+    store.publish_artifact("processed", result_name)
+    store.publish("processed", index_name)
+
+    # Drop the cached copy so the next request reads what we just wrote.
+    get_result_cache(server).invalidate(md5_name, conversion_type)
+
+
+def read_result_index(server: Quart, md5_name: str, conversion_type: str):
+    """
+    Returns (blocks, items) from the index of the result file, or None if the result has no valid index.
+    """
+    store = get_blob_store(server)
+    index_path = store.fetch("processed", get_result_index_name(md5_name, conversion_type))
+    result_path = store.fetch(
+        "processed", f"{get_result_name(md5_name, conversion_type)}{artifact_io.COMPRESSED_SUFFIX}"
+    )
+    try:
+        with open(index_path, "rb") as file:
+            index_data = file.read()
+        result_size = os.path.getsize(result_path)
+    except FileNotFoundError:
+        return None
+
+    if len(index_data) < INDEX_HEADER.size:
+        return None
+
+    magic, version, indexed_size, block_count, item_count = INDEX_HEADER.unpack_from(index_data, 0)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION or indexed_size != result_size:
+        return None
+
+    items_start = INDEX_HEADER.size + block_count * INDEX_BLOCK.size
+    blocks = list(INDEX_BLOCK.iter_unpack(index_data[INDEX_HEADER.size : items_start]))
+    items = list(INDEX_ITEM.iter_unpack(index_data[items_start : items_start + item_count * INDEX_ITEM.size]))
+    return (blocks, items)
+
+
+def read_processed_result_page(server: Quart, md5_name: str, conversion_type: str, offset: int, limit: int):
+    """
+    Returns (items, data_length) for limit items of the result's data starting at offset. Only the blocks holding the
+    requested items are read from disk & decompressed, unless the result is already cached or was saved without an
+    index.
+
+    Returns (None, 0) if the file has no result for the conversion type. Raises FileNotFoundError if nothing was
+    processed for the file yet.
+    """
+    cached_result = get_result_cache(server).get(md5_name, conversion_type)
+    index = None if cached_result is not None else read_result_index(server, md5_name, conversion_type)
+
+    if index is None:
+        result = cached_result or get_processed_result(server, md5_name, conversion_type)
+        if result is None:
+            return (None, 0)
+        return (result["data"][offset : offset + limit], len(result["data"]))
+
+    blocks, items = index
+    page_items = items[offset : offset + limit]
+    if len(page_items) <= 0:
+        return ([], len(items))
+
+    first_block = blocks[page_items[0][0]]
+    last_block = blocks[page_items[-1][0]]
+    result_path = f"{get_result_path(server, md5_name, conversion_type)}{artifact_io.COMPRESSED_SUFFIX}"
+    with open(result_path, "rb") as file:
+        file.seek(first_block[0])
+        block_data = artifact_io.decompress_blocks(file.read(last_block[0] + last_block[1] - first_block[0]))
+
+    # The items are stored back to back with commas in between, the same as a JSON array without brackets.
+    start = page_items[0][1] - first_block[2]
+    end = page_items[-1][1] + page_items[-1][2] - first_block[2]
+    items = json.loads(b"[" + block_data[start:end] + b"]")
+
+    return (items, len(index[1]))
+
+
+def read_result_response(
+    server: Quart, md5_name: str, conversion_type: str, offset: int, limit: int | None, user_data_limit: int = -1
+):
+    """
+    Returns the /convertfile/ response for limit items (all if None) of the result starting at offset, or None if the
+    file has no result for the conversion type. Items past user_data_limit (-1 for no limit) are left out, data_length
+    stays the full count so the client can tell the user how many are locked, but next_offset never points past the
+    limit. Raises FileNotFoundError if nothing was processed for the file yet.
+    """
+    if user_data_limit != -1:
+        end = user_data_limit if limit is None else min(offset + max(limit, 0), user_data_limit)
+        limit = max(end - offset, 0)
+
+    if limit is None:
+        result = get_processed_result(server, md5_name, conversion_type)
+        data = result["data"] if result is not None else None
+        data_length = len(data) if result is not None else 0
+    else:
+        data, data_length = read_processed_result_page(server, md5_name, conversion_type, offset, limit)
+
+    if data is None:
+        return None
+
+    next_offset = offset + len(data)
+    available_length = data_length if user_data_limit == -1 else min(data_length, user_data_limit)
+    return {
+        "data": data,
+        "data_length": data_length,
+        "offset": offset,
+        "next_offset": next_offset if next_offset < available_length and len(data) > 0 else None,
+    }
+
+
+def read_stored_result(server: Quart, md5_name: str, conversion_type: str) -> bytes | None:
+    """
+    Returns the gzip compressed /convertfile/ response of the result as stored, or None if it isn't stored compressed.
+    """
+    return artifact_io.read_stored_bytes(
+        get_blob_store(server).fetch_artifact("processed", get_result_name(md5_name, conversion_type))
+    )
+
+
+def get_processed_result(server: Quart, md5_name: str, conversion_type: str):
+    """
+    Same as read_processed_result, served from the result cache when possible.
+    """
+    cache = get_result_cache(server)
+    value = cache.get(md5_name, conversion_type)
+    if value is not None:
+        return value
+
+    generation = cache.get_generation(md5_name, conversion_type)
+    value, size = read_sized_processed_result(server, md5_name, conversion_type)
+
+    if value is not None:
+        cache.put(md5_name, conversion_type, value, size, generation)
+
+    return value
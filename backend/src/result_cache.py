@@ -0,0 +1,101 @@
+import threading
+from collections import OrderedDict
+from quart import Quart
+
+
+class ResultCache:
+    """
+    Least recently used cache of parsed processed results, keyed by (md5_name, conversion_type) and bounded by the
+    serialized size of the cached results.
+
+    Sync routes run in worker threads, so every access holds a lock.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple[str, str], tuple[object, int]] = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Bumped on every invalidation, so a result read before the file was rewritten is never cached after it.
+        self.generations: dict[tuple[str, str], int] = {}
+        self.lock = threading.Lock()
+
+    def get(self, md5_name: str, conversion_type: str):
+        with self.lock:
+            entry = self.entries.get((md5_name, conversion_type))
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end((md5_name, conversion_type))
+            return entry[0]
+
+    def get_generation(self, md5_name: str, conversion_type: str) -> int:
+        with self.lock:
+            return self.generations.get((md5_name, conversion_type), 0)
+
+    def put(self, md5_name: str, conversion_type: str, value: object, size: int, generation: int):
+        # Results bigger than the whole cache would just evict everything else.
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if self.generations.get((md5_name, conversion_type), 0) != generation:
+                return
+
+            self._remove((md5_name, conversion_type))
+            self.entries[(md5_name, conversion_type)] = (value, size)
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, md5_name: str, conversion_type: str):
+        with self.lock:
+            key = (md5_name, conversion_type)
+            self.generations[key] = self.generations.get(key, 0) + 1
+            self._remove(key)
+
+    def invalidate_file(self, md5_name: str):
+        """
+        Invalidates the cached results of every conversion type of the file.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == md5_name]:
+                self.generations[key] = self.generations.get(key, 0) + 1
+                self._remove(key)
+
+    def _remove(self, key: tuple[str, str]):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests > 0 else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+result_cache: ResultCache | None = None
+
+
+def get_result_cache(server: Quart) -> ResultCache:
+    global result_cache
+
+    if result_cache is None:
+        result_cache = ResultCache(server.config["RESULT_CACHE_MAX_BYTES"])
+
+    return result_cache
@@ -0,0 +1,221 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+from quart import Quart
+from . import file_utils
+from . import async_io
+from .result_cache import get_result_cache
+from .search_index import get_search_index
+from .blob_store import get_blob_store
+
+# Last access of an artifact is its modification time. Reads touch it, at most once per ACCESS_RESOLUTION seconds.
+ACCESS_RESOLUTION = 60 * 60
+# Artifacts used more recently than this are never evicted, they might belong to a document being processed.
+MIN_IDLE_SECONDS = 60 * 60
+# Kinds of blobs named after the document they belong to, and the suffixes of their names. Processed results are a
+# directory named after the document, or a single .json file if they were processed before results were split.
+DOCUMENT_ARTIFACTS = {
+    "upload": (".pdf", ".pptx"),
+    "json": (".json.gz", ".json"),
+    "text": (".txt", ".idx"),
+    "processed": ("", ".json"),
+    "log": (".txt.gz", ".txt"),
+}
+
+
+def touch(path: str):
+    try:
+        if time.time() - os.stat(path).st_mtime >= ACCESS_RESOLUTION:
+            os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def record_access(server: Quart, md5_name: str):
+    """
+    Marks every artifact of the document as used, so retention evicts it after documents that weren't used lately.
+    Artifacts that don't exist are skipped. Touches files, call it through run_io from async code.
+    """
+    store = get_blob_store(server)
+    for kind, suffixes in DOCUMENT_ARTIFACTS.items():
+        for suffix in suffixes:
+            touch(store.get_path(kind, f"{md5_name}{suffix}"))
+
+
+def get_entry_key(entry_name: str) -> str:
+    """
+    Artifacts are named after the document (<md5>.pdf, <md5>.json.gz, <md5>/...) or export they belong to, everything
+    with the same key is evicted together.
+    """
+    return entry_name.split(".")[0]
+
+
+def get_entry_usage(path: str) -> tuple[int, float]:
+    """
+    Returns (size, last access) of a file, or of a directory & everything in it.
+    """
+    stat = os.stat(path)
+    if not os.path.isdir(path):
+        return (stat.st_size, stat.st_mtime)
+
+    size = 0
+    last_access = stat.st_mtime
+    for root_path, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                file_stat = os.stat(os.path.join(root_path, file_name))
+            except FileNotFoundError:
+                continue
+            size += file_stat.st_size
+            last_access = max(last_access, file_stat.st_mtime)
+
+    return (size, last_access)
+
+
+class RetentionManager:
+    """
+    Keeps the data folder of each kind of blob within its size & age budget (server.config["RETENTION_POLICIES"]).
+    Artifacts past the age budget are deleted, then the least recently used ones until the folder fits its size budget.
+    Artifacts of files in paid_files, or in a user's library with conversions, are never deleted.
+
+    Only local files are deleted. With the S3 blob store these are copies, the bucket is left to its lifecycle rules.
+    """
+
+    def __init__(self, server: Quart):
+        self.server = server
+        self.folder_stats: dict[str, dict] = {}
+        self.reclaimed_bytes = 0
+        self.last_sweep = None
+        self.lock = threading.Lock()
+
+    def sweep(self):
+        try:
+            with file_utils.get_database(self.server) as database:
+                protected_keys = database.get_paid_md5_names() | database.get_library_md5_names()
+        except Exception as e:
+            # Without the paid & library files we can't tell what is safe to delete.
+            print(f"Retention sweep skipped, couldn't read paid & library files: {e}", file=sys.stderr)
+            return
+
+        for kind, (max_bytes, max_age_seconds) in self.server.config["RETENTION_POLICIES"].items():
+            folder_stats = self.sweep_folder(kind, max_bytes, max_age_seconds, protected_keys)
+
+            with self.lock:
+                self.folder_stats[kind] = folder_stats
+                self.reclaimed_bytes += folder_stats["reclaimed_bytes"]
+
+            if folder_stats["reclaimed_bytes"] > 0:
+                print(
+                    f"Retention reclaimed {folder_stats['reclaimed_bytes']} bytes from {kind} "
+                    f"({folder_stats['evicted']} evicted, {folder_stats['bytes']} bytes left)",
+                    file=sys.stderr,
+                )
+
+        with self.lock:
+            self.last_sweep = time.time()
+
+    def sweep_folder(self, kind: str, max_bytes: int | None, max_age_seconds: int | None, protected_keys: set):
+        store = get_blob_store(self.server)
+        # Group the folder's artifacts by key: [paths, size, last access]
+        groups: dict[str, list] = {}
+
+        for name, path in store.iter_local(kind):
+            try:
+                size, last_access = get_entry_usage(path)
+            except FileNotFoundError:
+                continue
+
+            group = groups.setdefault(get_entry_key(name), [[], 0, 0.0])
+            group[0].append(path)
+            group[1] += size
+            group[2] = max(group[2], last_access)
+
+        now = time.time()
+        total_bytes = sum(group[1] for group in groups.values())
+        reclaimed_bytes = 0
+        evicted = 0
+
+        candidates = sorted(
+            (
+                (key, group)
+                for key, group in groups.items()
+                if key not in protected_keys and now - group[2] >= MIN_IDLE_SECONDS
+            ),
+            key=lambda item: item[1][2],
+        )
+
+        for key, (paths, size, last_access) in candidates:
+            expired = max_age_seconds is not None and now - last_access > max_age_seconds
+            over_budget = max_bytes is not None and total_bytes > max_bytes
+            if not expired and not over_budget:
+                # Candidates are oldest first, nothing after this one is expired either.
+                break
+
+            if kind == "processed" and not self.forget_processed_results(key):
+                continue
+
+            for path in paths:
+                store.evict(path)
+            if kind == "processed":
+                get_result_cache(self.server).invalidate_file(key)
+
+            total_bytes -= size
+            reclaimed_bytes += size
+            evicted += 1
+
+        return {
+            "bytes": total_bytes,
+            "entries": len(groups) - evicted,
+            "protected_entries": len([key for key in groups if key in protected_keys]),
+            "evicted": evicted,
+            "reclaimed_bytes": reclaimed_bytes,
+            "max_bytes": max_bytes,
+            "max_age_seconds": max_age_seconds,
+        }
+
+    def forget_processed_results(self, md5_name: str) -> bool:
+        """
+        Clears what refers to the document's processed results before they are deleted, so they don't show as ready or
+        turn up in searches. Returns False if that failed & the results have to be kept.
+
+        With the S3 blob store only the local copies are deleted, the results are still there.
+        """
+        if self.server.config["BLOB_STORE"] != "local":
+            return True
+
+        try:
+            with file_utils.get_database(self.server) as database:
+                database.clear_file_results(md5_name)
+            get_search_index(self.server).remove_document(md5_name)
+        except Exception as e:
+            print(f"Retention kept the results of {md5_name}, couldn't clear them: {e}", file=sys.stderr)
+            return False
+
+        return True
+
+    async def run(self):
+        while True:
+            await async_io.run_io(self.sweep)
+            await asyncio.sleep(self.server.config["RETENTION_INTERVAL"])
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "last_sweep": self.last_sweep,
+                "reclaimed_bytes": self.reclaimed_bytes,
+                "folders": dict(self.folder_stats),
+            }
+
+
+retention_manager: RetentionManager | None = None
+
+
+def get_retention_manager(server: Quart) -> RetentionManager:
+    global retention_manager
+
+    if retention_manager is None:
+        retention_manager = RetentionManager(server)
+
+    return retention_manager
@@ -0,0 +1,222 @@
+import os
+import re
+import sys
+import json
+import sqlite3
+import threading
+from quart import Quart
+from . import processed_results
+
+# Marks the matched terms in snippets, removed again once their offsets are known.
+MATCH_START = "\x01"
+MATCH_END = "\x02"
+SNIPPET_TOKENS = 24  # Words around the matches returned per hit.
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS items USING fts5(
+    md5_name UNINDEXED,
+    conversion_type UNINDEXED,
+    item_index UNINDEXED,
+    text,
+    tokenize = 'porter unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS indexed_results (
+    md5_name TEXT NOT NULL,
+    conversion_type TEXT NOT NULL,
+    PRIMARY KEY (md5_name, conversion_type)
+);
+"""
+
+
+def get_item_text(item) -> str:
+    """
+    Returns the text of a generated item (flashcard, keyword, test question...), whatever its fields are.
+    """
+    if isinstance(item, str):
+        return item
+    if isinstance(item, dict):
+        return "\n".join(get_item_text(value) for value in item.values())
+    if isinstance(item, list):
+        return "\n".join(get_item_text(value) for value in item)
+    return ""
+
+
+def get_match_query(query: str) -> str | None:
+    """
+    Turns what the user typed into an FTS5 query matching items with every word, the last one as a prefix since it
+    might not be typed out yet. Words are quoted, so FTS5 operators in the input are searched for as text.
+    """
+    words = re.findall(r"\w+", query)
+    if len(words) <= 0:
+        return None
+
+    return " ".join([f'"{word}"' for word in words[:-1]] + [f'"{words[-1]}"*'])
+
+
+def get_match_offsets(snippet: str) -> tuple[str, list[tuple[int, int]]]:
+    """
+    Returns the snippet without match markers & the (start, end) offsets of the matches in it.
+    """
+    text = ""
+    offsets = []
+    for index, part in enumerate(re.split(f"[{MATCH_START}{MATCH_END}]", snippet)):
+        # Parts alternate between unmatched & matched text.
+        if index % 2 == 1:
+            offsets.append((len(text), len(text) + len(part)))
+        text += part
+    return (text, offsets)
+
+
+class SearchIndex:
+    """
+    Full-text index of the generated items of every processed result, in an SQLite FTS5 database on disk. Results are
+    indexed as they are written, searches rank items with bm25.
+
+    The index is local to each backend node, while results are shared through the blob store. Results written by
+    another node, or before this index existed, are indexed from the blob store the first time they are converted or
+    searched on this node (index_results). indexed_results tracks which results this node has indexed.
+
+    Every thread has its own connection, WAL mode lets searches run while a result is being indexed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.get_connection() as connection:
+            connection.executescript(SCHEMA)
+
+    def get_connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def index_result(self, md5_name: str, conversion_type: str, items: list):
+        """
+        Replaces the indexed items of the result, in one transaction.
+        """
+        with self.get_connection() as connection:
+            connection.execute(
+                "DELETE FROM items WHERE md5_name = ? AND conversion_type = ?", (md5_name, conversion_type)
+            )
+            connection.executemany(
+                "INSERT INTO items (md5_name, conversion_type, item_index, text) VALUES (?, ?, ?, ?)",
+                [(md5_name, conversion_type, index, get_item_text(item)) for index, item in enumerate(items)],
+            )
+            connection.execute(
+                "INSERT OR IGNORE INTO indexed_results (md5_name, conversion_type) VALUES (?, ?)",
+                (md5_name, conversion_type),
+            )
+
+    def remove_document(self, md5_name: str):
+        """
+        Removes the indexed items of every result of the document, in one transaction.
+        """
+        with self.get_connection() as connection:
+            connection.execute("DELETE FROM items WHERE md5_name = ?", (md5_name,))
+            connection.execute("DELETE FROM indexed_results WHERE md5_name = ?", (md5_name,))
+
+    def get_unindexed_results(self, results: dict[str, list[str]]) -> list[tuple[str, str]]:
+        """
+        Returns the (md5_name, conversion_type) of the given results ({md5_name: conversion types}) not indexed yet.
+        """
+        rows = self.get_connection().execute(
+            "SELECT md5_name, conversion_type FROM indexed_results WHERE md5_name IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(results)),),
+        ).fetchall()
+        indexed = set(rows)
+        return [
+            (md5_name, conversion_type)
+            for md5_name, conversion_types in results.items()
+            for conversion_type in conversion_types
+            if (md5_name, conversion_type) not in indexed
+        ]
+
+    def index_processed_result(self, server: Quart, md5_name: str, conversion_type: str):
+        """
+        Indexes a result from the blob store, e.g. one another node wrote. Results that don't exist are skipped.
+        """
+        try:
+            result = processed_results.read_processed_result(server, md5_name, conversion_type)
+        except FileNotFoundError:
+            return
+        if result is not None:
+            self.index_result(md5_name, conversion_type, result["data"])
+
+    def index_results(self, server: Quart, results: dict[str, list[str]]):
+        """
+        Indexes the given results ({md5_name: conversion types}) this node hasn't indexed yet.
+        """
+        for md5_name, conversion_type in self.get_unindexed_results(results):
+            try:
+                self.index_processed_result(server, md5_name, conversion_type)
+            except Exception as e:
+                # Tried again at the next search, the result is only missing from this one.
+                print(f"Indexing {md5_name}/{conversion_type} for search failed: {e}", file=sys.stderr)
+
+    def search(
+        self, query: str, md5_names: list[str], free_items: int, paid_results: list[str], limit: int
+    ) -> list[dict]:
+        """
+        Returns the best matching items of the given documents, best first. Only the first free_items items of each
+        result are searched, plus every item of the paid_results ("md5_name/conversion_type"). Only what this node
+        indexed is searched, index_results the documents first.
+        """
+        match_query = get_match_query(query)
+        if match_query is None or len(md5_names) <= 0:
+            return []
+
+        rows = self.get_connection().execute(
+            """
+            SELECT md5_name, conversion_type, item_index, snippet(items, 3, ?, ?, '...', ?), rank
+            FROM items
+            WHERE items MATCH ?
+                AND md5_name IN (SELECT value FROM json_each(?))
+                AND (item_index < ? OR md5_name || '/' || conversion_type IN (SELECT value FROM json_each(?)))
+            ORDER BY rank
+            LIMIT ?
+            """,
+            (
+                MATCH_START,
+                MATCH_END,
+                SNIPPET_TOKENS,
+                match_query,
+                json.dumps(md5_names),
+                free_items,
+                json.dumps(paid_results),
+                limit,
+            ),
+        ).fetchall()
+
+        hits = []
+        for md5_name, conversion_type, item_index, snippet, rank in rows:
+            snippet, match_offsets = get_match_offsets(snippet)
+            hits.append(
+                {
+                    "md5_name": md5_name,
+                    "conversion_type": conversion_type,
+                    "item_index": item_index,
+                    "snippet": snippet,
+                    "match_offsets": match_offsets,
+                    # bm25, lower is better.
+                    "rank": rank,
+                }
+            )
+
+        return hits
+
+
+search_index: SearchIndex | None = None
+
+
+def get_search_index(server: Quart) -> SearchIndex:
+    global search_index
+
+    if search_index is None:
+        search_index = SearchIndex(server.config["SEARCH_INDEX_PATH"])
+
+    return search_index
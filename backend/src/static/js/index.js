@@ -287,6 +287,9 @@ function handle_upload_error(request, formatted_file_name) {
     case "file_denied":
       display_error_msg("Filetype not supported");
       break;
+    case "quota_exceeded":
+      display_error_msg("Daily document limit reached, log in or connect a card for more: " + formatted_file_name);
+      break;
     default:
       display_error_msg("Unknown error occured");
       break;
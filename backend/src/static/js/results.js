@@ -92,12 +92,19 @@ async function unlock_file(results_output, conversion_type, file_data) {
   console.log(response);
 
   if (response.ok) {
-    const responseData = await response.json();
-    console.log(responseData);
+    const response_data = await response.json();
+    console.log(response_data);
     // Just do another GET request by calling get_converted_file or something
     await get_converted_file(file_data, conversion_type);
     await display_file_data(file_data.filename, file_data.md5_name, conversion_type);
     document.body.removeChild(document.getElementById("prompt-unlock-file"));
+  } else {
+    const response_data = await response.json();
+    if (response_data.error_type == "entitlements_unavailable") {
+      // The payment went through, don't offer to pay again.
+      document.querySelector(".prompt-message").innerHTML = response_data.error;
+      document.querySelector(".prompt-confirm-btn").remove();
+    }
   }
 }
 
@@ -200,7 +207,8 @@ async function display_file_data(filename, md5_name, conversion_type) {
 function set_flashcard(file_data, side, page) {
   // Set flashcard title
   const flashcard_text = file_data.data["flashcards"][page][side];
-  const total_pages = file_data.data_lengths["flashcards"];
+  // Only the flashcards the user may view are sent, the rest are locked.
+  const total_pages = Math.min(file_data.data_lengths["flashcards"], file_data.data["flashcards"].length);
   document.querySelector(".flashcard-text p").innerHTML = flashcard_text;
   // Set flashcard page
   document.querySelector(".flashcard-count p").innerHTML = `${page + 1} / ${total_pages}`;
@@ -0,0 +1,71 @@
+import os
+import sys
+import asyncio
+import hashlib
+from quart import url_for
+
+WATCH_INTERVAL = 2  # Seconds between checks for changed static files in development.
+
+
+class AssetManifest:
+    """
+    Maps each static file to a fingerprinted name containing a hash of its contents (css/main.css ->
+    css/main.1a2b3c4d5e6f.css). A fingerprinted name always refers to the same bytes, so it can be cached forever.
+
+    The manifest is built once at startup. In development, watch() rebuilds it whenever a static file changes.
+    """
+
+    def __init__(self, static_folder: str):
+        self.static_folder = static_folder
+        self.fingerprinted_paths: dict[str, str] = {}
+        self.real_paths: dict[str, str] = {}
+        self.modified_times: dict[str, float] = {}
+        self.build()
+
+    def get_modified_times(self) -> dict[str, float]:
+        modified_times = {}
+        for root_path, _, files in os.walk(self.static_folder):
+            for file_name in files:
+                file_path = os.path.join(root_path, file_name)
+                modified_times[os.path.relpath(file_path, self.static_folder)] = os.path.getmtime(file_path)
+        return modified_times
+
+    def build(self):
+        fingerprinted_paths = {}
+        modified_times = self.get_modified_times()
+
+        for real_path in modified_times:
+            with open(os.path.join(self.static_folder, real_path), "rb") as file:
+                content_hash = hashlib.sha256(file.read()).hexdigest()[:12]
+
+            name, extension = os.path.splitext(real_path)
+            fingerprinted_paths[real_path.replace(os.sep, "/")] = f"{name}.{content_hash}{extension}".replace(
+                os.sep, "/"
+            )
+
+        self.fingerprinted_paths = fingerprinted_paths
+        self.real_paths = {fingerprinted: real for real, fingerprinted in fingerprinted_paths.items()}
+        self.modified_times = modified_times
+
+    def asset_url(self, filename: str) -> str:
+        """
+        Returns the URL of the fingerprinted static file, for use in templates.
+        """
+        fingerprinted_path = self.fingerprinted_paths.get(filename)
+        if fingerprinted_path is None:
+            return url_for("static", filename=filename)
+
+        return url_for("get_static_asset", filename=fingerprinted_path)
+
+    def resolve(self, filename: str) -> str | None:
+        """
+        Returns the static file of a fingerprinted name, or None if the name isn't the current version of any file.
+        """
+        return self.real_paths.get(filename)
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            if self.get_modified_times() != self.modified_times:
+                print("Static files changed, rebuilding asset manifest.", file=sys.stderr)
+                self.build()
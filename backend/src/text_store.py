@@ -0,0 +1,203 @@
+import os
+import mmap
+import uuid
+import struct
+import bisect
+from contextlib import contextmanager
+from quart import Quart
+from .blob_store import get_blob_store
+
+# Index file layout: header (magic, version, element count), followed by one record per element of
+# (page_number, byte offset into the text blob, byte length). Elements without a page number get page 0.
+INDEX_MAGIC = b"P2QT"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sII")
+INDEX_RECORD = struct.Struct("<IQI")
+
+
+def get_text_store_paths(server: Quart, md5_name: str) -> tuple[str, str]:
+    """
+    Returns the local paths of the text & index files, fetched from the blob store.
+    """
+    store = get_blob_store(server)
+    return (store.fetch("text", f"{md5_name}.txt"), store.fetch("text", f"{md5_name}.idx"))
+
+
+def text_store_exists(server: Quart, md5_name: str) -> bool:
+    store = get_blob_store(server)
+    return store.exists("text", f"{md5_name}.txt") and store.exists("text", f"{md5_name}.idx")
+
+
+def write_text_store(server: Quart, md5_name: str, document_text):
+    """
+    Writes the (page_number, text) elements of a document as one UTF-8 text blob plus an offset index.
+
+    Both files are written to temporary paths first & renamed, so readers never see a partial store. Conversions of
+    the same document may build its store at once, each writes its own temporary files & they rename the same content.
+    """
+    store = get_blob_store(server)
+    text_path = store.get_write_path("text", f"{md5_name}.txt")
+    index_path = store.get_write_path("text", f"{md5_name}.idx")
+
+    records = []
+    offset = 0
+    temporary_id = uuid.uuid4().hex
+    with open(f"{text_path}.{temporary_id}.tmp", "wb") as text_file:
+        for page_number, text in document_text:
+            encoded_text = text.encode("utf-8")
+            text_file.write(encoded_text)
+            records.append((page_number or 0, offset, len(encoded_text)))
+            offset += len(encoded_text)
+
+    with open(f"{index_path}.{temporary_id}.tmp", "wb") as index_file:
+        index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(records)))
+        for record in records:
+            index_file.write(INDEX_RECORD.pack(*record))
+
+    os.replace(f"{text_path}.{temporary_id}.tmp", text_path)
+    os.replace(f"{index_path}.{temporary_id}.tmp", index_path)
+    store.publish("text", f"{md5_name}.txt")
+    store.publish("text", f"{md5_name}.idx")
+
+
+class TextStore:
+    """
+    Read-only view of a document's text store. The text blob is memory mapped, so elements, page ranges & previews
+    are sliced straight out of the page cache without decoding the whole document.
+
+    Slices are memoryviews handed out by context managers & released when the block exits, the mapping can't be
+    closed while one is still held. Elements are looked up by page through an index built when the store is opened,
+    which doesn't assume elements are stored in page order. Elements without a page number (page 0) are only
+    included when iterating the whole document.
+
+    Iterating yields (page_number, text) like document_processing.iter_document_text. `progress` is the fraction of
+    the elements being iterated that were read so far.
+    """
+
+    def __init__(self, server: Quart, md5_name: str):
+        text_path, index_path = get_text_store_paths(server, md5_name)
+
+        with open(index_path, "rb") as index_file:
+            index_data = index_file.read()
+
+        magic, version, count = INDEX_HEADER.unpack_from(index_data, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"Invalid text store index: {index_path}")
+
+        records = list(INDEX_RECORD.iter_unpack(index_data[INDEX_HEADER.size :]))[:count]
+        self.pages = [record[0] for record in records]
+        self.offsets = [record[1] for record in records]
+        self.lengths = [record[2] for record in records]
+        self.elements_read = 0
+        self.elements_total = len(records)
+
+        # {page_number: element indexes in storage order}, and the page numbers sorted for range lookups.
+        self.page_elements: dict[int, list[int]] = {}
+        for index, page_number in enumerate(self.pages):
+            if page_number != 0:
+                self.page_elements.setdefault(page_number, []).append(index)
+        self.page_numbers = sorted(self.page_elements)
+
+        self._file = open(text_path, "rb")
+        # mmap can't map an empty file, an empty document is just an empty buffer.
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._buffer = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        return self.iter_elements()
+
+    @property
+    def progress(self) -> float:
+        if self.elements_total <= 0:
+            return 1.0
+        return self.elements_read / self.elements_total
+
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._file.close()
+
+    @contextmanager
+    def _view(self, start: int, end: int):
+        with memoryview(self._buffer) as buffer_view, buffer_view[start:end] as view:
+            yield view
+
+    def element_bytes(self, index: int):
+        """
+        Context manager for the raw UTF-8 bytes of one element, as a memoryview of the mapping.
+        """
+        offset = self.offsets[index]
+        return self._view(offset, offset + self.lengths[index])
+
+    def element_text(self, index: int) -> str:
+        with self.element_bytes(index) as view:
+            return str(view, "utf-8")
+
+    def get_page_count(self) -> int:
+        return len(self.page_numbers)
+
+    def get_page_elements(self, first_page: int, last_page: int) -> list[int]:
+        """
+        Returns the indexes of the elements between first_page & last_page (inclusive), in storage order.
+        """
+        first = bisect.bisect_left(self.page_numbers, max(first_page, 1))
+        last = bisect.bisect_right(self.page_numbers, last_page)
+        return sorted(
+            index for page_number in self.page_numbers[first:last] for index in self.page_elements[page_number]
+        )
+
+    @contextmanager
+    def page_range_bytes(self, first_page: int, last_page: int):
+        """
+        Context manager for the raw UTF-8 bytes of every element between first_page & last_page (inclusive), as a list
+        of memoryviews of the mapping. Elements stored back to back share a view, so pages stored in order are one.
+        """
+        ranges = []
+        for index in self.get_page_elements(first_page, last_page):
+            start = self.offsets[index]
+            end = start + self.lengths[index]
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+
+        with memoryview(self._buffer) as buffer_view:
+            views = [buffer_view[start:end] for start, end in ranges]
+            try:
+                yield views
+            finally:
+                for view in views:
+                    view.release()
+
+    def preview(self, max_characters: int = 500) -> str:
+        """
+        Returns the first max_characters of the document text.
+        """
+        # A UTF-8 character is at most 4 bytes, only decode what we might need.
+        with self._view(0, max_characters * 4) as view:
+            return str(view, "utf-8", errors="ignore")[:max_characters]
+
+    def iter_elements(self, first_page: int | None = None, last_page: int | None = None):
+        elements = range(len(self))
+        if first_page is not None or last_page is not None:
+            elements = self.get_page_elements(
+                first_page if first_page is not None else 1,
+                last_page if last_page is not None else self.page_numbers[-1] if self.page_numbers else 0,
+            )
+
+        self.elements_read = 0
+        self.elements_total = len(elements)
+        for index in elements:
+            self.elements_read += 1
+            yield (self.pages[index], self.element_text(index))
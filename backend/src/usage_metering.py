@@ -0,0 +1,182 @@
+import sys
+import time
+import uuid
+import asyncio
+import threading
+import redis
+from datetime import datetime, timezone
+from quart import Quart
+from . import file_utils
+from .async_io import run_io
+
+# Adds to a counter unless that would take it over the limit, in one atomic step. Returns the new count, or -1 if
+# the limit was reached. KEYS[1]: counter, ARGV: amount, limit (-1 for none), seconds until the counter expires.
+COUNT_USAGE_SCRIPT = """
+local count = redis.call("INCRBY", KEYS[1], ARGV[1])
+if count == tonumber(ARGV[1]) then
+    redis.call("EXPIRE", KEYS[1], ARGV[3])
+end
+if tonumber(ARGV[2]) >= 0 and count > tonumber(ARGV[2]) then
+    redis.call("DECRBY", KEYS[1], ARGV[1])
+    return -1
+end
+return count
+"""
+# Adds the counts of one hash to another & deletes it, in one atomic step. KEYS[1]: from, KEYS[2]: to.
+RESTORE_PAGES_SCRIPT = """
+local pages = redis.call("HGETALL", KEYS[1])
+for i = 1, #pages, 2 do
+    redis.call("HINCRBY", KEYS[2], pages[i], pages[i + 1])
+end
+redis.call("DEL", KEYS[1])
+return #pages / 2
+"""
+COUNTER_EXPIRY = 2 * 24 * 60 * 60  # Daily counters are kept a day longer, so they can be looked at after the fact.
+PENDING_PAGES_KEY = "usage:pages-pending"  # Hash of email -> pages processed not yet added to users.pages_processed
+# Counts being flushed are moved to usage:pages-flushing:<unix time>:<id>. Ones left older than this were left by a
+# node that stopped mid-flush, and are put back.
+FLUSHING_RECOVERY_AGE = 10 * 60
+FLUSH_BATCH_SIZE = 500  # Users updated per UPDATE statement.
+
+
+def get_window() -> str:
+    return datetime.now(timezone.utc).strftime("%Y%m%d")
+
+
+class UsageMeter:
+    """
+    Per day usage counters of each user (by email) or guest (by IP) in Redis, checked against the daily quotas of the
+    account type (server.config["DAILY_QUOTAS"]) before work is scheduled. Each check is one atomic Redis call, no
+    database queries.
+
+    Pages processed by users are added up in Redis too, and added to users.pages_processed in batches by run().
+    If Redis is unavailable, requests are let through rather than failing.
+    """
+
+    def __init__(self, server: Quart, client: redis.Redis):
+        self.server = server
+        self.client = client
+        self.count_usage_script = client.register_script(COUNT_USAGE_SCRIPT)
+        self.restore_pages_script = client.register_script(RESTORE_PAGES_SCRIPT)
+        self.allowed = 0
+        self.denied = 0
+        self.errors = 0
+        self.flushed_pages = 0
+        self.recovered_flushes = 0
+        self.last_flush = None
+        self.lock = threading.Lock()
+
+    def get_key(self, counter: str, identity: str) -> str:
+        return f"usage:{counter}:{identity}:{get_window()}"
+
+    def count(self, counter: str, account_type: str, identity: str, amount: int = 1) -> bool:
+        """
+        Counts amount of usage, returns False without counting it if that would exceed today's quota.
+        """
+        limit = self.server.config["DAILY_QUOTAS"].get(account_type, {}).get(counter)
+        try:
+            count = self.count_usage_script(
+                keys=[self.get_key(counter, identity)], args=[amount, -1 if limit is None else limit, COUNTER_EXPIRY]
+            )
+        except redis.RedisError as e:
+            with self.lock:
+                self.errors += 1
+            print(f"Usage meter unavailable, allowing {counter} of {identity}: {e}", file=sys.stderr)
+            return True
+
+        with self.lock:
+            if count < 0:
+                self.denied += 1
+            else:
+                self.allowed += 1
+        return count >= 0
+
+    def add_pages(self, email: str, pages: int):
+        try:
+            self.client.hincrby(PENDING_PAGES_KEY, email, pages)
+        except redis.RedisError as e:
+            with self.lock:
+                self.errors += 1
+            print(f"Couldn't count {pages} pages processed by {email}: {e}", file=sys.stderr)
+
+    def flush_pages(self):
+        """
+        Adds the pages counted since the last flush to users.pages_processed, a batch of users per UPDATE.
+        """
+        # Move the counts aside, pages counted meanwhile go into a new hash for the next flush.
+        flushing_key = f"usage:pages-flushing:{int(time.time())}:{uuid.uuid4().hex}"
+        try:
+            self.client.rename(PENDING_PAGES_KEY, flushing_key)
+        except redis.ResponseError:
+            # Nothing was counted since the last flush.
+            return
+
+        pending_pages = [
+            (email.decode("utf-8"), int(pages)) for email, pages in self.client.hgetall(flushing_key).items()
+        ]
+        # Each batch is committed on its own, so on failure only the counts from the failed batch on are put back.
+        flushed = 0
+        try:
+            with file_utils.get_database(self.server) as database:
+                for batch_start in range(0, len(pending_pages), FLUSH_BATCH_SIZE):
+                    database.add_pages_processed(pending_pages[batch_start : batch_start + FLUSH_BATCH_SIZE])
+                    flushed = min(len(pending_pages), batch_start + FLUSH_BATCH_SIZE)
+        except Exception:
+            # Put the rest of the counts back for the next flush.
+            if flushed > 0:
+                self.client.hdel(flushing_key, *[email for email, _ in pending_pages[:flushed]])
+            self.restore_pages_script(keys=[flushing_key, PENDING_PAGES_KEY])
+            with self.lock:
+                self.flushed_pages += sum(pages for _, pages in pending_pages[:flushed])
+            raise
+
+        self.client.delete(flushing_key)
+        with self.lock:
+            self.flushed_pages += sum(pages for _, pages in pending_pages)
+            self.last_flush = time.time()
+
+    def recover_flushing_pages(self):
+        """
+        Puts back the counts a node moved aside to flush but never added or put back, e.g. because it was stopped.
+        """
+        for key in self.client.scan_iter(match="usage:pages-flushing:*"):
+            flushing_since = int(key.decode("utf-8").split(":")[2])
+            if flushing_since > time.time() - FLUSHING_RECOVERY_AGE:
+                continue
+
+            if self.restore_pages_script(keys=[key, PENDING_PAGES_KEY]) > 0:
+                print(f"Put back the pages processed left in {key.decode('utf-8')}", file=sys.stderr)
+                with self.lock:
+                    self.recovered_flushes += 1
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.server.config["USAGE_FLUSH_INTERVAL"])
+            try:
+                await run_io(self.recover_flushing_pages)
+                await run_io(self.flush_pages)
+            except Exception as e:
+                print(f"Flushing pages processed failed: {e}", file=sys.stderr)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "allowed": self.allowed,
+                "denied": self.denied,
+                "errors": self.errors,
+                "flushed_pages": self.flushed_pages,
+                "recovered_flushes": self.recovered_flushes,
+                "last_flush": self.last_flush,
+            }
+
+
+usage_meter: UsageMeter | None = None
+
+
+def get_usage_meter(server: Quart) -> UsageMeter:
+    global usage_meter
+
+    if usage_meter is None:
+        usage_meter = UsageMeter(server, redis.Redis.from_url(server.config["REDIS_URL"]))
+
+    return usage_meter
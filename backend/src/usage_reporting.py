@@ -0,0 +1,187 @@
+import sys
+import time
+import uuid
+import asyncio
+import threading
+import stripe
+from quart import Quart
+from . import file_utils
+from .async_io import run_io
+
+
+class UsageReporter:
+    """
+    Reports the usage queued in usage_outbox (by pay_for_file) to stripe in the background, so unlocking a file never
+    waits on stripe. New usage is grouped into one batch per subscription item, each batch is sent as one usage record
+    with its batch_id as the idempotency key. Failed batches are retried with exponential backoff, always with the same
+    key & values, so stripe counts each batch once even if an earlier attempt got through. The timestamp is fixed at
+    the first attempt, inside the subscription's current period as stripe requires. Batches stripe rejects, or that
+    still fail after USAGE_MAX_ATTEMPTS, get failed_at set & are left for an operator instead of being retried forever.
+    """
+
+    def __init__(self, server: Quart):
+        self.server = server
+        self.reported_batches = 0
+        self.reported_quantity = 0
+        self.failed_attempts = 0
+        self.failed_batches = 0
+        self.pending_events = 0
+        self.last_error = None
+        self.last_run = None
+        self.lock = threading.Lock()
+
+    def create_batches(self, database):
+        cursor = database.cursor
+        cursor.execute(
+            "SELECT subscription_item_id, id FROM usage_outbox "
+            "WHERE reported_at IS NULL AND failed_at IS NULL AND batch_id IS NULL ORDER BY id LIMIT %s",
+            (self.server.config["USAGE_REPORT_BATCH_SIZE"],),
+        )
+        event_ids: dict[str, list[int]] = {}
+        for subscription_item_id, event_id in cursor.fetchall():
+            event_ids.setdefault(subscription_item_id, []).append(event_id)
+
+        for ids in event_ids.values():
+            # Events another node batched meanwhile keep their batch.
+            placeholders = ", ".join(["%s"] * len(ids))
+            cursor.execute(
+                f"UPDATE usage_outbox SET batch_id = %s WHERE batch_id IS NULL AND id IN ({placeholders})",
+                (uuid.uuid4().hex, *ids),
+            )
+        database.connection.commit()
+
+    def get_report_timestamp(self, subscription_item_id: str, queued_at: int) -> int:
+        """
+        When the batch was queued, moved into the subscription's current period if it was queued in an earlier one.
+        Stripe rejects usage records outside of the current period.
+        """
+        subscription_item = stripe.SubscriptionItem.retrieve(subscription_item_id)
+        subscription = stripe.Subscription.retrieve(subscription_item.subscription)
+        return min(max(queued_at, subscription.current_period_start), int(time.time()))
+
+    def fix_report_timestamp(self, database, batch_id: str, subscription_item_id: str, queued_at: int) -> int:
+        """Stores the batch's timestamp at its first attempt, every retry sends the same one."""
+        timestamp = self.get_report_timestamp(subscription_item_id, queued_at)
+        database.cursor.execute(
+            "UPDATE usage_outbox SET report_timestamp = %s WHERE batch_id = %s AND report_timestamp IS NULL",
+            (timestamp, batch_id),
+        )
+        database.connection.commit()
+        # Another node may have fixed it first.
+        database.cursor.execute("SELECT MAX(report_timestamp) FROM usage_outbox WHERE batch_id = %s", (batch_id,))
+        return int(database.cursor.fetchone()[0])
+
+    def report_batch(self, database, batch_id: str, subscription_item_id: str, quantity: int, timestamp: int):
+        stripe.SubscriptionItem.create_usage_record(
+            subscription_item_id,
+            quantity=quantity,
+            timestamp=timestamp,
+            action="increment",
+            idempotency_key=f"usage-{batch_id}",
+        )
+        database.cursor.execute("UPDATE usage_outbox SET reported_at = NOW() WHERE batch_id = %s", (batch_id,))
+        database.connection.commit()
+        # The upcoming invoice grew, the reconciler refreshes the customer's billing summary.
+        database.mark_billing_summaries_stale(subscription_item_id)
+
+    def report_pending(self):
+        with file_utils.get_database(self.server) as database:
+            self.create_batches(database)
+
+            database.cursor.execute(
+                """
+                SELECT
+                    batch_id, subscription_item_id, SUM(quantity), UNIX_TIMESTAMP(MAX(created_at)),
+                    MAX(report_timestamp), MAX(attempts)
+                FROM usage_outbox
+                WHERE reported_at IS NULL AND failed_at IS NULL AND batch_id IS NOT NULL AND next_attempt_at <= NOW()
+                GROUP BY batch_id, subscription_item_id
+                """
+            )
+            for batch_id, subscription_item_id, quantity, queued_at, timestamp, attempts in database.cursor.fetchall():
+                try:
+                    if timestamp is None:
+                        timestamp = self.fix_report_timestamp(database, batch_id, subscription_item_id, int(queued_at))
+                    self.report_batch(database, batch_id, subscription_item_id, int(quantity), int(timestamp))
+                    with self.lock:
+                        self.reported_batches += 1
+                        self.reported_quantity += int(quantity)
+                except Exception as e:
+                    database.connection.rollback()
+                    # Invalid requests fail the same way every time, e.g. a deleted subscription item.
+                    if isinstance(e, stripe.error.InvalidRequestError) or (
+                        attempts + 1 >= self.server.config["USAGE_MAX_ATTEMPTS"]
+                    ):
+                        self.fail_batch(database, batch_id, e)
+                        continue
+                    retry_delay = min(
+                        self.server.config["USAGE_RETRY_MAX_DELAY"],
+                        self.server.config["USAGE_RETRY_DELAY"] * 2**attempts,
+                    )
+                    print(f"Reporting usage batch {batch_id} failed, retrying in {retry_delay}s: {e}", file=sys.stderr)
+                    database.cursor.execute(
+                        """
+                        UPDATE usage_outbox
+                        SET attempts = attempts + 1, next_attempt_at = NOW() + INTERVAL %s SECOND, last_error = %s
+                        WHERE batch_id = %s
+                        """,
+                        (retry_delay, str(e), batch_id),
+                    )
+                    database.connection.commit()
+                    with self.lock:
+                        self.failed_attempts += 1
+                        self.last_error = str(e)
+
+            database.cursor.execute(
+                "SELECT COUNT(*) FROM usage_outbox WHERE reported_at IS NULL AND failed_at IS NULL"
+            )
+            pending_events = database.cursor.fetchone()[0]
+
+        with self.lock:
+            self.pending_events = pending_events
+            self.last_run = time.time()
+
+    def fail_batch(self, database, batch_id: str, error: Exception):
+        print(f"Reporting usage batch {batch_id} failed for good, giving up: {error}", file=sys.stderr)
+        database.cursor.execute(
+            "UPDATE usage_outbox SET attempts = attempts + 1, failed_at = NOW(), last_error = %s WHERE batch_id = %s",
+            (str(error), batch_id),
+        )
+        database.connection.commit()
+        with self.lock:
+            self.failed_attempts += 1
+            self.failed_batches += 1
+            self.last_error = str(error)
+
+    async def run(self):
+        while True:
+            try:
+                await run_io(self.report_pending)
+            except Exception as e:
+                # The usage stays in the outbox, the next run picks it up.
+                print(f"Usage reporting failed: {e}", file=sys.stderr)
+            await asyncio.sleep(self.server.config["USAGE_REPORT_INTERVAL"])
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "reported_batches": self.reported_batches,
+                "reported_quantity": self.reported_quantity,
+                "failed_attempts": self.failed_attempts,
+                "failed_batches": self.failed_batches,
+                "pending_events": self.pending_events,
+                "last_error": self.last_error,
+                "last_run": self.last_run,
+            }
+
+
+usage_reporter: UsageReporter | None = None
+
+
+def get_usage_reporter(server: Quart) -> UsageReporter:
+    global usage_reporter
+
+    if usage_reporter is None:
+        usage_reporter = UsageReporter(server)
+
+    return usage_reporter
@@ -0,0 +1,17 @@
+import types
+import pytest
+from backend.src import blob_store, result_cache
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """
+    A stand-in for the Quart app with the config the blob store & result cache read, its folders under tmp_path.
+    """
+    config = {"BLOB_STORE": "local", "RESULT_CACHE_MAX_BYTES": 1024 * 1024}
+    for kind, config_key in blob_store.BLOB_KINDS.items():
+        config[config_key] = str(tmp_path / kind)
+    # The blob store & result cache are module singletons, each test gets its own.
+    monkeypatch.setattr(blob_store, "blob_store", None)
+    monkeypatch.setattr(result_cache, "result_cache", None)
+    return types.SimpleNamespace(config=config)
@@ -0,0 +1,79 @@
+import gzip
+import zlib
+import logging
+from backend.src import artifact_io
+
+
+def get_cut_short_member(data: bytes) -> bytes:
+    # What a log file looks like while it's still open: flushed, but without the end of the stream & trailer.
+    compressor = zlib.compressobj(artifact_io.COMPRESSION_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def test_decompress_members():
+    data = gzip.compress(b"first\n") + gzip.compress(b"second\n") + gzip.compress(b"third\n")
+    assert artifact_io.decompress(data) == b"first\nsecond\nthird\n"
+
+
+def test_decompress_empty():
+    assert artifact_io.decompress(b"") == b""
+
+
+def test_decompress_cut_short_last_member():
+    data = gzip.compress(b"first\n") + get_cut_short_member(b"second\n")
+    assert artifact_io.decompress(data) == b"first\nsecond\n"
+
+
+def test_decompress_cut_short_member_followed_by_members():
+    data = gzip.compress(b"first\n") + get_cut_short_member(b"second\n") + gzip.compress(b"third\n")
+    assert artifact_io.decompress(data) == b"first\nsecond\nthird\n"
+
+
+def test_decompress_member_cut_mid_block():
+    data = "".join(f"line {index}\n" for index in range(10000)).encode("utf-8")
+    member = gzip.compress(data)
+    decompressed = artifact_io.decompress(member[: len(member) // 2])
+    assert len(decompressed) > 0 and data.startswith(decompressed)
+
+
+def test_block_compressed_writer(tmp_path):
+    path = tmp_path / "blocks.gz"
+    with open(path, "wb") as file:
+        writer = artifact_io.BlockCompressedWriter(file)
+        blocks = [writer.write_block(b"[1,"), writer.write_block(b"2,"), writer.write_block(b"3")]
+        writer.close(b"]")
+
+    data = path.read_bytes()
+    assert gzip.decompress(data) == b"[1,2,3]"
+
+    offset, _ = blocks[1]
+    last_offset, last_length = blocks[2]
+    assert artifact_io.decompress_blocks(data[offset : last_offset + last_length]) == b"2,3"
+
+
+def test_write_artifact_replaces_uncompressed_copy(tmp_path):
+    path = str(tmp_path / "result.json")
+    with open(path, "w") as file:
+        file.write("old")
+
+    with artifact_io.write_artifact(path) as file:
+        file.write("new")
+
+    assert artifact_io.get_artifact_path(path) == f"{path}{artifact_io.COMPRESSED_SUFFIX}"
+    assert artifact_io.read_artifact_text(path) == "new"
+
+
+def test_compressed_file_handler_ends_cut_short_members(tmp_path):
+    path = str(tmp_path / "log.txt")
+    # A log left open by a crash: flushed, never closed.
+    with open(f"{path}{artifact_io.COMPRESSED_SUFFIX}", "wb") as file:
+        file.write(gzip.compress(b"first\n") + get_cut_short_member(b"second\n"))
+
+    handler = artifact_io.CompressedFileHandler(path)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.handle(logging.makeLogRecord({"msg": "third"}))
+    handler.close()
+
+    data = (tmp_path / f"log.txt{artifact_io.COMPRESSED_SUFFIX}").read_bytes()
+    assert not artifact_io.has_unended_member(data)
+    assert gzip.decompress(data) == b"first\nsecond\nthird\n"
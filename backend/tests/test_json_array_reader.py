@@ -0,0 +1,54 @@
+import json
+import pytest
+from backend.src import artifact_io
+from backend.src.file_utils import JSONArrayReader
+
+ELEMENTS = [{"text": f"element {index}", "metadata": {"page_number": index // 3 + 1}} for index in range(100)] + [
+    "a string",
+    12345,
+    None,
+    [1, [2, 3]],
+]
+
+
+def test_reads_every_element_across_chunks(tmp_path):
+    path = tmp_path / "document.json"
+    path.write_text(json.dumps(ELEMENTS))
+
+    # Chunks smaller than an element, so elements & scalars are split across reads.
+    reader = JSONArrayReader(str(path), chunk_size=7)
+    assert list(reader) == ELEMENTS
+    assert reader.progress == 1.0
+
+
+def test_reads_compressed_artifact(tmp_path):
+    path = str(tmp_path / "document.json")
+    with artifact_io.write_artifact(path) as file:
+        json.dump(ELEMENTS, file)
+
+    assert list(JSONArrayReader(path, chunk_size=64)) == ELEMENTS
+
+
+def test_empty_array(tmp_path):
+    path = tmp_path / "document.json"
+    path.write_text(" [ ] ")
+    assert list(JSONArrayReader(str(path))) == []
+
+
+def test_rejects_non_array(tmp_path):
+    path = tmp_path / "document.json"
+    path.write_text('{"text": "not an array"}')
+    with pytest.raises(json.JSONDecodeError):
+        list(JSONArrayReader(str(path)))
+
+
+def test_rejects_unterminated_array(tmp_path):
+    path = tmp_path / "document.json"
+    path.write_text('[{"text": "first"}, {"text": "sec')
+    with pytest.raises(json.JSONDecodeError):
+        list(JSONArrayReader(str(path), chunk_size=8))
+
+
+def test_missing_file(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        JSONArrayReader(str(tmp_path / "missing.json"))
@@ -0,0 +1,54 @@
+import asyncio
+from backend.src.async_io import KeyedLock
+
+
+def test_same_key_is_serialized():
+    keyed_lock = KeyedLock()
+    events = []
+
+    async def work(name: str):
+        async with keyed_lock.lock("file"):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{name} end")
+
+    async def main():
+        await asyncio.gather(work("a"), work("b"))
+
+    asyncio.run(main())
+    assert events == ["a start", "a end", "b start", "b end"]
+
+
+def test_different_keys_run_concurrently():
+    keyed_lock = KeyedLock()
+    events = []
+
+    async def work(key: str):
+        async with keyed_lock.lock(key):
+            events.append(f"{key} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{key} end")
+
+    async def main():
+        await asyncio.gather(work("a"), work("b"))
+
+    asyncio.run(main())
+    assert events == ["a start", "b start", "a end", "b end"]
+
+
+def test_locks_are_dropped_when_released():
+    keyed_lock = KeyedLock()
+
+    async def main():
+        async with keyed_lock.lock("file"):
+            assert "file" in keyed_lock.locks
+        assert keyed_lock.locks == {}
+
+        try:
+            async with keyed_lock.lock("file"):
+                raise ValueError()
+        except ValueError:
+            pass
+        assert keyed_lock.locks == {}
+
+    asyncio.run(main())
@@ -0,0 +1,39 @@
+import os
+import hashlib
+from backend.src import passwords
+
+# Low enough to keep the tests fast, the parameters are stored in the hash either way.
+ITERATIONS = 1000
+
+
+def test_verify_password():
+    stored_hash = passwords.hash_password("correct horse", ITERATIONS)
+    assert stored_hash.startswith(f"{passwords.ALGORITHM}${ITERATIONS}$")
+    assert passwords.verify_password("correct horse", stored_hash)
+    assert not passwords.verify_password("wrong horse", stored_hash)
+
+
+def test_hashes_are_salted():
+    assert passwords.hash_password("password", ITERATIONS) != passwords.hash_password("password", ITERATIONS)
+
+
+def test_verify_legacy_password():
+    salt = os.urandom(passwords.SALT_BYTES)
+    legacy_hash = hashlib.pbkdf2_hmac("sha256", b"correct horse", salt, passwords.LEGACY_ITERATIONS).hex()
+    assert passwords.verify_password("correct horse", legacy_hash, salt)
+    assert not passwords.verify_password("wrong horse", legacy_hash, salt)
+    assert not passwords.verify_password("correct horse", legacy_hash, os.urandom(passwords.SALT_BYTES))
+
+
+def test_unknown_algorithm_is_rejected():
+    stored_hash = passwords.hash_password("password", ITERATIONS).replace(passwords.ALGORITHM, "md5", 1)
+    assert not passwords.verify_password("password", stored_hash)
+
+
+def test_needs_rehash():
+    stored_hash = passwords.hash_password("password", ITERATIONS)
+    assert not passwords.needs_rehash(stored_hash, ITERATIONS)
+    assert not passwords.needs_rehash(stored_hash, ITERATIONS // 2)
+    assert passwords.needs_rehash(stored_hash, ITERATIONS * 2)
+    # Legacy hashes are always upgraded.
+    assert passwords.needs_rehash("0" * 64, ITERATIONS)
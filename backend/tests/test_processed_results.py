@@ -0,0 +1,105 @@
+import pytest
+from backend.src import processed_results
+from backend.src.blob_store import get_blob_store
+from backend.src.result_cache import get_result_cache
+
+MD5_NAME = "0123456789abcdef0123456789abcdef"
+# Spans several blocks of ITEMS_PER_BLOCK items, with items of different sizes & shapes.
+ITEMS = [[f"question {index}", "answer " * (index % 7)] for index in range(processed_results.ITEMS_PER_BLOCK * 3 + 5)]
+
+
+@pytest.fixture
+def result(server):
+    processed_results.write_processed_result(server, MD5_NAME, "flashcards", {"data": ITEMS})
+    return server
+
+
+def read_page(server, offset, limit):
+    # Drop the cached copy, so the page is read through the index.
+    get_result_cache(server).invalidate(MD5_NAME, "flashcards")
+    return processed_results.read_processed_result_page(server, MD5_NAME, "flashcards", offset, limit)
+
+
+def test_index_covers_every_item(result):
+    blocks, items = processed_results.read_result_index(result, MD5_NAME, "flashcards")
+    assert len(items) == len(ITEMS)
+    # The prefix block, then the blocks of items.
+    assert len(blocks) == 1 + -(-len(ITEMS) // processed_results.ITEMS_PER_BLOCK)
+
+
+@pytest.mark.parametrize(
+    "offset, limit",
+    [
+        (0, 10),
+        (60, 10),  # Across a block boundary.
+        (0, len(ITEMS)),
+        (len(ITEMS) - 3, 10),  # Past the end.
+        (processed_results.ITEMS_PER_BLOCK, 1),  # The first item of a block.
+    ],
+)
+def test_read_page(result, offset, limit):
+    assert read_page(result, offset, limit) == (ITEMS[offset : offset + limit], len(ITEMS))
+
+
+def test_read_page_past_the_end(result):
+    assert read_page(result, len(ITEMS) + 10, 10) == ([], len(ITEMS))
+
+
+def test_whole_result_is_the_convertfile_response(result):
+    assert processed_results.read_processed_result(result, MD5_NAME, "flashcards") == {
+        "data": ITEMS,
+        "data_length": len(ITEMS),
+        "offset": 0,
+        "next_offset": None,
+    }
+
+
+def test_mismatched_index_is_not_used(result):
+    # The index of an earlier result next to a newer result, e.g. when a node crashed between the two renames.
+    index_path = get_blob_store(result).get_path(
+        "processed", processed_results.get_result_index_name(MD5_NAME, "flashcards")
+    )
+    with open(index_path, "rb") as file:
+        old_index = file.read()
+    new_items = ITEMS[:100]
+    processed_results.write_processed_result(result, MD5_NAME, "flashcards", {"data": new_items})
+    with open(index_path, "wb") as file:
+        file.write(old_index)
+
+    assert processed_results.read_result_index(result, MD5_NAME, "flashcards") is None
+    assert read_page(result, 60, 10) == (new_items[60:70], len(new_items))
+
+
+def test_missing_conversion_type(result):
+    assert processed_results.read_processed_result_page(result, MD5_NAME, "keywords", 0, 10) == (None, 0)
+
+
+def test_nothing_processed(server):
+    with pytest.raises(FileNotFoundError):
+        processed_results.read_processed_result_page(server, MD5_NAME, "flashcards", 0, 10)
+
+
+def test_trimmed_response(result):
+    # A guest sees the first 5 items, next_offset never points into the locked items.
+    get_result_cache(result).invalidate(MD5_NAME, "flashcards")
+    assert processed_results.read_result_response(result, MD5_NAME, "flashcards", 0, None, 5) == {
+        "data": ITEMS[:5],
+        "data_length": len(ITEMS),
+        "offset": 0,
+        "next_offset": None,
+    }
+
+
+def test_trimmed_response_pages(result):
+    assert processed_results.read_result_response(result, MD5_NAME, "flashcards", 0, 3, 5)["next_offset"] == 3
+    assert processed_results.read_result_response(result, MD5_NAME, "flashcards", 3, 3, 5) == {
+        "data": ITEMS[3:5],
+        "data_length": len(ITEMS),
+        "offset": 3,
+        "next_offset": None,
+    }
+    assert processed_results.read_result_response(result, MD5_NAME, "flashcards", 10, 3, 5)["data"] == []
+
+
+def test_untrimmed_response_pages(result):
+    assert processed_results.read_result_response(result, MD5_NAME, "flashcards", 0, 10)["next_offset"] == 10
@@ -0,0 +1,66 @@
+from backend.src.result_cache import ResultCache
+
+
+def test_get_and_put():
+    cache = ResultCache(100)
+    assert cache.get("file", "flashcards") is None
+
+    cache.put("file", "flashcards", {"data": []}, 10, cache.get_generation("file", "flashcards"))
+    assert cache.get("file", "flashcards") == {"data": []}
+    assert cache.get_stats()["hits"] == 1
+    assert cache.get_stats()["misses"] == 1
+
+
+def test_evicts_least_recently_used():
+    cache = ResultCache(100)
+    cache.put("a", "flashcards", "a", 40, 0)
+    cache.put("b", "flashcards", "b", 40, 0)
+    cache.get("a", "flashcards")
+    cache.put("c", "flashcards", "c", 40, 0)
+
+    assert cache.get("b", "flashcards") is None
+    assert cache.get("a", "flashcards") == "a"
+    assert cache.get("c", "flashcards") == "c"
+    assert cache.get_stats()["bytes"] == 80
+    assert cache.get_stats()["evictions"] == 1
+
+
+def test_skips_results_bigger_than_the_cache():
+    cache = ResultCache(100)
+    cache.put("a", "flashcards", "a", 40, 0)
+    cache.put("b", "flashcards", "b", 101, 0)
+
+    assert cache.get("b", "flashcards") is None
+    assert cache.get("a", "flashcards") == "a"
+
+
+def test_replacing_an_entry_keeps_the_size_right():
+    cache = ResultCache(100)
+    cache.put("a", "flashcards", "old", 40, 0)
+    cache.put("a", "flashcards", "new", 30, 0)
+
+    assert cache.get("a", "flashcards") == "new"
+    assert cache.get_stats()["bytes"] == 30
+
+
+def test_result_read_before_invalidation_is_not_cached():
+    cache = ResultCache(100)
+    generation = cache.get_generation("a", "flashcards")
+    # The result is rewritten while the old one is being read.
+    cache.invalidate("a", "flashcards")
+    cache.put("a", "flashcards", "stale", 10, generation)
+
+    assert cache.get("a", "flashcards") is None
+
+
+def test_invalidate_file():
+    cache = ResultCache(100)
+    cache.put("a", "flashcards", "a", 10, 0)
+    cache.put("a", "keywords", "a", 10, 0)
+    cache.put("b", "flashcards", "b", 10, 0)
+    cache.invalidate_file("a")
+
+    assert cache.get("a", "flashcards") is None
+    assert cache.get("a", "keywords") is None
+    assert cache.get("b", "flashcards") == "b"
+    assert cache.get_stats()["bytes"] == 10
@@ -0,0 +1,55 @@
+from backend.src import processed_results, search_index
+from backend.src.search_index import MATCH_END, MATCH_START
+
+MD5_NAME = "0123456789abcdef0123456789abcdef"
+
+
+def test_match_query_quotes_words_and_prefixes_the_last():
+    assert search_index.get_match_query("cell membrane") == '"cell" "membrane"*'
+    assert search_index.get_match_query("  mito ") == '"mito"*'
+
+
+def test_match_query_searches_operators_as_text():
+    assert search_index.get_match_query('cell OR "wall" NEAR(x') == '"cell" "OR" "wall" "NEAR" "x"*'
+
+
+def test_match_query_without_words():
+    assert search_index.get_match_query("") is None
+    assert search_index.get_match_query("*** ()") is None
+
+
+def test_match_offsets():
+    snippet = f"The {MATCH_START}cell{MATCH_END} has a {MATCH_START}membrane{MATCH_END}."
+    assert search_index.get_match_offsets(snippet) == ("The cell has a membrane.", [(4, 8), (15, 23)])
+
+
+def test_match_offsets_without_matches():
+    assert search_index.get_match_offsets("no matches") == ("no matches", [])
+
+
+def test_match_offsets_at_the_start():
+    assert search_index.get_match_offsets(f"{MATCH_START}Cell{MATCH_END} walls") == ("Cell walls", [(0, 4)])
+
+
+def test_results_of_other_nodes_are_indexed_on_first_search(server, tmp_path):
+    items = [["What is a cell membrane?", "A barrier"], ["Mitochondria", "Powerhouse"]]
+    processed_results.write_processed_result(server, MD5_NAME, "flashcards", {"data": items})
+    index = search_index.SearchIndex(str(tmp_path / "search-index" / "items.sqlite3"))
+    assert index.search("membrane", [MD5_NAME], 10, [], 10) == []
+
+    index.index_results(server, {MD5_NAME: ["flashcards", "keywords"]})
+
+    hits = index.search("membrane", [MD5_NAME], 10, [], 10)
+    assert [(hit["conversion_type"], hit["item_index"]) for hit in hits] == [("flashcards", 0)]
+    # The missing keywords result is tried again, the indexed one isn't.
+    assert index.get_unindexed_results({MD5_NAME: ["flashcards", "keywords"]}) == [(MD5_NAME, "keywords")]
+
+
+def test_removed_document_is_indexed_again(tmp_path):
+    index = search_index.SearchIndex(str(tmp_path / "search-index" / "items.sqlite3"))
+    index.index_result(MD5_NAME, "flashcards", [["What is a cell membrane?", "A barrier"]])
+
+    index.remove_document(MD5_NAME)
+
+    assert index.search("membrane", [MD5_NAME], 10, [], 10) == []
+    assert index.get_unindexed_results({MD5_NAME: ["flashcards"]}) == [(MD5_NAME, "flashcards")]
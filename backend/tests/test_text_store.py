@@ -0,0 +1,81 @@
+import os
+from backend.src import text_store
+from backend.src.blob_store import get_blob_store
+
+MD5_NAME = "0123456789abcdef0123456789abcdef"
+
+
+def test_round_trip(server):
+    elements = [(1, "First page"), (1, "Ünïcödé ✓"), (2, "Second page"), (None, "No page"), (3, "")]
+    text_store.write_text_store(server, MD5_NAME, elements)
+
+    assert text_store.text_store_exists(server, MD5_NAME)
+    with text_store.TextStore(server, MD5_NAME) as store:
+        assert len(store) == len(elements)
+        assert store.element_text(1) == "Ünïcödé ✓"
+        with store.element_bytes(2) as element_bytes:
+            assert element_bytes == b"Second page"
+        # Elements without a page number get page 0.
+        assert list(store) == [(page_number or 0, text) for page_number, text in elements]
+        assert store.progress == 1.0
+
+
+def test_page_ranges(server):
+    # Unsorted pages, with elements without a page in between.
+    elements = [(2, "two"), (None, "none"), (1, "one"), (2, " more"), (4, "four")]
+    text_store.write_text_store(server, MD5_NAME, elements)
+
+    with text_store.TextStore(server, MD5_NAME) as store:
+        assert store.get_page_count() == 3
+        assert store.get_page_elements(2, 3) == [0, 3]
+        assert store.get_page_elements(0, 1) == [2]
+        assert list(store.iter_elements(2, 4)) == [(2, "two"), (2, " more"), (4, "four")]
+        assert store.progress == 1.0
+        assert list(store.iter_elements(first_page=4)) == [(4, "four")]
+        with store.page_range_bytes(1, 2) as views:
+            # "one" & " more" are stored back to back.
+            assert [bytes(view) for view in views] == [b"two", b"one more"]
+        with store.page_range_bytes(5, 9) as views:
+            assert views == []
+
+
+def test_preview(server):
+    text_store.write_text_store(server, MD5_NAME, [(1, "Ünïcödé "), (2, "text")])
+
+    with text_store.TextStore(server, MD5_NAME) as store:
+        assert store.preview(3) == "Ünï"
+        assert store.preview() == "Ünïcödé text"
+
+
+def test_close_after_views_are_released(server):
+    text_store.write_text_store(server, MD5_NAME, [(1, "text")])
+
+    store = text_store.TextStore(server, MD5_NAME)
+    with store.element_bytes(0) as element_bytes:
+        kept_bytes = bytes(element_bytes)
+    with store.page_range_bytes(1, 1):
+        pass
+    store.close()
+    assert kept_bytes == b"text"
+
+
+def test_empty_document(server):
+    text_store.write_text_store(server, MD5_NAME, [])
+
+    with text_store.TextStore(server, MD5_NAME) as store:
+        assert len(store) == 0
+        assert list(store) == []
+        assert store.preview() == ""
+        with store.page_range_bytes(1, 1) as views:
+            assert views == []
+        assert store.progress == 1.0
+
+
+def test_rewrite_leaves_no_temporary_files(server):
+    text_store.write_text_store(server, MD5_NAME, [(1, "old")])
+    text_store.write_text_store(server, MD5_NAME, [(1, "new"), (2, "text")])
+
+    with text_store.TextStore(server, MD5_NAME) as store:
+        assert list(store) == [(1, "new"), (2, "text")]
+    text_folder = os.path.dirname(get_blob_store(server).get_path("text", f"{MD5_NAME}.txt"))
+    assert sorted(os.listdir(text_folder)) == [f"{MD5_NAME}.idx", f"{MD5_NAME}.txt"]
@@ -0,0 +1,96 @@
+# Measures how many concurrent requests the backend serves while every one of them waits on the database.
+# Each simulated request runs one query taking --latency seconds (SELECT SLEEP), either the old way, calling DBManager
+# straight from async code, or through AsyncDatabase. Meanwhile a heartbeat task measures how long the event loop was
+# blocked, which is how long every other request would have been stuck.
+#
+# Run it anywhere the database is reachable, e.g. in the backend container:
+#   python scripts/benchmark_db_concurrency.py --host db --password-file /run/secrets/db-password
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from src.database import DBConnectionPool, DBManager, AsyncDatabase  # noqa: E402
+
+
+async def heartbeat(interval: float, delays: list):
+    while True:
+        expected = time.monotonic() + interval
+        await asyncio.sleep(interval)
+        delays.append(max(0.0, time.monotonic() - expected))
+
+
+async def blocking_request(pool: DBConnectionPool, latency: float):
+    # What the handlers did before: the query runs on the event loop thread.
+    with DBManager(pool) as database:
+        database.run_query("SELECT SLEEP(%s)", (latency,))
+
+
+async def async_request(database: AsyncDatabase, latency: float):
+    await database.run_query("SELECT SLEEP(%s)", (latency,))
+
+
+async def run_benchmark(name: str, make_request, requests: int, concurrency: int) -> dict:
+    delays = []
+    heartbeat_task = asyncio.create_task(heartbeat(0.01, delays))
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    # All requests arrive at once, a request's latency is how long until it was answered.
+    async def request():
+        async with semaphore:
+            await make_request()
+            latencies.append(time.monotonic() - start)
+
+    start = time.monotonic()
+    await asyncio.gather(*(request() for _ in range(requests)))
+    elapsed = time.monotonic() - start
+    # Let the heartbeat wake up once more, it can't while the loop is blocked.
+    await asyncio.sleep(0.05)
+    heartbeat_task.cancel()
+
+    latencies.sort()
+    return {
+        "mode": name,
+        "seconds": elapsed,
+        "requests_per_second": requests / elapsed,
+        "p50_latency": latencies[len(latencies) // 2],
+        "p95_latency": latencies[int(len(latencies) * 0.95) - 1],
+        "max_loop_stall": max(delays, default=0.0),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmarks concurrent requests under database latency.")
+    parser.add_argument("--host", default="db")
+    parser.add_argument("--password-file", default="/run/secrets/db-password")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds every query takes.")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="Requests in flight at once.")
+    parser.add_argument("--pool-size", type=int, default=10)
+    args = parser.parse_args()
+
+    pool = DBConnectionPool(args.pool_size, 30, 30, args.password_file, host=args.host)
+    database = AsyncDatabase(pool)
+
+    results = [
+        await run_benchmark(
+            "blocking", lambda: blocking_request(pool, args.latency), args.requests, args.concurrency
+        ),
+        await run_benchmark("async", lambda: async_request(database, args.latency), args.requests, args.concurrency),
+    ]
+
+    print(f"{args.requests} requests, {args.concurrency} concurrent, {args.latency * 1000:.0f}ms per query")
+    for result in results:
+        print(
+            f"{result['mode']:>8}: {result['seconds']:.2f}s, {result['requests_per_second']:.1f} req/s, "
+            f"p50 {result['p50_latency'] * 1000:.0f}ms, p95 {result['p95_latency'] * 1000:.0f}ms, "
+            f"longest event loop stall {result['max_loop_stall'] * 1000:.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
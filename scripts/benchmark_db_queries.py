@@ -0,0 +1,140 @@
+# Times the backend's hot queries over a seeded dataset, before & after the lookup indexes of migration 4.
+# Creates (and drops first) a separate database, migrates it to version 3, seeds --users users & --paid-files paid
+# files, times the queries, applies the remaining migrations & times them again. Seeding 1M paid files takes minutes.
+#
+# Run it anywhere the database is reachable, e.g. in the backend container:
+#   python scripts/benchmark_db_queries.py --host db --password-file /run/secrets/db-password
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from src.database import DBConnectionPool, DBManager  # noqa: E402
+from src.migrations import run_migrations  # noqa: E402
+
+CONVERSION_TYPES = ("flashcards", "keywords", "test", "text")
+SEED_BATCH_SIZE = 10000
+
+
+def get_email(user_id: int) -> str:
+    return f"user{user_id}@example.com"
+
+
+def get_md5_name(file_number: int) -> str:
+    return hashlib.md5(str(file_number).encode("utf-8")).hexdigest()
+
+
+def seed(database: DBManager, user_count: int, paid_file_count: int, rng: random.Random):
+    cursor = database.cursor
+    for batch_start in range(1, user_count + 1, SEED_BATCH_SIZE):
+        cursor.executemany(
+            "INSERT INTO users (id, email, password, salt, card_connected) VALUES (%s, %s, %s, %s, 1)",
+            [
+                (user_id, get_email(user_id), "0" * 64, os.urandom(16))
+                for user_id in range(batch_start, min(batch_start + SEED_BATCH_SIZE, user_count + 1))
+            ],
+        )
+        database.connection.commit()
+
+    for batch_start in range(1, paid_file_count + 1, SEED_BATCH_SIZE):
+        file_ids = range(batch_start, min(batch_start + SEED_BATCH_SIZE, paid_file_count + 1))
+        cursor.executemany(
+            "INSERT INTO paid_files (file_id, md5_name, conversion_type, data_length) VALUES (%s, %s, %s, %s)",
+            [(file_id, get_md5_name(file_id // 2), CONVERSION_TYPES[file_id % 4], 50) for file_id in file_ids],
+        )
+        cursor.executemany(
+            "INSERT INTO paid_files_jt (user_id, file_id) VALUES (%s, %s)",
+            [(rng.randint(1, user_count), file_id) for file_id in file_ids],
+        )
+        database.connection.commit()
+        print(f"Seeded {file_ids[-1]} paid files", file=sys.stderr)
+
+
+def time_queries(database: DBManager, user_count: int, paid_file_count: int, runs: int, rng: random.Random):
+    # (name, query, parameters for a run)
+    queries = [
+        ("get_user", "SELECT * FROM users WHERE email = %s", lambda: (get_email(rng.randint(1, user_count)),)),
+        ("get_db_user_id", "SELECT id FROM users WHERE email = %s", lambda: (get_email(rng.randint(1, user_count)),)),
+        (
+            "user_has_paid_file",
+            """
+            SELECT 1
+            FROM paid_files pf
+            INNER JOIN paid_files_jt uft ON pf.file_id = uft.file_id
+            INNER JOIN users u ON uft.user_id = u.id
+            WHERE u.email = %s AND pf.md5_name = %s AND pf.conversion_type = %s
+            """,
+            lambda: (
+                get_email(rng.randint(1, user_count)),
+                get_md5_name(rng.randint(1, paid_file_count) // 2),
+                rng.choice(CONVERSION_TYPES),
+            ),
+        ),
+        (
+            "get_paid_files",
+            """
+            SELECT pf.md5_name, pf.conversion_type
+            FROM paid_files pf
+            INNER JOIN paid_files_jt uft ON pf.file_id = uft.file_id
+            INNER JOIN users u ON uft.user_id = u.id
+            WHERE u.email = %s
+            """,
+            lambda: (get_email(rng.randint(1, user_count)),),
+        ),
+    ]
+
+    results = {}
+    for name, query, get_parameters in queries:
+        durations = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            database.cursor.execute(query, get_parameters())
+            database.cursor.fetchall()
+            durations.append(time.perf_counter() - start)
+
+        durations.sort()
+        results[name] = (durations[len(durations) // 2], durations[int(len(durations) * 0.95) - 1])
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the hot queries with & without the lookup indexes.")
+    parser.add_argument("--host", default="db")
+    parser.add_argument("--password-file", default="/run/secrets/db-password")
+    parser.add_argument("--database", default="query_benchmark", help="Dropped & recreated, never use a real one.")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--paid-files", type=int, default=1000000)
+    parser.add_argument("--runs", type=int, default=200, help="Runs of each query.")
+    args = parser.parse_args()
+
+    with DBManager(DBConnectionPool(1, 30, 30, args.password_file, host=args.host)) as database:
+        database.cursor.execute(f"DROP DATABASE IF EXISTS `{args.database}`")
+        database.cursor.execute(f"CREATE DATABASE `{args.database}`")
+
+    pool = DBConnectionPool(1, 30, 30, args.password_file, database=args.database, host=args.host)
+    rng = random.Random(0)
+
+    run_migrations(pool, target_version=3)
+    with DBManager(pool) as database:
+        seed(database, args.users, args.paid_files, rng)
+        before = time_queries(database, args.users, args.paid_files, args.runs, rng)
+
+    run_migrations(pool)
+    with DBManager(pool) as database:
+        after = time_queries(database, args.users, args.paid_files, args.runs, rng)
+
+    print(f"{args.users} users, {args.paid_files} paid files, {args.runs} runs per query (p50 / p95)")
+    for name in before:
+        print(
+            f"{name:>20}: {before[name][0] * 1000:8.2f}ms / {before[name][1] * 1000:8.2f}ms without indexes, "
+            f"{after[name][0] * 1000:8.2f}ms / {after[name][1] * 1000:8.2f}ms with indexes"
+        )
+
+
+if __name__ == "__main__":
+    main()
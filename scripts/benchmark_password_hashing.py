@@ -0,0 +1,78 @@
+# Measures login throughput & how long the event loop is blocked while a burst of logins verifies passwords. Each
+# simulated login verifies one password, either inline on the event loop as logins used to, or in PasswordHasher's
+# threads. A heartbeat task measures the event loop stalls, which is how long every other request would have waited.
+#
+#   python scripts/benchmark_password_hashing.py --logins 64 --iterations 100000
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from src.passwords import PasswordHasher, hash_password, verify_password  # noqa: E402
+
+PASSWORD = "correct horse battery staple"
+
+
+async def heartbeat(interval: float, delays: list):
+    while True:
+        expected = time.monotonic() + interval
+        await asyncio.sleep(interval)
+        delays.append(max(0.0, time.monotonic() - expected))
+
+
+async def inline_login(password: str, stored_hash: str):
+    # What login did before: the hash runs on the event loop thread.
+    return verify_password(password, stored_hash)
+
+
+async def run_benchmark(name: str, make_login, logins: int) -> dict:
+    delays = []
+    heartbeat_task = asyncio.create_task(heartbeat(0.01, delays))
+    await asyncio.sleep(0)
+
+    start = time.monotonic()
+    results = await asyncio.gather(*(make_login() for _ in range(logins)))
+    elapsed = time.monotonic() - start
+    # Let the heartbeat wake up once more, it can't while the loop is blocked.
+    await asyncio.sleep(0.05)
+    heartbeat_task.cancel()
+
+    assert all(results)
+    return {
+        "mode": name,
+        "seconds": elapsed,
+        "logins_per_second": logins / elapsed,
+        "total_loop_stall": sum(delays),
+        "max_loop_stall": max(delays, default=0.0),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmarks a burst of logins, inline & in the hashing threads.")
+    parser.add_argument("--logins", type=int, default=64, help="Logins arriving at once.")
+    parser.add_argument("--iterations", type=int, default=100000, help="PBKDF2 iterations of the password hash.")
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    stored_hash = hash_password(PASSWORD, args.iterations)
+    hasher = PasswordHasher(args.iterations, args.threads)
+
+    results = [
+        await run_benchmark("inline", lambda: inline_login(PASSWORD, stored_hash), args.logins),
+        await run_benchmark("executor", lambda: hasher.verify(PASSWORD, stored_hash), args.logins),
+    ]
+
+    print(f"{args.logins} logins at once, {args.iterations} iterations, {args.threads} hashing threads")
+    for result in results:
+        print(
+            f"{result['mode']:>8}: {result['seconds']:.2f}s, {result['logins_per_second']:.1f} logins/s, "
+            f"event loop stalled {result['total_loop_stall'] * 1000:.0f}ms in total, "
+            f"longest stall {result['max_loop_stall'] * 1000:.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
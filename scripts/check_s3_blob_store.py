@@ -0,0 +1,92 @@
+# Runs the S3 blob store against a real bucket, as two backend nodes with separate data folders would use it.
+# Creates the bucket if needed & only touches blobs under a random name, which it deletes again at the end.
+#
+# Start MinIO (docker compose --profile minio up) and run it where MinIO is reachable, e.g. in the backend container:
+#   AWS_ACCESS_KEY_ID=minioadmin AWS_SECRET_ACCESS_KEY=minioadmin \
+#       python scripts/check_s3_blob_store.py --endpoint-url http://minio:9000
+import os
+import sys
+import json
+import uuid
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from src import artifact_io  # noqa: E402
+from src.blob_store import BLOB_KINDS, S3BlobStore  # noqa: E402
+
+
+def get_folders(root: str) -> dict[str, str]:
+    return {kind: os.path.join(root, kind) for kind in BLOB_KINDS}
+
+
+def check(name: str, passed: bool):
+    print(f"{'ok' if passed else 'FAILED'}: {name}")
+    if not passed:
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the S3 blob store against a bucket.")
+    parser.add_argument("--endpoint-url", default=None, help="None for AWS, e.g. http://minio:9000 for MinIO.")
+    parser.add_argument("--bucket", default="pdf2questions")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    md5_name = uuid.uuid4().hex
+    try:
+        node_a = S3BlobStore(get_folders(os.path.join(root, "a")), args.bucket, args.endpoint_url)
+        node_b = S3BlobStore(get_folders(os.path.join(root, "b")), args.bucket, args.endpoint_url)
+
+        check("missing blob doesn't exist", not node_b.exists("upload", f"{md5_name}.pdf"))
+        check("missing blob reads as None", node_b.read("upload", f"{md5_name}.pdf") is None)
+
+        node_a.write("upload", f"{md5_name}.pdf", b"%PDF-1.4 test")
+        check("blob written on one node exists on the other", node_b.exists("upload", f"{md5_name}.pdf"))
+        check("blob is downloaded intact", node_b.read("upload", f"{md5_name}.pdf") == b"%PDF-1.4 test")
+
+        # Compressed artifacts, in a directory per document like processed results.
+        result_name = f"{md5_name}/flashcards.json"
+        with artifact_io.write_artifact(node_a.get_write_path("processed", result_name)) as file:
+            json.dump({"data": [1, 2, 3]}, file)
+        node_a.publish_artifact("processed", result_name)
+
+        check("artifact exists on the other node", node_b.artifact_exists("processed", result_name))
+        check("other node sees the document's directory", node_b.has_prefix("processed", md5_name))
+        check("unknown document has no directory", not node_b.has_prefix("processed", uuid.uuid4().hex))
+        result_text = artifact_io.read_artifact_text(node_b.fetch_artifact("processed", result_name))
+        check("artifact is fetched & decompressed", json.loads(result_text) == {"data": [1, 2, 3]})
+
+        # A result replaced on one node is downloaded again by the other.
+        with artifact_io.write_artifact(node_a.get_write_path("processed", result_name)) as file:
+            json.dump({"data": [4]}, file)
+        node_a.publish_artifact("processed", result_name)
+        result_text = artifact_io.read_artifact_text(node_b.fetch_artifact("processed", result_name))
+        check("replaced artifact is fetched again", json.loads(result_text) == {"data": [4]})
+
+        # Both nodes append to the same log before either publishes, neither node's entries are lost.
+        log_name = f"{md5_name}.txt.gz"
+        node_a.write("log", log_name, b"a1 ")
+        for node, entry in ((node_a, b"a2 "), (node_b, b"b1 ")):
+            with open(node.fetch("log", log_name), "ab") as file:
+                file.write(entry)
+        node_a.publish("log", log_name)
+        node_b.publish("log", log_name)
+        check("concurrent log appends are merged", node_a.read("log", log_name) == b"a1 a2 b1 ")
+        check("merged log is published", node_b.read("log", log_name) == b"a1 a2 b1 ")
+        node_a.delete("log", log_name)
+
+        node_a.delete("upload", f"{md5_name}.pdf")
+        node_b.evict(node_b.get_path("upload", f"{md5_name}.pdf"))
+        check("deleted blob is gone from the bucket", not node_b.exists("upload", f"{md5_name}.pdf"))
+
+        node_a.delete("processed", f"{result_name}{artifact_io.COMPRESSED_SUFFIX}")
+        check("bucket is cleaned up", not node_a.has_prefix("processed", md5_name))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
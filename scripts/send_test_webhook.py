@@ -0,0 +1,52 @@
+# Sends a signed stripe webhook event to the backend, standing in for stripe when testing billing locally.
+# The event is signed the way stripe signs them, with the webhook_secret from the backend's stripe secrets file.
+#
+#   python scripts/send_test_webhook.py --secret whsec_test --customer cus_123 --type invoice.updated
+import hmac
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import requests
+
+
+def get_signature_header(payload: str, secret: str, timestamp: int) -> str:
+    signature = hmac.new(secret.encode("utf-8"), f"{timestamp}.{payload}".encode("utf-8"), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sends a signed stripe webhook event to the backend.")
+    parser.add_argument("--url", default="http://localhost:8000/stripe-webhook")
+    parser.add_argument("--secret", required=True, help="The webhook_secret the backend was configured with.")
+    parser.add_argument("--customer", required=True, help="Stripe customer id, e.g. cus_...")
+    parser.add_argument("--type", default="invoice.updated", help="Event type, e.g. customer.subscription.deleted")
+    args = parser.parse_args()
+
+    object_type = "subscription" if args.type.startswith("customer.subscription.") else "invoice"
+    event = {
+        "id": f"evt_test_{uuid.uuid4().hex}",
+        "object": "event",
+        "api_version": "2023-10-16",
+        "created": int(time.time()),
+        "type": args.type,
+        "livemode": False,
+        "data": {"object": {"id": f"test_{uuid.uuid4().hex}", "object": object_type, "customer": args.customer}},
+    }
+    payload = json.dumps(event)
+
+    response = requests.post(
+        args.url,
+        data=payload,
+        headers={
+            "Content-Type": "application/json",
+            "Stripe-Signature": get_signature_header(payload, args.secret, int(time.time())),
+        },
+        timeout=30,
+    )
+    print(response.status_code, response.text)
+
+
+if __name__ == "__main__":
+    main()